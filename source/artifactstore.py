@@ -0,0 +1,287 @@
+""" Storage of the book artifacts: titles, table of contents, summaries, outlines, chapters,
+status and progress.
+By default every artifact is a file in the output directory, as it has always been. Optionally
+the artifacts live in a SQLite database (output/book.sqlite) in WAL mode, where writes are
+transactional and many workers, threads or processes, can write the same book concurrently.
+The database can be exported to the file layout at any time.
+"""
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# Artifacts that belong to a book. Other files of the output directory, e.g. the usage ledger or
+# the embedding index, are owned by their components and stay files.
+STAGES = ("book_titles", "toc", "plot", "chapter", "chapteroutline", "chapterfull",
+          "fullbook", "status", "progress", "summarytree")
+
+DATABASE_NAME = "book.sqlite"
+
+
+def parse_artifact_name(name: str) -> tuple:
+    """ Splits an artifact name into its stage and chapter index.
+        "chapteroutline_3.txt" is ("chapteroutline", 3), "toc.txt" is ("toc", None).
+
+    Args:
+        name (str): File name of the artifact.
+
+    Returns:
+        tuple: The stage and the chapter index, or None if the artifact is not per chapter.
+    """
+    base_name = os.path.splitext(name)[0]
+    stage, _, index = base_name.rpartition("_")
+    if stage and index.isdigit():
+        return stage, int(index)
+    return base_name, None
+
+
+class FileArtifactStore():
+    """ Stores every artifact as a file in the output directory. Writes are atomic. """
+
+    def __init__(self, output_path: str):
+        """ Set up the store.
+
+        Args:
+            output_path (str): Output directory of the book.
+        """
+        self.output_path = output_path
+
+    def path(self, name: str) -> str:
+        """ Returns the path of an artifact. """
+        return os.path.join(self.output_path, name)
+
+    def exists(self, name: str) -> bool:
+        """ Returns whether an artifact exists. """
+        return os.path.exists(self.path(name))
+
+    def read(self, name: str) -> str:
+        """ Reads an artifact.
+
+        Raises:
+            FileNotFoundError: Raises FileNotFoundError if the artifact does not exist.
+        """
+        with open(self.path(name), "r", encoding="utf-8") as f:
+            return f.read()
+
+    def write(self, name: str, content: str):
+        """ Writes an artifact to a temporary file first and then renames it, so that a crash
+            never leaves a truncated artifact behind.
+        """
+        write_file(self.path(name), content)
+
+    def delete(self, name: str):
+        """ Deletes an artifact if it exists. """
+        if self.exists(name):
+            os.remove(self.path(name))
+
+    def names(self, stage: str) -> list:
+        """ Returns the names of the artifacts of a stage, ordered by chapter index. """
+        if not os.path.exists(self.output_path):
+            return []
+
+        names = [name for name in os.listdir(self.output_path)
+                 if not name.endswith((".tmp", ".partial"))
+                 and parse_artifact_name(name)[0] == stage]
+        return sorted(names, key=lambda name: parse_artifact_name(name)[1] or 0)
+
+    @contextmanager
+    def transaction(self):
+        """ Groups writes. Files have no transactions, every single write is atomic. """
+        yield self
+
+
+class SQLiteArtifactStore():
+    """ Stores the artifacts in a SQLite database in WAL mode. Thread-safe, and several
+        processes can write the same database.
+    """
+
+    def __init__(self, database_path: str, busy_timeout: float = 30.0):
+        """ Set up the store and create the table if necessary.
+
+        Args:
+            database_path (str): Path to the database file.
+            busy_timeout (float, optional): Seconds a write waits for other writers.
+                Defaults to 30.
+        """
+        self.database_path = database_path
+        self.busy_timeout = busy_timeout
+
+        # Every thread has its own connection, a connection must not be shared between threads.
+        self.local = threading.local()
+
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS artifacts ("
+                           "name TEXT PRIMARY KEY, stage TEXT NOT NULL, chapter INTEGER, "
+                           "content TEXT NOT NULL, updated REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS artifacts_stage_chapter "
+                           "ON artifacts (stage, chapter)")
+
+    def connection(self) -> sqlite3.Connection:
+        """ Returns the connection of the current thread. It is opened on first use. """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # Autocommit mode, transactions are begun explicitly.
+            connection = sqlite3.connect(self.database_path, timeout=self.busy_timeout,
+                                         isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.depth = 0
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """ Runs the enclosed reads and writes in one transaction. The write lock is taken
+            at the start, so that a read-modify-write cannot interleave with other writers.
+            Nested transactions join the outer one.
+        """
+        connection = self.connection()
+        if self.local.depth > 0:
+            self.local.depth += 1
+            try:
+                yield self
+            finally:
+                self.local.depth -= 1
+            return
+
+        connection.execute("BEGIN IMMEDIATE")
+        self.local.depth = 1
+        try:
+            yield self
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+        finally:
+            self.local.depth = 0
+
+    def exists(self, name: str) -> bool:
+        """ Returns whether an artifact exists. """
+        row = self.connection().execute(
+            "SELECT 1 FROM artifacts WHERE name = ?", (name,)).fetchone()
+        return row is not None
+
+    def read(self, name: str) -> str:
+        """ Reads an artifact.
+
+        Raises:
+            FileNotFoundError: Raises FileNotFoundError if the artifact does not exist.
+        """
+        row = self.connection().execute(
+            "SELECT content FROM artifacts WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"Artifact not found: {name} in {self.database_path}")
+        return row[0]
+
+    def write(self, name: str, content: str):
+        """ Writes an artifact. """
+        stage, chapter = parse_artifact_name(name)
+        with self.transaction():
+            self.connection().execute(
+                "INSERT INTO artifacts (name, stage, chapter, content, updated) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET "
+                "content = excluded.content, updated = excluded.updated",
+                (name, stage, chapter, content, time.time()))
+
+    def delete(self, name: str):
+        """ Deletes an artifact if it exists. """
+        with self.transaction():
+            self.connection().execute("DELETE FROM artifacts WHERE name = ?", (name,))
+
+    def names(self, stage: str) -> list:
+        """ Returns the names of the artifacts of a stage, ordered by chapter index. """
+        rows = self.connection().execute(
+            "SELECT name FROM artifacts WHERE stage = ? ORDER BY chapter, name", (stage,)).fetchall()
+        return [row[0] for row in rows]
+
+    def import_files(self, output_path: str) -> int:
+        """ Imports the artifacts of the file layout in one transaction.
+
+        Args:
+            output_path (str): Output directory of the book.
+
+        Returns:
+            int: Number of imported artifacts.
+        """
+        file_store = FileArtifactStore(output_path)
+        names = [name for stage in STAGES for name in file_store.names(stage)]
+        with self.transaction():
+            for name in names:
+                self.write(name, file_store.read(name))
+        return len(names)
+
+    def export(self, output_path: str) -> int:
+        """ Exports all artifacts to the file layout of the output directory.
+
+        Args:
+            output_path (str): Directory to write the files to.
+
+        Returns:
+            int: Number of exported artifacts.
+        """
+        os.makedirs(output_path, exist_ok=True)
+        rows = self.connection().execute("SELECT name, content FROM artifacts").fetchall()
+        for name, content in rows:
+            write_file(os.path.join(output_path, name), content)
+        return len(rows)
+
+    def close(self):
+        """ Closes the connection of the current thread. """
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+def write_file(file_path: str, content: str):
+    """ Writes a file to a temporary file first and then renames it. Every thread and process
+        writes its own temporary file, so that concurrent writes of the same file do not mix.
+    """
+    temp_file_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_file_path, "w", encoding="utf-8") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file_path, file_path)
+
+
+_lock = threading.Lock()
+_stores = {}
+
+
+def open_artifact_store(output_path: str, sqlite: bool = False):
+    """ Returns the artifact store of a book. The project and all chain elements of a process
+        share one store per output directory. The backend is a property of the book: a book
+        whose output directory has a database always uses it, no matter which component opens
+        the store first or whether it passes the sqlite flag.
+
+    Args:
+        output_path (str): Output directory of the book.
+        sqlite (bool, optional): Whether to switch the book to the SQLite store. Existing
+            artifact files are imported once. Defaults to False.
+
+    Returns:
+        FileArtifactStore | SQLiteArtifactStore: The store.
+    """
+    database_path = os.path.join(output_path, DATABASE_NAME)
+    key = os.path.abspath(output_path)
+    with _lock:
+        store = _stores.get(key)
+        if isinstance(store, SQLiteArtifactStore):
+            return store
+
+        # The database may have been created since, e.g. by another process.
+        if os.path.exists(database_path):
+            store = SQLiteArtifactStore(database_path)
+        elif sqlite:
+            store = SQLiteArtifactStore(database_path)
+            imported = store.import_files(output_path)
+            print(f"Created {database_path} with {imported} artifacts.")
+        elif store is None:
+            store = FileArtifactStore(output_path)
+
+        _stores[key] = store
+        return store
@@ -1,7 +1,9 @@
 import os
-import glob
+import json
 
 from source.chain import BaseChainElement
+from source.structuredoutput import strip_list_marker
+from source.artifactstore import open_artifact_store
 
 
 class BaseBookChainElement(BaseChainElement):
@@ -14,17 +16,27 @@ class BaseBookChainElement(BaseChainElement):
         self.title_path = os.path.join(
             self.book_path, "output", "book_titles.txt")
         self.toc_path = os.path.join(self.book_path, "output", "toc.txt")
+        self.title_json_path = os.path.join(
+            self.book_path, "output", "book_titles.json")
+        self.toc_json_path = os.path.join(self.book_path, "output", "toc.json")
+
+        # The artifacts are files in the output directory or rows of the book's SQLite database.
+        self.store = open_artifact_store(os.path.join(self.book_path, "output"))
 
     def get_book_title(self):
 
-        with open(self.title_path, "r") as f:
-            title = f.read()
+        # Prefer the validated titles.
+        if self.store.exists("book_titles.json"):
+            return json.loads(self.store.read("book_titles.json"))["titles"][0]
+
+        title = self.store.read("book_titles.txt")
 
-        # Get the first line and remove the number.
-        title = title.split("\n")[0]
-        title = title.replace("1. ", "")
+        # Get the first non-empty line and remove the numbering.
+        lines = [line for line in title.split("\n") if strip_list_marker(line) != ""]
+        if not lines:
+            raise ValueError(f"No book title found in {self.title_path}")
 
-        return title
+        return strip_list_marker(lines[0])
 
     def get_book_description(self):
         with open(self.description_path, "r") as f:
@@ -32,36 +44,36 @@ class BaseBookChainElement(BaseChainElement):
         return description
 
     def get_toc(self):
-        with open(self.toc_path, "r") as f:
-            toc = f.read()
-        return toc
+        return self.store.read("toc.txt")
+
+    def get_chapter_titles(self):
+
+        # Prefer the validated table of contents.
+        if self.store.exists("toc.json"):
+            return json.loads(self.store.read("toc.json"))["chapters"]
 
-    def get_chapter_summary_paths(self):
+        toc = self.get_toc()
+        return [title for title in toc.split("\n") if title.strip() != ""]
 
-        # Glob all the paths in the output directory. Pattern is "chapter_*.txt".
-        summary_paths = glob.glob(os.path.join(
-            self.book_path, "output", "chapter_*.txt"))
-        summary_paths = sorted(summary_paths)
+    def get_chapter_summary_names(self):
 
-        return summary_paths
+        # Artifacts "chapter_NUMBER.txt", ordered by NUMBER.
+        return self.store.names("chapter")
 
-    def get_chapter_outline_paths(self):
+    def get_chapter_outline_names(self):
 
-        # Glob all the paths in the output directory. Pattern is "chapter_*.txt".
-        summary_paths = glob.glob(os.path.join(
-            self.book_path, "output", "chapteroutline_*.txt"))
-        summary_paths = sorted(summary_paths)
+        # Artifacts "chapteroutline_NUMBER.txt", ordered by NUMBER.
+        return self.store.names("chapteroutline")
 
-        return summary_paths
+    def get_chapter_names(self):
 
-    def get_chapter_paths(self):
+        # Artifacts "chapterfull_NUMBER.txt", ordered by NUMBER.
+        return self.store.names("chapterfull")
 
-        # Glob all the paths in the output directory. Pattern is "chapterfull_*.txt".
-        chapter_paths = glob.glob(os.path.join(
-            self.book_path, "output", "chapterfull_*.txt"))
-        chapter_paths = sorted(chapter_paths)
+    def get_chapter_index(self, name):
 
-        return chapter_paths
+        # The pattern is "NAME_NUMBER.txt". Map NUMBER to an integer.
+        return int(name.split("_")[-1].replace(".txt", ""))
 
     def extract_content(self, content, start_marker, end_marker=None):
 
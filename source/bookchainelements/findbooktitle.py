@@ -1,8 +1,10 @@
 import os
 import sys
+import json
 
 from source.bookchainelements.basebookchainelement import BaseBookChainElement
 from source.prompttemplate import PromptTemplate
+from source.structuredoutput import request_json, TITLES_SCHEMA
 
 
 from enum import Enum
@@ -29,7 +31,7 @@ class FindBookTitle(BaseBookChainElement):
     def step(self, llm_connection):
 
         # If the book titles file already exists, then we are done.
-        if os.path.exists(self.title_path):
+        if self.store.exists("book_titles.txt"):
             print("Book titles file already exists. Skipping FindBookTitle.")
             self.done = True
             return
@@ -55,20 +57,26 @@ class FindBookTitle(BaseBookChainElement):
             self.messages += [{"role": "user", "content": prompt}]
             response_message = llm_connection.chat(self.messages, version4=False)
             self.messages += [response_message]
+            self.advance_progress(current="suggested titles")
             self.current_step = FindBookTitleSteps.rank_book_titles
 
         # Rank the book titles.
         elif current_step is FindBookTitleSteps.rank_book_titles:
             prompt = PromptTemplate.get("rank_book_titles")
             self.messages += [{"role": "user", "content": prompt}]
-            response_message = llm_connection.chat(self.messages, version4=False)
-            self.messages += [response_message]
-
-            # Write the book titles to a file.
-            book_titles = response_message["content"]
-            with open(self.title_path, "w") as f:
-                f.write(book_titles)
-
+            try:
+                book_titles = request_json(llm_connection, self.messages, TITLES_SCHEMA, version4=False)
+            finally:
+                # Remove the prompt, also if the request failed and the step is retried.
+                self.messages = self.messages[:-1]
+
+            # Write the book titles. The text file is written last, it marks the step as done.
+            with self.store.transaction():
+                self.store.write("book_titles.json", json.dumps(book_titles, indent=4))
+                self.store.write("book_titles.txt", "\n".join(f"{index + 1}. {title}"
+                                 for index, title in enumerate(book_titles["titles"])))
+
+            self.advance_progress(current="ranked titles")
             self.done = True
 
         elif current_step is None:
@@ -3,6 +3,7 @@ import sys
 
 from source.bookchainelements.basebookchainelement import BaseBookChainElement
 from source.prompttemplate import PromptTemplate
+from source.structuredoutput import request_json, OUTLINE_SCHEMA
 
 
 from enum import Enum
@@ -14,9 +15,10 @@ class WriteChapterOutlinesSteps(str, Enum):
 
 class WriteChapterOutlines(BaseBookChainElement):
 
-    def __init__(self, book_path):
+    def __init__(self, book_path, embedding_index=None):
         super().__init__(book_path)
 
+        self.embedding_index = embedding_index
         self.current_step = WriteChapterOutlinesSteps.set_system_message
         self.done = False
         self.messages = []
@@ -40,42 +42,57 @@ class WriteChapterOutlines(BaseBookChainElement):
         # Suggest initial table of contents.
         elif current_step == WriteChapterOutlinesSteps.write_outlines:
 
-            # Get the book title.
-            book_title = self.get_book_title()
-
             # Get the chapter summaries.
-            chapter_summary_paths = self.get_chapter_summary_paths()
-
-            for chapter_summary_path in chapter_summary_paths:
-
-                chapter_outline_path = chapter_summary_path.replace("chapter_", "chapteroutline_")
-                if os.path.exists(chapter_outline_path):
-                    print(f"Chapter outline {chapter_outline_path} already exists. Skipping.")
-                    continue
-
-                # Get the chapter summary.
-                with open(chapter_summary_path, "r") as f:
-                    chapter_summary = f.read()
-
-                # Create the prompt.
-                prompt = PromptTemplate.get("write_chapteroutline").format(book_title, chapter_summary)
+            chapter_summary_names = self.get_chapter_summary_names()
+            self.set_progress_total(sum(1 for name in chapter_summary_names
+                                        if not self.store.exists(name.replace("chapter_", "chapteroutline_"))))
 
-                # Send the prompt.
-                self.messages += [{"role": "user", "content": prompt}]
-                response_message = llm_connection.chat(self.messages, version4=False)
-
-                # Write to a file.
-                chapter_outline = response_message["content"]
-                with open(chapter_outline_path, "w") as f:
-                    f.write(chapter_outline)
-
-                # Remove the last message.
-                self.messages = self.messages[:-1]
+            for chapter_summary_name in chapter_summary_names:
+                self.write_outline(llm_connection, chapter_summary_name)
 
             # Done.
             self.done = True
 
         elif current_step is None:
             raise ValueError("current_step is None. This should not happen.")
-        
-            
\ No newline at end of file
+
+    def write_outline(self, llm_connection, chapter_summary_name):
+        """ Writes the outline of a single chapter, unless it exists already.
+
+        Args:
+            llm_connection (class): Connector to handle GPT calls.
+            chapter_summary_name (str): Name of the chapter summary, e.g. "chapter_3.txt".
+        """
+        chapter_outline_name = chapter_summary_name.replace("chapter_", "chapteroutline_")
+        if self.store.exists(chapter_outline_name):
+            print(f"Chapter outline {chapter_outline_name} already exists. Skipping.")
+            return
+
+        # Get the book title.
+        book_title = self.get_book_title()
+
+        # Get the chapter summary.
+        chapter_summary = self.store.read(chapter_summary_name)
+
+        # Create the prompt.
+        prompt = PromptTemplate.get("write_chapteroutline").format(book_title, chapter_summary)
+
+        # Send the prompt.
+        self.messages += [{"role": "user", "content": prompt}]
+        try:
+            outline = request_json(llm_connection, self.messages, OUTLINE_SCHEMA, version4=False)
+        finally:
+            # Remove the prompt, also if the request failed and is retried.
+            self.messages = self.messages[:-1]
+
+        # Write to the store.
+        chapter_outline = "\n".join(f"- {point}" for point in outline["points"])
+        self.store.write(chapter_outline_name, chapter_outline)
+        self.advance_progress(current=f"chapter {self.get_chapter_index(chapter_outline_name) + 1}")
+
+        # Index the outline elements for retrieval.
+        if self.embedding_index is not None:
+            outline_lines = [line for line in chapter_outline.split("\n") if line.strip() != ""]
+            self.embedding_index.add(outline_lines, kind="outline",
+                                     chapter=self.get_chapter_index(chapter_outline_name))
+            self.embedding_index.save()
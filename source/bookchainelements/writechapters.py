@@ -1,8 +1,10 @@
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from source.bookchainelements.basebookchainelement import BaseBookChainElement
 from source.prompttemplate import PromptTemplate
+from source.embeddingindex import split_paragraphs
 
 
 from enum import Enum
@@ -14,13 +16,35 @@ class WriteChaptersSteps(str, Enum):
 
 class WriteChapters(BaseBookChainElement):
 
-    def __init__(self, book_path):
+    def __init__(self, book_path, embedding_index=None, retrieval_top_k=4,
+                 duplicate_index=None, max_duplicate_retries=2,
+                 parallel_lines=False, max_workers=8, smooth_transitions=False,
+                 summary_tree=None):
         super().__init__(book_path)
 
         self.current_step = WriteChaptersSteps.set_system_message
         self.done = False
         self.messages = []
 
+        # With an embedding index, every chapter starts from the system message and only gets
+        # the most relevant passages of the earlier chapters instead of the whole history.
+        self.embedding_index = embedding_index
+        self.retrieval_top_k = retrieval_top_k
+
+        # With a MinHash index, outline lines whose response repeats earlier text are requested again.
+        self.duplicate_index = duplicate_index
+        self.max_duplicate_retries = max_duplicate_retries
+
+        # In parallel mode all outline lines of a chapter are expanded at the same time
+        # from a shared context and stitched together in order afterwards.
+        self.parallel_lines = parallel_lines
+        self.max_workers = max_workers
+        self.smooth_transitions = smooth_transitions
+
+        # With a summary tree, every chapter starts from the system message and a summary of
+        # the story so far of bounded size instead of the whole history.
+        self.summary_tree = summary_tree
+
     def is_done(self):
         return self.done
 
@@ -44,65 +68,332 @@ class WriteChapters(BaseBookChainElement):
             book_title = self.get_book_title()
 
             # Get the chapter summaries.
-            chapter_outline_paths = self.get_chapter_outline_paths()
-            for chapter_index, chapter_outline_path in enumerate(chapter_outline_paths):
+            chapter_outline_names = self.get_chapter_outline_names()
 
-                print(f"Working on chapter {chapter_index + 1}/{len(chapter_outline_paths)}...")
+            # Make sure that chapters written in earlier runs are indexed.
+            self.index_existing_chapters()
 
-                chapter_path = chapter_outline_path.replace("chapteroutline_", "chapterfull_")
-                if os.path.exists(chapter_path):
-                    print(f"Chapter {chapter_path} already exists. Skipping.")
-                    continue
+            # The work units are the outline lines of the chapters that are not written yet.
+            self.set_progress_total(sum(
+                len(self.get_outline_lines(chapter_outline_name))
+                for chapter_outline_name in chapter_outline_names
+                if not self.store.exists(chapter_outline_name.replace("chapteroutline_", "chapterfull_"))))
 
-                # Get the chapter summary path.
-                chapter_summary_path = chapter_outline_path.replace("chapteroutline_", "chapter_")
+            for chapter_outline_name in chapter_outline_names:
+                self.write_chapter(llm_connection, chapter_outline_name)
 
-                # Get the chapter summary.
-                with open(chapter_summary_path, "r") as f:
-                    chapter_summary = f.read()
+            # Done.
+            self.done = True
 
-                # Get the outline.
-                with open(chapter_outline_path, "r") as f:
-                    chapter_outlines = f.read()
-                    chapter_outlines_lines = chapter_outlines.split("\n")
+        elif current_step is None:
+            raise ValueError("current_step is None. This should not happen.")
 
-                # Open the chapter file. 
-                chapter_file = open(chapter_path, "w")
+    def write_chapter(self, llm_connection, chapter_outline_name):
+        """ Writes a single chapter from its summary and outline, unless it exists already.
+
+        Args:
+            llm_connection (class): Connector to handle GPT calls.
+            chapter_outline_name (str): Name of the chapter outline, e.g. "chapteroutline_3.txt".
+        """
+        chapter_name = chapter_outline_name.replace("chapteroutline_", "chapterfull_")
+        if self.store.exists(chapter_name):
+            print(f"Chapter {chapter_name} already exists. Skipping.")
+            return
+
+        # Get the chapter summary.
+        chapter_summary = self.store.read(chapter_outline_name.replace("chapteroutline_", "chapter_"))
+
+        # Get the outline.
+        chapter_outlines = self.store.read(chapter_outline_name)
+        chapter_outlines_lines = self.get_outline_lines(chapter_outline_name)
+
+        # The sections of the chapter. The chapter is only written once it is complete,
+        # so that an interrupted chapter is not skipped in the next run.
+        chapter_sections = []
+
+        # Forget paragraphs of an interrupted earlier attempt at this chapter.
+        if self.duplicate_index is not None:
+            self.duplicate_index.remove_prefix(f"c{self.get_chapter_index(chapter_name)}p")
+
+        # The context of the chapter: the story so far, the relevant passages of the earlier
+        # chapters, and the summary and outline of the chapter.
+        chapter_messages = []
+        if self.summary_tree is not None:
+            chapter_messages += self.get_story_so_far_messages(self.get_chapter_index(chapter_name))
+        if self.embedding_index is not None:
+            chapter_messages += self.get_retrieval_messages(
+                self.get_chapter_index(chapter_name), chapter_summary)
+        prompt = PromptTemplate.get("write_chapter").format(chapter_summary, chapter_outlines)
+        chapter_messages += [{"role": "user", "content": prompt}]
+
+        # The story so far and the passages replace the history.
+        if self.embedding_index is not None or self.summary_tree is not None:
+            self.messages = self.messages[:1]
+        self.messages += chapter_messages
+
+        # Expand all outline lines at once.
+        if self.parallel_lines:
+            chapter_sections = self.write_chapter_parallel(
+                llm_connection, self.get_chapter_index(chapter_name), chapter_outlines_lines,
+                chapter_messages)
+
+        # Expand the outline lines one after the other.
+        else:
+            paragraph_count = 0
+
+            for chapter_outlines_line_index, chapter_outlines_line in enumerate(chapter_outlines_lines):
 
                 # Create the prompt.
-                prompt = PromptTemplate.get("write_chapter").format(chapter_summary, chapter_outlines)
+                prompt = PromptTemplate.get("write_chapter_line").format(chapter_outlines_line)
                 self.messages += [{"role": "user", "content": prompt}]
 
-                for chapter_outlines_line_index, chapter_outlines_line in enumerate(chapter_outlines_lines):
-
-                    print(f"Working on chapter outline line {chapter_outlines_line_index + 1}/{len(chapter_outlines_lines)}...")
-
-                    # Create the prompt.
-                    prompt = PromptTemplate.get("write_chapter_line").format(chapter_outlines_line)
-                    self.messages += [{"role": "user", "content": prompt}]
-
-                    # Get the response.
-                    response_message = llm_connection.chat(self.messages, long=True, version4=False)
-
-                    self.messages += [response_message]
-
-                    # Write to a file.
-                    chapter = response_message["content"]
-                    chapter_file.write(chapter)
-                    chapter_file.write("\n\n")
-
-                    # Flush the file.
-                    chapter_file.flush()
-
-                    # Remove the last message.
-                    #self.messages = self.messages[:-1]
-
-                # Close the file.   
-                chapter_file.close()
-
-            # Done.
-            self.done = True
-
-        elif current_step is None:
-            raise ValueError("current_step is None. This should not happen.")
-        
\ No newline at end of file
+                # Get the response.
+                response_message = llm_connection.chat(self.messages, long=True, version4=False)
+
+                # Request the outline line again if it repeats earlier text.
+                if self.duplicate_index is not None:
+                    response_message = self.request_without_duplicates(
+                        llm_connection, self.messages, response_message)
+                    paragraph_count = self.add_to_duplicate_index(
+                        self.get_chapter_index(chapter_name), paragraph_count, response_message["content"])
+
+                self.messages += [response_message]
+
+                # Add to the chapter.
+                chapter = response_message["content"]
+                chapter_sections.append(chapter)
+                self.advance_progress(
+                    current=f"chapter {self.get_chapter_index(chapter_name) + 1}, "
+                            f"line {chapter_outlines_line_index + 1}/{len(chapter_outlines_lines)}")
+
+                # Index the new paragraphs for the following chapters.
+                if self.embedding_index is not None:
+                    self.embedding_index.add_document(
+                        chapter, kind="chapter", chapter=self.get_chapter_index(chapter_name))
+
+                # Remove the last message.
+                #self.messages = self.messages[:-1]
+
+        # Write the complete chapter.
+        chapter_text = "".join(f"{section}\n\n" for section in chapter_sections)
+        self.store.write(chapter_name, chapter_text)
+        if self.embedding_index is not None:
+            self.embedding_index.save()
+
+        # Condense the chapter for the story so far of the following chapters.
+        if self.summary_tree is not None:
+            self.summary_tree.update_chapter(self.get_chapter_index(chapter_name), chapter_text)
+
+    def get_outline_lines(self, chapter_outline_name):
+        """ Returns the outline lines of a chapter that are expanded. In parallel mode empty
+            lines are skipped.
+        """
+        chapter_outlines_lines = self.store.read(chapter_outline_name).split("\n")
+        if self.parallel_lines:
+            chapter_outlines_lines = [line for line in chapter_outlines_lines if line.strip() != ""]
+        return chapter_outlines_lines
+
+    def index_existing_chapters(self):
+        """ Adds the chapters that already exist on disk to the embedding and duplicate indices
+            and the summary tree. Paragraphs that are indexed already and chapters that are
+            summarized already are skipped.
+        """
+        if self.embedding_index is None and self.duplicate_index is None and self.summary_tree is None:
+            return
+
+        for chapter_name in self.get_chapter_names():
+            chapter = self.store.read(chapter_name)
+            chapter_number = self.get_chapter_index(chapter_name)
+
+            if self.embedding_index is not None:
+                self.embedding_index.add_document(chapter, kind="chapter", chapter=chapter_number)
+
+            if self.duplicate_index is not None and f"c{chapter_number}p0" not in self.duplicate_index:
+                self.add_to_duplicate_index(chapter_number, 0, chapter)
+
+            if self.summary_tree is not None:
+                self.summary_tree.update_chapter(chapter_number, chapter)
+
+        if self.embedding_index is not None:
+            self.embedding_index.save()
+
+    def find_duplicate_paragraphs(self, text):
+        """ Returns the paragraphs of a text that are near-duplicates of earlier text. """
+        return [paragraph for paragraph in split_paragraphs(text)
+                if self.duplicate_index.query(paragraph)]
+
+    def add_to_duplicate_index(self, chapter_number, paragraph_offset, text):
+        """ Adds the paragraphs of a text to the duplicate index.
+
+        Args:
+            chapter_number (int): Number of the chapter the text belongs to.
+            paragraph_offset (int): Number of paragraphs of the chapter that are indexed already.
+            text (str): Text to add.
+
+        Returns:
+            int: Number of paragraphs of the chapter that are indexed now.
+        """
+        paragraphs = split_paragraphs(text)
+        for paragraph_index, paragraph in enumerate(paragraphs, start=paragraph_offset):
+            self.duplicate_index.add(f"c{chapter_number}p{paragraph_index}", paragraph, save=False)
+        self.duplicate_index.save()
+        return paragraph_offset + len(paragraphs)
+
+    def request_without_duplicates(self, llm_connection, messages, response_message):
+        """ Requests the current outline line again while its response repeats earlier text.
+            Only the affected outline line is requested again, not the whole chapter.
+
+        Args:
+            llm_connection (class): Connector to handle GPT calls.
+            messages (list): Messages that the outline line was requested with.
+            response_message (dict): Response to the outline line.
+
+        Returns:
+            dict: The last response. It might still contain duplicates after all retries.
+        """
+        duplicates = self.find_duplicate_paragraphs(response_message["content"])
+
+        retries = 0
+        while duplicates and retries < self.max_duplicate_retries:
+            retries += 1
+            print(f"{len(duplicates)} paragraphs repeat earlier text. "
+                  f"Requesting the outline line again ({retries}/{self.max_duplicate_retries})...")
+
+            prompt = PromptTemplate.get("write_chapter_line_duplicate").format("\n\n".join(duplicates))
+            retry_messages = messages + [response_message, {"role": "user", "content": prompt}]
+            response_message = llm_connection.chat(retry_messages, long=True, version4=False)
+
+            duplicates = self.find_duplicate_paragraphs(response_message["content"])
+
+        if duplicates:
+            print(f"Warning: {len(duplicates)} paragraphs still repeat earlier text.")
+
+        return response_message
+
+    def get_retrieval_messages(self, chapter_index, chapter_summary):
+        """ Retrieves the passages of the earlier chapters that are most relevant for the chapter.
+
+        Args:
+            chapter_index (int): Index of the chapter that is about to be written.
+            chapter_summary (str): Summary of that chapter, used as query.
+
+        Returns:
+            list: A list with a single user message, or an empty list if nothing was found.
+        """
+        passages = self.embedding_index.search(chapter_summary,
+                                               k=self.retrieval_top_k,
+                                               before_chapter=chapter_index)
+        if not passages:
+            return []
+
+        print(f"Retrieved {len(passages)} passages from earlier chapters.")
+        passages_text = "\n\n".join(passage["text"] for passage in passages)
+        prompt = PromptTemplate.get("write_chapter_context").format(passages_text)
+        return [{"role": "user", "content": prompt}]
+
+    def get_story_so_far_messages(self, chapter_index):
+        """ Returns the summary of the story before a chapter from the summary tree.
+
+        Args:
+            chapter_index (int): Index of the chapter that is about to be written.
+
+        Returns:
+            list: A list with a single user message, or an empty list for the first chapter.
+        """
+        story_so_far = self.summary_tree.story_so_far(chapter_index)
+        if not story_so_far:
+            return []
+
+        prompt = PromptTemplate.get("write_chapter_story_so_far").format(story_so_far)
+        return [{"role": "user", "content": prompt}]
+
+    def write_chapter_parallel(self, llm_connection, chapter_number, chapter_outlines_lines,
+                               chapter_messages):
+        """ Expands all outline lines of a chapter concurrently and returns the sections in order.
+            Every line is requested with the system message, the bounded context of the chapter
+            (summary and outline, and the story so far and passages if enabled) and its
+            neighbouring outline lines, not with the whole history. So the prompt of a line does
+            not grow with the book, and the chapter takes about as long as its slowest line.
+
+        Args:
+            llm_connection (class): Connector to handle GPT calls.
+            chapter_number (int): Number of the chapter.
+            chapter_outlines_lines (list): Non-empty outline lines of the chapter.
+            chapter_messages (list): Context messages of the chapter.
+
+        Returns:
+            list: The sections of the chapter.
+        """
+        print(f"Expanding {len(chapter_outlines_lines)} outline lines in parallel...")
+
+        lines_messages = []
+        for line_index, chapter_outlines_line in enumerate(chapter_outlines_lines):
+            previous_line = chapter_outlines_lines[line_index - 1] if line_index > 0 else "None, this is the first one."
+            next_line = (chapter_outlines_lines[line_index + 1]
+                         if line_index + 1 < len(chapter_outlines_lines) else "None, this is the last one.")
+            prompt = PromptTemplate.get("write_chapter_line_parallel").format(
+                previous_line, next_line, chapter_outlines_line)
+            lines_messages += [self.messages[:1] + chapter_messages + [{"role": "user", "content": prompt}]]
+
+        def expand(line_index):
+            response_message = llm_connection.chat(lines_messages[line_index], long=True, version4=False)
+            self.advance_progress(current=f"chapter {chapter_number + 1}, line {line_index + 1}/{len(lines_messages)} "
+                                          "in parallel")
+            return response_message
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            responses = list(executor.map(expand, range(len(lines_messages))))
+
+        # Request outline lines again that repeat earlier text. Sections are checked in order,
+        # so that a section is also compared with the sections before it.
+        if self.duplicate_index is not None:
+            paragraph_count = 0
+            for line_index, messages in enumerate(lines_messages):
+                responses[line_index] = self.request_without_duplicates(
+                    llm_connection, messages, responses[line_index])
+                paragraph_count = self.add_to_duplicate_index(
+                    chapter_number, paragraph_count, responses[line_index]["content"])
+
+        sections = [response["content"] for response in responses]
+        if self.smooth_transitions and len(sections) > 1:
+            sections = self.smooth_section_transitions(llm_connection, sections)
+
+        if self.embedding_index is not None:
+            for section in sections:
+                self.embedding_index.add_document(section, kind="chapter", chapter=chapter_number)
+
+        # Keep the chapter in the history, like the line by line mode does.
+        self.messages += [{"role": "assistant", "content": "\n\n".join(sections)}]
+
+        return sections
+
+    def smooth_section_transitions(self, llm_connection, sections):
+        """ Rewrites the first paragraph of every section but the first one, so that it follows
+            on from the last paragraph of the section before. This is a small request per
+            transition, and the transitions are requested concurrently.
+
+        Args:
+            llm_connection (class): Connector to handle GPT calls.
+            sections (list): Sections of the chapter in order.
+
+        Returns:
+            list: The sections with smoothed transitions.
+        """
+        print(f"Smoothing {len(sections) - 1} transitions...")
+
+        def smooth(section_index):
+            previous_paragraphs = split_paragraphs(sections[section_index - 1])
+            paragraphs = split_paragraphs(sections[section_index])
+            if not previous_paragraphs or not paragraphs:
+                return sections[section_index]
+
+            prompt = PromptTemplate.get("smooth_chapter_transition").format(
+                previous_paragraphs[-1], paragraphs[0])
+            response_message = llm_connection.chat(
+                self.messages[:1] + [{"role": "user", "content": prompt}], version4=False)
+            return "\n\n".join([response_message["content"].strip()] + paragraphs[1:])
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            smoothed_sections = list(executor.map(smooth, range(1, len(sections))))
+
+        return sections[:1] + smoothed_sections
@@ -3,6 +3,7 @@ import sys
 
 from source.bookchainelements.basebookchainelement import BaseBookChainElement
 from source.prompttemplate import PromptTemplate
+from source.structuredoutput import request_json, SUMMARY_SCHEMA
 
 
 from enum import Enum
@@ -14,9 +15,10 @@ class WriteChapterSummariesSteps(str, Enum):
 
 class WriteChapterSummaries(BaseBookChainElement):
 
-    def __init__(self, book_path):
+    def __init__(self, book_path, embedding_index=None):
         super().__init__(book_path)
 
+        self.embedding_index = embedding_index
         self.current_step = WriteChapterSummariesSteps.set_system_message
         self.done = False
         self.messages = []
@@ -45,40 +47,53 @@ class WriteChapterSummaries(BaseBookChainElement):
         # Suggest initial table of contents.
         elif current_step == WriteChapterSummariesSteps.write_summaries:
 
-            # Get the book title.
-            book_title = self.get_book_title()
-
-            # Get the book description.
-            description = self.get_book_description()
-
             # Get the table of contents.
-            toc = self.get_toc()
-            chapter_titles = toc.split("\n")
-            chapter_titles = [title for title in chapter_titles if title.strip() != ""]
-
-            for chapter_index, chapter_title in enumerate(chapter_titles):
-
-                summary_path = os.path.join(self.book_path, "output", f"chapter_{chapter_index}.txt")
-                if os.path.exists(summary_path):
-                    print(f"Summary for chapter {chapter_index + 1} already exists. Skipping.")
-                    continue
+            chapter_titles = self.get_chapter_titles()
+            self.set_progress_total(sum(1 for chapter_index in range(len(chapter_titles))
+                                        if not self.store.exists(f"chapter_{chapter_index}.txt")))
 
-                print(f"Writing summary for chapter {chapter_index + 1} of {len(chapter_titles)}")
-
-                prompt = PromptTemplate.get("write_chapter_summary").format(book_title, description, chapter_title)
-                self.messages += [{"role": "user", "content": prompt}]
-                response_message = llm_connection.chat(self.messages, version4=False)
-                self.messages = self.messages[:-1]
-
-                # Write to a file.
-                summary = response_message["content"]
-                with open(summary_path, "w") as f:
-                    f.write(summary)
+            for chapter_index in range(len(chapter_titles)):
+                self.write_summary(llm_connection, chapter_index, chapter_titles)
 
             # Done.
             self.done = True
 
         elif current_step is None:
             raise ValueError("current_step is None. This should not happen.")
-        
-            
\ No newline at end of file
+
+    def write_summary(self, llm_connection, chapter_index, chapter_titles):
+        """ Writes the summary of a single chapter, unless it exists already.
+
+        Args:
+            llm_connection (class): Connector to handle GPT calls.
+            chapter_index (int): Index of the chapter.
+            chapter_titles (list): Titles of all chapters.
+        """
+        summary_name = f"chapter_{chapter_index}.txt"
+        if self.store.exists(summary_name):
+            print(f"Summary for chapter {chapter_index + 1} already exists. Skipping.")
+            return
+
+        # Get the book title and description.
+        book_title = self.get_book_title()
+        description = self.get_book_description()
+
+        prompt = PromptTemplate.get("write_chapter_summary").format(
+            book_title, description, chapter_titles[chapter_index])
+        self.messages += [{"role": "user", "content": prompt}]
+        try:
+            chapter_summary = request_json(llm_connection, self.messages, SUMMARY_SCHEMA,
+                                           version4=False)
+        finally:
+            # Remove the prompt, also if the request failed and is retried.
+            self.messages = self.messages[:-1]
+
+        # Write to the store.
+        summary = f"{chapter_summary['title']}\n\n{chapter_summary['summary']}"
+        self.store.write(summary_name, summary)
+        self.advance_progress(current=f"chapter {chapter_index + 1} of {len(chapter_titles)}")
+
+        # Index the summary for retrieval.
+        if self.embedding_index is not None:
+            self.embedding_index.add_document(summary, kind="summary", chapter=chapter_index)
+            self.embedding_index.save()
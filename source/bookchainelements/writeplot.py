@@ -4,6 +4,7 @@ import os
 from enum import Enum
 
 from source.bookchainelements.basebookchainelement import BaseBookChainElement
+from source.convergence import ConvergenceDetector
 from source.prompttemplate import PromptTemplate
 
 
@@ -56,14 +57,19 @@ class WritePlot(BaseBookChainElement):
         BaseBookChainElement (class): Inherits from BqseBookChainElement
     """
 
-    def __init__(self, book_path: str):
+    def __init__(self, book_path: str, convergence_detector: ConvergenceDetector = None):
         """ Set up the class, passing the book path to the parent class.
 
         Args:
             book_path (String): Path to the book directory.
+            convergence_detector (ConvergenceDetector, optional): Stops refining once
+                consecutive drafts barely change. Defaults to None, which uses a
+                ConvergenceDetector with its default threshold.
         """
         super().__init__(book_path)
 
+        self.convergence_detector = convergence_detector or ConvergenceDetector()
+
         self.process_steps = ProcessSteps()
 
         self.description = ""
@@ -94,7 +100,7 @@ class WritePlot(BaseBookChainElement):
         """
 
         # If the plot file already exists, then we are done.
-        if os.path.exists(self.plot_path):
+        if self.store.exists("plot.txt"):
             print("Plot file already exists. Skipping FindPlot.")
             self.done = True
             return
@@ -138,8 +144,8 @@ class WritePlot(BaseBookChainElement):
                 self.messages,
                 version4=True)
 
-            self.key_content = self.extract_content(
-                response_message["content"], "Step 2:")
+            self.key_content = self.extract_refined_plot(
+                llm_connection, response_message)
             self.process_steps.advance_step()
 
         elif self.process_steps.get_step_index() == 3:
@@ -157,19 +163,50 @@ class WritePlot(BaseBookChainElement):
                 self.messages,
                 version4=True)
 
-            self.key_content = self.extract_content(
-                response_message["content"], "Step 2:")
+            previous_content = self.key_content
+            self.key_content = self.extract_refined_plot(
+                llm_connection, response_message)
 
             self.refine_plot += 1
 
-            if self.refine_plot >= self.refine_max:
+            converged = self.convergence_detector.converged(previous_content, self.key_content)
+            if converged:
+                print("Plot: " + self.convergence_detector.format_report(self.refine_max - 1,
+                                                                         self.refine_plot - 1))
+
+            if converged or self.refine_plot >= self.refine_max:
                 # Write the book titles to a file.
                 plot_line = self.key_content
-                with open(self.plot_path, "w", encoding='utf-8') as f:
-                    f.write(plot_line)
+                self.store.write("plot.txt", plot_line)
 
                 self.process_steps.advance_step()
                 self.done = True
 
         elif self.process_steps.get_step_index() is None:
             raise ValueError("current_step is None. This should not happen.")
+
+    def extract_refined_plot(self, llm_connection, response_message):
+        """ Extracts the refined plot after the "Step 2:" marker. If the marker is missing,
+            the answer is repaired with a short follow-up request instead of failing the step.
+
+        Args:
+            llm_connection (class): Connector to handle GPT calls
+            response_message (dict): Answer to the refine prompt.
+
+        Returns:
+            String: The refined plot.
+        """
+        try:
+            return self.extract_content(response_message["content"], "Step 2:")
+        except ValueError:
+            print("Refined plot is missing the \"Step 2:\" marker. Requesting a repair.")
+
+        repair_messages = self.messages + [response_message,
+                                           {"role": "user",
+                                            "content": PromptTemplate.get("repair_plot_marker")}]
+        repaired_message = llm_connection.chat(repair_messages, version4=True)
+        try:
+            return self.extract_content(repaired_message["content"], "Step 2:")
+        except ValueError:
+            # The repair answer only contains the plot.
+            return repaired_message["content"].strip()
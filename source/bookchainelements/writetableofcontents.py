@@ -1,8 +1,10 @@
 import os
 import sys
+import json
 
 from source.bookchainelements.basebookchainelement import BaseBookChainElement
 from source.prompttemplate import PromptTemplate
+from source.structuredoutput import request_json, TOC_SCHEMA
 
 
 from enum import Enum
@@ -27,7 +29,7 @@ class WriteTableOfContents(BaseBookChainElement):
 
     def step(self, llm_connection):
 
-        if os.path.exists(self.toc_path):
+        if self.store.exists("toc.txt"):
             print("Table of contents already exists. Skipping.")
             self.done = True
             return
@@ -55,20 +57,26 @@ class WriteTableOfContents(BaseBookChainElement):
             self.messages += [{"role": "user", "content": prompt}]
             response_message = llm_connection.chat(self.messages, version4=False)
             self.messages += [response_message]
+            self.advance_progress(current="draft")
             self.current_step = WriteTableOfContentsSteps.review_toc_draft
 
         # Review the table of contents.
         elif current_step is WriteTableOfContentsSteps.review_toc_draft:
             prompt = PromptTemplate.get("write_toc_review_draft")
             self.messages += [{"role": "user", "content": prompt}]
-            response_message = llm_connection.chat(self.messages, version4=False)
-            self.messages += [response_message]
-
-            # Write the book titles to a file.
-            chapter_titles = response_message["content"]
-            with open(self.toc_path, "w") as f:
-                f.write(chapter_titles)
-
+            try:
+                toc = request_json(llm_connection, self.messages, TOC_SCHEMA, version4=False)
+            finally:
+                # Remove the prompt, also if the request failed and the step is retried.
+                self.messages = self.messages[:-1]
+
+            # Write the table of contents. The text file is written last, it marks the step as done.
+            with self.store.transaction():
+                self.store.write("toc.json", json.dumps(toc, indent=4))
+                self.store.write("toc.txt", "\n".join(f"{index + 1}. {title}"
+                                 for index, title in enumerate(toc["chapters"])))
+
+            self.advance_progress(current="review")
             self.done = True
 
         elif current_step is None:
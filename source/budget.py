@@ -0,0 +1,148 @@
+""" Hard token and cost budget that is enforced while a book is written.
+When the budget runs low, requests are downgraded to a cheaper model and their context is shrunk.
+When it is used up, BudgetExceeded stops the chain cleanly before the next request.
+"""
+import threading
+
+from source.pricing import MODEL_PRICES, estimate_cost
+
+
+class BudgetExceeded(Exception):
+    """ Exception raised when a request would exceed the budget. """
+
+
+class Budget():
+    """ Keeps track of the spent tokens and cost and adjusts requests to the remaining budget. """
+
+    # Cheaper model to fall back to when the budget runs low.
+    DOWNGRADES = {
+        "gpt-4": "gpt-3.5-turbo-16k",
+        "gpt-4-32k": "gpt-3.5-turbo-16k",
+    }
+
+    def __init__(self,
+                 max_tokens: int = None,
+                 max_cost: float = None,
+                 downgrade_ratio: float = 0.7,
+                 shrink_ratio: float = 0.85,
+                 shrink_to_tokens: int = 4_000,
+                 min_completion_tokens: int = 256):
+        """ Set up the budget.
+
+        Args:
+            max_tokens (int, optional): Maximum number of tokens. Defaults to None.
+            max_cost (float, optional): Maximum cost in US dollars. Defaults to None.
+            downgrade_ratio (float, optional): Used share of the budget from which on requests
+                are downgraded to a cheaper model. Defaults to 0.7.
+            shrink_ratio (float, optional): Used share of the budget from which on the context of
+                requests is shrunk. Defaults to 0.85.
+            shrink_to_tokens (int, optional): Size the context is shrunk to. Defaults to 4000.
+            min_completion_tokens (int, optional): Completion tokens the budget has to leave for
+                a request to be sent. Defaults to 256.
+        """
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.downgrade_ratio = downgrade_ratio
+        self.shrink_ratio = shrink_ratio
+        self.shrink_to_tokens = shrink_to_tokens
+        self.min_completion_tokens = min_completion_tokens
+
+        self.spent_tokens = 0
+        self.spent_cost = 0.0
+        self.lock = threading.Lock()
+
+    def usage_ratio(self, extra_tokens: int = 0, extra_cost: float = 0.0) -> float:
+        """ Returns the used share of the budget, including an optional upcoming request. """
+        ratios = [0.0]
+        if self.max_tokens:
+            ratios.append((self.spent_tokens + extra_tokens) / self.max_tokens)
+        if self.max_cost:
+            ratios.append((self.spent_cost + extra_cost) / self.max_cost)
+        return max(ratios)
+
+    def remaining_completion_tokens(self, model: str, prompt_tokens: int):
+        """ Returns the completion tokens the budget leaves for a request, or None if it does
+            not limit them.
+
+        Args:
+            model (str): Model the request is sent to.
+            prompt_tokens (int): Number of prompt tokens of the request.
+
+        Returns:
+            int | None: The completion tokens, at least 0.
+        """
+        limits = []
+        with self.lock:
+            if self.max_tokens:
+                limits.append(self.max_tokens - self.spent_tokens - prompt_tokens)
+            if self.max_cost:
+                remaining_cost = self.max_cost - self.spent_cost - estimate_cost(model, prompt_tokens)
+                completion_price = MODEL_PRICES.get(model, (0.0, 0.0))[1]
+                if completion_price > 0:
+                    limits.append(int(remaining_cost * 1000 / completion_price))
+                elif remaining_cost < 0:
+                    limits.append(0)
+        if not limits:
+            return None
+        return max(0, min(limits))
+
+    def adjust(self, model: str, messages: list, count_tokens) -> tuple:
+        """ Adjusts a request to the remaining budget before it is sent.
+
+        Args:
+            model (str): Model the request is meant for.
+            messages (list): Messages of the request.
+            count_tokens (callable): Function counting the tokens of messages for a model.
+
+        Raises:
+            BudgetExceeded: Raises BudgetExceeded if the budget does not leave the minimum
+                completion tokens after the prompt.
+
+        Returns:
+            tuple: The model and the messages to use.
+        """
+        if self.usage_ratio() >= self.downgrade_ratio and model in self.DOWNGRADES:
+            print(f"Budget {self.usage_ratio():.0%} used. Downgrading {model} to {self.DOWNGRADES[model]}.")
+            model = self.DOWNGRADES[model]
+
+        prompt_tokens = count_tokens(messages, model)
+        if self.usage_ratio() >= self.shrink_ratio and prompt_tokens > self.shrink_to_tokens:
+            messages = self.shrink(messages, model, count_tokens)
+            shrunk_tokens = count_tokens(messages, model)
+            if shrunk_tokens < prompt_tokens:
+                print(f"Budget {self.usage_ratio():.0%} used. Shrunk context from {prompt_tokens} "
+                      f"to {shrunk_tokens} tokens.")
+            prompt_tokens = shrunk_tokens
+
+        remaining_tokens = self.remaining_completion_tokens(model, prompt_tokens)
+        if remaining_tokens is not None and remaining_tokens < self.min_completion_tokens:
+            raise BudgetExceeded(f"The next request ({prompt_tokens} prompt tokens and at least "
+                                 f"{self.min_completion_tokens} completion tokens) would exceed the budget. "
+                                 f"Spent so far: {self.spent_tokens} tokens, ${self.spent_cost:.2f}.")
+
+        return model, messages
+
+    def shrink(self, messages: list, model: str, count_tokens) -> list:
+        """ Drops the oldest messages until the context fits into shrink_to_tokens.
+            System messages and the last two messages (the current request) are always kept.
+        """
+        system_messages = [message for message in messages[:-2] if message["role"] == "system"]
+        history = [message for message in messages[:-2] if message["role"] != "system"]
+        current = messages[-2:]
+
+        while history and count_tokens(system_messages + history + current, model) > self.shrink_to_tokens:
+            history = history[1:]
+
+        return system_messages + history + current
+
+    def charge(self, model: str, prompt_tokens: int, completion_tokens: int):
+        """ Charges a finished request to the budget.
+
+        Args:
+            model (str): Model that answered the request.
+            prompt_tokens (int): Number of prompt tokens.
+            completion_tokens (int): Number of completion tokens.
+        """
+        with self.lock:
+            self.spent_tokens += prompt_tokens + completion_tokens
+            self.spent_cost += estimate_cost(model, prompt_tokens, completion_tokens)
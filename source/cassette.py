@@ -0,0 +1,191 @@
+""" Record and replay of the exchanges with the LLMs.
+In record mode every request and response of the backends is appended to a gzipped JSON lines
+file in the book directory, together with its latency. Recording a resumed run keeps the
+exchanges recorded before. In replay mode the responses are served
+back from that file without network access, either instantly or with the recorded latencies.
+"""
+import os
+import json
+import gzip
+import time
+import hashlib
+import threading
+from collections import deque
+
+
+class CassetteMiss(KeyError):
+    """ Exception raised when a replayed run sends a request that was not recorded. """
+
+
+class Cassette():
+    """ Records the exchanges with the LLMs or replays them. """
+
+    FILE_NAME = "cassette.jsonl.gz"
+    RECORD = "record"
+    REPLAY = "replay"
+
+    def __init__(self, cassette_path: str, mode: str, realtime: bool = False):
+        """ Open the cassette for recording or load it for replaying.
+
+        Args:
+            cassette_path (str): Path to the cassette file.
+            mode (str): Cassette.RECORD or Cassette.REPLAY.
+            realtime (bool, optional): Wait for the recorded latency of every response when
+                replaying. Defaults to False.
+
+        Raises:
+            ValueError: Raises ValueError if the mode is unknown.
+            FileNotFoundError: Raises FileNotFoundError if the cassette to replay does not exist.
+        """
+        if mode not in (self.RECORD, self.REPLAY):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+
+        self.cassette_path = cassette_path
+        self.mode = mode
+        self.realtime = realtime
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+
+        # Replayed responses by request key. Identical requests are served in recorded order.
+        self.entries = {}
+        self.file = None
+
+        if mode == self.RECORD:
+            if os.path.exists(cassette_path):
+                self.rewrite(self.read_entries())
+            self.file = gzip.open(cassette_path, "at", encoding="utf-8")
+        else:
+            if not os.path.exists(cassette_path):
+                raise FileNotFoundError(f"Cassette not found: {cassette_path}")
+            self.load()
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == self.REPLAY
+
+    @property
+    def skips_waits(self) -> bool:
+        """ Whether waits for the backends, e.g. polling delays, can be skipped. """
+        return self.replaying and not self.realtime
+
+    @staticmethod
+    def request_key(backend: str, operation: str, request: dict) -> str:
+        """ Returns a stable key of a request. """
+        request_json = json.dumps([backend, operation, request], sort_keys=True, default=str)
+        return hashlib.sha256(request_json.encode("utf-8")).hexdigest()
+
+    def read_entries(self) -> list:
+        """ Reads the recorded exchanges. The end of a recording that was interrupted, e.g. by
+            a crash, is incomplete and dropped.
+        """
+        entries = []
+        try:
+            with gzip.open(self.cassette_path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip() == "":
+                        continue
+                    entries.append(json.loads(line))
+        except (EOFError, json.JSONDecodeError):
+            print(f"Cassette {self.cassette_path} ends with an interrupted recording. "
+                  f"Keeping the {len(entries)} complete exchanges.")
+        return entries
+
+    def rewrite(self, entries: list):
+        """ Rewrites the cassette with complete exchanges only, so that new exchanges can be
+            appended to it.
+        """
+        temp_path = f"{self.cassette_path}.{os.getpid()}.tmp"
+        with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(temp_path, self.cassette_path)
+
+    def load(self):
+        """ Loads the recorded exchanges. """
+        for entry in self.read_entries():
+            self.entries.setdefault(entry["key"], deque()).append(entry)
+
+    def call(self, backend: str, operation: str, request: dict, function,
+             encode=None, decode=None):
+        """ Sends a request and records it, or serves the recorded response.
+
+        Args:
+            backend (str): Backend of the request, e.g. "openai", "assistants" or "langchain".
+            operation (str): Operation of the backend, e.g. "chat" or "create_run".
+            request (dict): Everything that determines the response.
+            function (callable): Sends the request and returns the response.
+            encode (callable, optional): Converts the response to JSON. Defaults to
+                model_dump for pydantic objects and to the response itself otherwise.
+            decode (callable, optional): Converts recorded JSON back to a response.
+                Defaults to returning the JSON.
+
+        Raises:
+            CassetteMiss: Raises CassetteMiss if the request was not recorded.
+
+        Returns:
+            Any: The response.
+        """
+        key = self.request_key(backend, operation, request)
+
+        if self.replaying:
+            with self.lock:
+                recorded = self.entries.get(key)
+                if not recorded:
+                    raise CassetteMiss(f"No recorded response for {backend}.{operation}")
+                entry = recorded.popleft()
+
+            if self.realtime:
+                time.sleep(entry["latency"])
+
+            return decode(entry["response"]) if decode is not None else entry["response"]
+
+        start_time = time.monotonic()
+        response = function()
+        latency = time.monotonic() - start_time
+
+        if encode is not None:
+            encoded = encode(response)
+        elif hasattr(response, "model_dump"):
+            encoded = response.model_dump(mode="json")
+        else:
+            encoded = response
+
+        entry = {"key": key,
+                 "backend": backend,
+                 "operation": operation,
+                 "offset": round(start_time - self.start_time, 3),
+                 "latency": round(latency, 3),
+                 "response": encoded}
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+        return response
+
+    def close(self):
+        """ Closes the cassette file. """
+        if self.file is not None:
+            with self.lock:
+                self.file.close()
+                self.file = None
+
+
+def cassette_call(cassette, backend: str, operation: str, request: dict, function,
+                  encode=None, decode=None):
+    """ Sends a request through the cassette, or directly if there is no cassette.
+
+    Args:
+        cassette (Cassette | None): The cassette of the project.
+        backend (str): Backend of the request.
+        operation (str): Operation of the backend.
+        request (dict): Everything that determines the response.
+        function (callable): Sends the request and returns the response.
+        encode (callable, optional): Converts the response to JSON. Defaults to None.
+        decode (callable, optional): Converts recorded JSON back to a response. Defaults to None.
+
+    Returns:
+        Any: The response.
+    """
+    if cassette is None:
+        return function()
+    return cassette.call(backend, operation, request, function, encode=encode, decode=decode)
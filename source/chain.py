@@ -1,41 +1,112 @@
-from source.project import Project
+from source.project import Project, JobCancelled
+from source.budget import BudgetExceeded
+
+# Outcomes of a run of the chain.
+COMPLETED = "completed"
+BUDGET_EXHAUSTED = "budget_exhausted"
+CANCELLED = "cancelled"
+
 
 class ChainExecutor:
 
-    def __init__(self, llm_connection, project_control=None):
+    def __init__(self, llm_connection, project_control=None, profiler=None):
         self.elements = []
         self.llm_connection = llm_connection
         self.project_control = project_control
+        self.profiler = profiler
 
     def add_element(self, element):
         self.elements.append(element)
 
-    def run(self):
+    def run(self) -> str:
+        """ Runs the chain elements in order until they are done, or until the budget is used up
+            or the job is cancelled. Everything written so far is kept in both cases, and the
+            next run resumes from there.
+
+        Returns:
+            str: COMPLETED, BUDGET_EXHAUSTED or CANCELLED.
+        """
 
         kwargs = {"llm_connection" : self.llm_connection}
         
         if self.project_control is not None:
             kwargs["project_control"] = self.project_control
 
+        # The connections share the project, which keeps the usage ledger.
+        project = self.project_control or getattr(self.llm_connection, "project_control", None)
+
         elements_to_execute = self.elements[::]
 
-        while len(elements_to_execute) > 0:
-            current_element = elements_to_execute.pop(0)
-            current_element.step(**kwargs)
-            while not current_element.is_done():
-                # Make print light grey color.
-                print("\033[0;37m", end="")
+        if self.profiler is not None:
+            self.profiler.start()
+
+        try:
+            while len(elements_to_execute) > 0:
+                current_element = elements_to_execute.pop(0)
+                element_name = get_element_name(current_element)
+                if project is not None:
+                    project.usage_ledger.set_step(element_name)
+                    current_element.progress = project.progress
+                    project.progress.start(element_name)
+
+                self.step_element(current_element, kwargs)
+                while not current_element.is_done():
+                    self.step_element(current_element, kwargs)
+
+                if project is not None:
+                    project.progress.finish(element_name)
+
+        # Stop cleanly. Everything written so far is kept and the next run resumes from there.
+        except BudgetExceeded as e:
+            print(f"Budget exhausted. Stopping. {e}")
+            return BUDGET_EXHAUSTED
 
-                current_element.step(**kwargs)
+        except JobCancelled as e:
+            print(f"Cancelled. Stopping. {e}")
+            return CANCELLED
 
-        current_element = self.elements[0]
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+            if project is not None:
+                project.progress.save(force=True)
+
+        return COMPLETED
+
+    def step_element(self, element, kwargs):
+        """ Advances an element by one step, under the profiler if profiling is active. """
+        if self.profiler is None:
+            element.step(**kwargs)
+            return
+
+        element_name = get_element_name(element).replace(" ", "_")
+        with self.profiler.profile_element(element_name):
+            element.step(**kwargs)
+
+
+def get_element_name(element) -> str:
+    """ Returns the name of a chain element in the usage ledger, the progress and the profiles. """
+    return getattr(element, "step_name", type(element).__name__)
 
 
 # Abstract class chain element.
 class BaseChainElement():
 
+    # Progress tracker of the book. Set by the ChainExecutor.
+    progress = None
+
     def is_done(self):
         raise NotImplementedError
 
     def step(self, **kwargs):
         raise NotImplementedError
+
+    def set_progress_total(self, units: int):
+        """ Sets the number of work units of the element, e.g. its outline lines. """
+        if self.progress is not None:
+            self.progress.set_total(get_element_name(self), units)
+
+    def advance_progress(self, units: int = 1, current: str = None):
+        """ Records completed work units of the element. """
+        if self.progress is not None:
+            self.progress.advance(get_element_name(self), units, current)
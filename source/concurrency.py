@@ -0,0 +1,167 @@
+""" Adaptive concurrency limit for local model servers.
+A local server, e.g. Ollama on a CPU box, has a sweet spot of parallel requests: below it the
+cores idle, above it the requests only queue and the latency explodes. The limiter finds it with
+AIMD: after every window of completed requests the limit grows by one while the throughput rises
+and the latency holds, and it is cut multiplicatively when the latency degrades or errors appear.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+
+class AdaptiveConcurrencyLimiter():
+    """ Limits the requests in flight to an adaptive limit. Thread-safe. """
+
+    def __init__(self,
+                 initial_limit: int = 2,
+                 min_limit: int = 1,
+                 max_limit: int = 16,
+                 window: int = 8,
+                 latency_tolerance: float = 1.5,
+                 decrease_factor: float = 0.5,
+                 telemetry=None,
+                 name: str = "local",
+                 clock=time.monotonic):
+        """ Set up the limiter.
+
+        Args:
+            initial_limit (int, optional): Requests in flight at the start. Defaults to 2.
+            min_limit (int, optional): Lowest limit. Defaults to 1.
+            max_limit (int, optional): Highest limit. Defaults to 16.
+            window (int, optional): Completed requests between two adjustments. Defaults to 8.
+            latency_tolerance (float, optional): Latency relative to the best observed latency
+                above which the limit is cut. Defaults to 1.5.
+            decrease_factor (float, optional): Factor the limit is cut by. Defaults to 0.5.
+            telemetry (Telemetry, optional): Telemetry to publish the limit and the observed
+                throughput to. Defaults to None.
+            name (str, optional): Name of the telemetry section, "<name>_concurrency".
+                Defaults to "local".
+            clock (callable, optional): Returns the time the latencies and the throughput are
+                measured with. Defaults to time.monotonic.
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.window = window
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.telemetry = telemetry
+        self.name = name
+        self.clock = clock
+
+        self.condition = threading.Condition()
+        self.limit = max(min_limit, min(initial_limit, max_limit))
+        self.in_flight = 0
+
+        # Observations of the current window.
+        self.window_start = self.clock()
+        self.window_latencies = []
+        self.window_tokens = 0
+        self.window_errors = 0
+        self.window_peak = 0
+
+        self.best_latency = None
+        self.last_throughput = None
+        self.throughput = 0.0
+        self.tokens_per_second = 0.0
+        self.latency = None
+        self.increases = 0
+        self.decreases = 0
+
+    def acquire(self):
+        """ Waits until a request may be sent. """
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            if self.in_flight == 0 and not self.window_latencies:
+                self.window_start = self.clock()
+            self.in_flight += 1
+            self.window_peak = max(self.window_peak, self.in_flight)
+
+    def release(self, seconds: float, error: bool = False, tokens: int = None):
+        """ Records a completed request and adjusts the limit after every window.
+
+        Args:
+            seconds (float): Latency of the request.
+            error (bool, optional): Whether the request failed. Defaults to False.
+            tokens (int, optional): Completion tokens of the request. The latency per token is
+                compared if they are known, so that long answers do not count as degradation.
+                Defaults to None.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if error:
+                self.window_errors += 1
+            else:
+                self.window_latencies.append(seconds / tokens if tokens else seconds)
+                self.window_tokens += tokens or 0
+
+            if len(self.window_latencies) + self.window_errors >= self.window:
+                self.adjust()
+            self.condition.notify_all()
+
+    def adjust(self):
+        """ Adjusts the limit from the observations of the window. Has to be called with the
+            lock held.
+        """
+        elapsed = max(self.clock() - self.window_start, 1e-6)
+        completed = len(self.window_latencies)
+        self.throughput = completed / elapsed
+        self.tokens_per_second = self.window_tokens / elapsed
+        self.latency = sorted(self.window_latencies)[completed // 2] if completed else None
+        if self.latency is not None and (self.best_latency is None or self.latency < self.best_latency):
+            self.best_latency = self.latency
+
+        if self.window_errors > 0 or (
+                self.latency is not None and self.latency > self.best_latency * self.latency_tolerance):
+            # Multiplicative decrease: errors or latency above the sweet spot.
+            new_limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+            if new_limit < self.limit:
+                self.decreases += 1
+            self.limit = new_limit
+            # At the lowest limit the latency is what the server does at best, e.g. after a
+            # larger model was loaded.
+            if self.limit == self.min_limit and self.latency is not None:
+                self.best_latency = self.latency
+        elif (self.window_peak >= self.limit and self.limit < self.max_limit
+              and (self.last_throughput is None or self.throughput >= self.last_throughput)):
+            # Additive increase: the limit was used and the throughput still rises.
+            self.limit += 1
+            self.increases += 1
+
+        self.last_throughput = self.throughput
+        self.window_start = self.clock()
+        self.window_latencies = []
+        self.window_tokens = 0
+        self.window_errors = 0
+        self.window_peak = self.in_flight
+
+        if self.telemetry is not None:
+            self.telemetry.set_section(f"{self.name}_concurrency", self.snapshot())
+
+    def snapshot(self) -> dict:
+        """ Returns the current limit and the throughput observed in the last window. """
+        with self.condition:
+            return {"limit": self.limit,
+                    "in_flight": self.in_flight,
+                    "requests_per_second": self.throughput,
+                    "tokens_per_second": self.tokens_per_second,
+                    "latency": self.latency,
+                    "best_latency": self.best_latency,
+                    "increases": self.increases,
+                    "decreases": self.decreases}
+
+    @contextmanager
+    def slot(self):
+        """ Holds a slot for the enclosed request and records its latency and errors.
+            The caller may set "tokens" in the yielded dictionary to the completion tokens.
+        """
+        self.acquire()
+        request = {"tokens": None}
+        start_time = self.clock()
+        try:
+            yield request
+        except Exception:
+            self.release(self.clock() - start_time, error=True)
+            raise
+        else:
+            self.release(self.clock() - start_time, tokens=request["tokens"])
@@ -0,0 +1,87 @@
+""" Convergence detection for refinement loops.
+Compares consecutive drafts and stops the loop once a rewrite barely changes the draft,
+instead of always spending the configured number of iterations.
+"""
+import re
+import difflib
+
+import numpy as np
+
+
+class ConvergenceDetector():
+    """ Measures the change between consecutive drafts and decides when refining has converged. """
+
+    def __init__(self,
+                 threshold: float = 0.05,
+                 embed_function=None,
+                 min_iterations: int = 1):
+        """ Set up the detector.
+
+        Args:
+            threshold (float, optional): Change between two drafts below which the refinement
+                counts as converged. 0 means identical, 1 means completely different.
+                Defaults to 0.05.
+            embed_function (callable, optional): Function embedding a list of texts. If set,
+                the change is measured by the cosine distance of the embeddings instead of the
+                token-level edit distance. Defaults to None.
+            min_iterations (int, optional): Number of iterations that always run.
+                Defaults to 1.
+        """
+        self.threshold = threshold
+        self.embed_function = embed_function
+        self.min_iterations = min_iterations
+        self.changes = []
+
+    def change(self, previous: str, current: str) -> float:
+        """ Measures the change between two drafts.
+
+        Args:
+            previous (str): The previous draft.
+            current (str): The current draft.
+
+        Returns:
+            float: Change between 0 (identical) and 1 (completely different).
+        """
+        if self.embed_function is not None:
+            vectors = np.asarray(self.embed_function([previous, current]), dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1)
+            if norms.min() == 0:
+                return 0.0 if previous == current else 1.0
+            similarity = float(vectors[0] @ vectors[1] / (norms[0] * norms[1]))
+            return max(0.0, 1.0 - similarity)
+
+        previous_tokens = re.findall(r"\w+|[^\w\s]", previous.lower())
+        current_tokens = re.findall(r"\w+|[^\w\s]", current.lower())
+        matcher = difflib.SequenceMatcher(None, previous_tokens, current_tokens, autojunk=False)
+        return 1.0 - matcher.ratio()
+
+    def converged(self, previous: str, current: str) -> bool:
+        """ Records the change of an iteration and checks whether refining has converged.
+
+        Args:
+            previous (str): The draft before the iteration.
+            current (str): The draft after the iteration.
+
+        Returns:
+            bool: True if the change is below the threshold and enough iterations ran.
+        """
+        change = self.change(previous, current)
+        self.changes.append(change)
+        print(f"Change to previous draft: {change:.1%}")
+        return len(self.changes) >= self.min_iterations and change < self.threshold
+
+    def format_report(self, max_iterations: int, iterations: int = None) -> str:
+        """ Formats how many iterations were run and saved.
+
+        Args:
+            max_iterations (int): Number of iterations configured for the loop.
+            iterations (int, optional): Number of iterations run, including those of a resumed
+                earlier run. Defaults to the iterations measured by this detector.
+
+        Returns:
+            str: The report.
+        """
+        if iterations is None:
+            iterations = len(self.changes)
+        return (f"Converged after {iterations}/{max_iterations} iterations, "
+                f"saved {max_iterations - iterations}")
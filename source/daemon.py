@@ -0,0 +1,362 @@
+""" Long-running writebook daemon.
+Books are submitted as jobs through a local HTTP API and run from a persistent queue by a fixed
+number of worker threads. The process stays up between jobs, so the tokenizer, the pooled HTTP
+client and the artifact stores stay warm, and jobs can be cancelled while they run.
+
+    POST   /jobs        {"book_path": "...", "options": {...}}  Submits a job.
+    GET    /jobs                                                Lists all jobs.
+    GET    /jobs/<id>                                           Job, status and progress of its book.
+    GET    /progress                                            Progress and ETA of the batch.
+    DELETE /jobs/<id>                                           Cancels a job.
+"""
+import os
+import json
+import time
+import uuid
+import inspect
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from source.artifactstore import open_artifact_store, write_file
+from source.progress import format_seconds
+from source.tokencounter import TokenCounter
+from source import transport
+from source import chain
+
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+BUDGET_EXHAUSTED = "budget_exhausted"
+
+
+class JobQueue():
+    """ Jobs in submission order, persisted to a JSON file after every change. Thread-safe. """
+
+    def __init__(self, queue_path: str):
+        """ Load the queue. Jobs that were running when the daemon stopped are queued again,
+            the books resume from their artifacts.
+
+        Args:
+            queue_path (str): JSON file to persist the queue in.
+        """
+        self.queue_path = queue_path
+        self.lock = threading.Condition()
+        self.jobs = {}
+
+        if os.path.exists(queue_path):
+            with open(queue_path, "r", encoding="utf-8") as f:
+                self.jobs = json.load(f)
+        for job in self.jobs.values():
+            if job["status"] == RUNNING:
+                job["status"] = QUEUED
+
+    def save(self):
+        """ Writes the queue. Has to be called with the lock held. """
+        write_file(self.queue_path, json.dumps(self.jobs, indent=4))
+
+    def submit(self, book_path: str, options: dict) -> dict:
+        """ Adds a job to the end of the queue.
+
+        Args:
+            book_path (str): Path to the book directory.
+            options (dict): Keyword arguments of writebook.
+
+        Raises:
+            ValueError: Raises ValueError if the book has a queued or running job already.
+
+        Returns:
+            dict: The job.
+        """
+        with self.lock:
+            book_path = os.path.abspath(book_path)
+            if any(job["book_path"] == book_path and job["status"] in (QUEUED, RUNNING)
+                   for job in self.jobs.values()):
+                raise ValueError(f"Book {book_path} has an active job already.")
+
+            job = {"id": uuid.uuid4().hex[:12],
+                   "book_path": book_path,
+                   "options": options,
+                   "status": QUEUED,
+                   "submitted": time.time(),
+                   "started": None,
+                   "finished": None,
+                   "error": None}
+            self.jobs[job["id"]] = job
+            self.save()
+            self.lock.notify_all()
+            return dict(job)
+
+    def take(self, stop_event: threading.Event):
+        """ Waits for the oldest queued job and marks it as running.
+
+        Args:
+            stop_event (threading.Event): Returns None once this is set.
+
+        Returns:
+            dict | None: The job, or None if the daemon stops.
+        """
+        with self.lock:
+            while not stop_event.is_set():
+                job = next((job for job in self.jobs.values() if job["status"] == QUEUED), None)
+                if job is not None:
+                    job["status"] = RUNNING
+                    job["started"] = time.time()
+                    self.save()
+                    return dict(job)
+                self.lock.wait(timeout=1.0)
+        return None
+
+    def update(self, job_id: str, **values):
+        """ Updates the values of a job. """
+        with self.lock:
+            self.jobs[job_id].update(values)
+            self.save()
+            self.lock.notify_all()
+
+    def get(self, job_id: str):
+        """ Returns a copy of a job, or None if it does not exist. """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def list(self) -> list:
+        """ Returns copies of all jobs in submission order. """
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+
+class BookDaemon():
+    """ Runs the jobs of the queue and serves the HTTP API. """
+
+    def __init__(self,
+                 run_job,
+                 queue_path: str,
+                 concurrency: int = 1,
+                 host: str = "127.0.0.1",
+                 port: int = 8765):
+        """ Set up the daemon.
+
+        Args:
+            run_job (callable): Writes a book. Called with the book path, the options of the job
+                and cancel_event, a threading.Event that is set when the job is cancelled.
+                Returns the outcome of the chain, e.g. chain.BUDGET_EXHAUSTED if the book
+                stopped early.
+            queue_path (str): JSON file to persist the queue in.
+            concurrency (int, optional): Number of books written at the same time. Defaults to 1.
+            host (str, optional): Host to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on. Defaults to 8765.
+        """
+        self.run_job = run_job
+        self.queue = JobQueue(queue_path)
+        self.concurrency = concurrency
+        self.stop_event = threading.Event()
+
+        self.cancel_events = {}
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), DaemonRequestHandler)
+        self.server.book_daemon = self
+        self.workers = []
+
+    def warm_up(self):
+        """ Loads the tokenizer and opens the HTTP pool once for all jobs. """
+        try:
+            TokenCounter().num_tokens_from_string("warm up", "gpt-3.5-turbo")
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Could not load the tokenizer: {e}")
+        transport.get_http_client()
+
+    def start(self):
+        """ Starts the worker threads. """
+        self.warm_up()
+        for worker_index in range(self.concurrency):
+            worker = threading.Thread(target=self.work, name=f"BookDaemonWorker{worker_index}",
+                                      daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def serve_forever(self):
+        """ Starts the workers and serves the API until the process is interrupted. Running jobs
+            are cancelled on shutdown and queued again for the next start.
+        """
+        self.start()
+        host, port = self.server.server_address[:2]
+        print(f"writebook daemon listening on http://{host}:{port} with {self.concurrency} workers")
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            print("Shutting down.")
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """ Stops the workers and the server. """
+        self.stop_event.set()
+        with self.lock:
+            for cancel_event in self.cancel_events.values():
+                cancel_event.set()
+        for worker in self.workers:
+            worker.join()
+        self.server.server_close()
+
+    def work(self):
+        """ Runs jobs of the queue until the daemon stops. """
+        while True:
+            job = self.queue.take(self.stop_event)
+            if job is None:
+                return
+
+            cancel_event = threading.Event()
+            with self.lock:
+                self.cancel_events[job["id"]] = cancel_event
+
+            print(f"Job {job['id']} started: {job['book_path']}")
+            status, error = DONE, None
+            try:
+                run_status = self.run_job(job["book_path"], cancel_event=cancel_event, **job["options"])
+                if run_status == chain.CANCELLED:
+                    status = CANCELLED
+                elif run_status == chain.BUDGET_EXHAUSTED:
+                    status = BUDGET_EXHAUSTED
+            except Exception as e:  # pylint: disable=broad-except
+                traceback.print_exc()
+                status, error = FAILED, f"{type(e).__name__}: {e}"
+
+            with self.lock:
+                del self.cancel_events[job["id"]]
+
+            # A job interrupted by the shutdown resumes on the next start.
+            if cancel_event.is_set():
+                status = QUEUED if self.stop_event.is_set() else CANCELLED
+
+            self.queue.update(job["id"], status=status, finished=time.time(), error=error)
+            print(f"Job {job['id']} {status}.")
+
+    def cancel(self, job_id: str):
+        """ Cancels a job. Queued jobs are cancelled right away, running jobs stop before their
+            next request.
+
+        Args:
+            job_id (str): Id of the job.
+
+        Returns:
+            dict | None: The job, or None if it does not exist.
+        """
+        job = self.queue.get(job_id)
+        if job is None:
+            return None
+
+        if job["status"] == QUEUED:
+            self.queue.update(job_id, status=CANCELLED, finished=time.time())
+        with self.lock:
+            if job_id in self.cancel_events:
+                self.cancel_events[job_id].set()
+        return self.queue.get(job_id)
+
+    def describe(self, job: dict) -> dict:
+        """ Returns a job with the current status and the live progress of its book. """
+        output_path = os.path.join(job["book_path"], "output")
+        store = open_artifact_store(output_path)
+        if store.exists("status.json"):
+            job["book_status"] = json.loads(store.read("status.json")).get("Current status")
+
+        progress_path = os.path.join(output_path, "live_progress.json")
+        if job["status"] == RUNNING and os.path.exists(progress_path):
+            with open(progress_path, "r", encoding="utf-8") as f:
+                job["progress"] = json.load(f)
+        return job
+
+    def batch_progress(self) -> dict:
+        """ Returns the progress of all jobs and the ETA of the batch. The running jobs finish
+            after their own ETAs, the queued jobs take as long as the finished jobs on average.
+        """
+        jobs = [self.describe(job) for job in self.queue.list()]
+        counts = {status: sum(1 for job in jobs if job["status"] == status)
+                  for status in (QUEUED, RUNNING, DONE, FAILED, CANCELLED, BUDGET_EXHAUSTED)}
+
+        running_etas = [job.get("progress", {}).get("eta_seconds") for job in jobs
+                        if job["status"] == RUNNING]
+        durations = [job["finished"] - job["started"] for job in jobs
+                     if job["status"] == DONE and job["started"] is not None]
+
+        eta_seconds = None
+        if None not in running_etas and (durations or counts[QUEUED] == 0):
+            average_seconds = sum(durations) / len(durations) if durations else 0.0
+            waves = -(-counts[QUEUED] // self.concurrency)
+            eta_seconds = max(running_etas, default=0.0) + waves * average_seconds
+
+        return {"jobs": counts,
+                "eta_seconds": eta_seconds,
+                "eta": format_seconds(eta_seconds),
+                "running": {job["id"]: job.get("progress") for job in jobs if job["status"] == RUNNING}}
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """ Serves the JSON API of the daemon. """
+
+    def send_json(self, status_code: int, value):
+        """ Sends a JSON response. """
+        body = json.dumps(value, indent=4).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def job_id(self):
+        """ Returns the job id of a /jobs/<id> path, or None. """
+        parts = self.path.strip("/").split("/")
+        return parts[1] if len(parts) == 2 and parts[0] == "jobs" else None
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        daemon = self.server.book_daemon
+        if self.path.rstrip("/") == "/jobs":
+            self.send_json(200, daemon.queue.list())
+            return
+        if self.path.rstrip("/") == "/progress":
+            self.send_json(200, daemon.batch_progress())
+            return
+
+        job = daemon.queue.get(self.job_id()) if self.job_id() else None
+        if job is None:
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+            return
+        self.send_json(200, daemon.describe(job))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        daemon = self.server.book_daemon
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            book_path = request["book_path"]
+            options = request.get("options", {})
+            if not os.path.exists(os.path.join(book_path, "description.txt")):
+                raise ValueError(f"{book_path} has no description.txt.")
+
+            # Reject unknown options now instead of failing the job later.
+            inspect.signature(daemon.run_job).bind(book_path, cancel_event=None, **options)
+
+            job = daemon.queue.submit(book_path, options)
+        except (KeyError, TypeError, ValueError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(201, job)
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        daemon = self.server.book_daemon
+        job = daemon.cancel(self.job_id()) if self.job_id() else None
+        if job is None:
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+            return
+        self.send_json(200, job)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        # Keep the output of the jobs readable.
+        pass
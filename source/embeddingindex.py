@@ -0,0 +1,240 @@
+""" Embedding index over the generated book content.
+Stores one embedding per paragraph of the summaries, outlines and chapters as a NumPy matrix
+next to the book output, so that prompts can pull in the few relevant passages instead of
+the whole history.
+"""
+import os
+import re
+import json
+import hashlib
+
+import numpy as np
+
+from source.artifactstore import write_file
+
+
+def text_hash(text: str) -> str:
+    """ Returns a stable hash of a text, used to deduplicate embedding calls.
+
+    Args:
+        text (str): Text to hash.
+
+    Returns:
+        str: Hex digest of the text.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def split_paragraphs(text: str) -> list:
+    """ Splits a text into its non-empty paragraphs.
+
+    Args:
+        text (str): Text to split.
+
+    Returns:
+        list: List of paragraphs.
+    """
+    paragraphs = re.split(r"\n\s*\n", text)
+    return [paragraph.strip() for paragraph in paragraphs if paragraph.strip() != ""]
+
+
+class HashingEmbedder():
+    """ Local embedding stand-in. Hashes the words of a text into a fixed size vector.
+        It needs no network access and is deterministic, which makes it usable for offline runs
+        and tests. Texts sharing many words get a high cosine similarity.
+    """
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def embed(self, texts: list[str]):
+        """ Embeds a list of texts.
+
+        Args:
+            texts (list[str]): Texts to embed.
+
+        Returns:
+            list: One vector (list of floats) per text.
+        """
+        embeddings = []
+        for text in texts:
+            vector = [0.0] * self.dimensions
+            for word in re.findall(r"\w+", text.lower()):
+                digest = hashlib.md5(word.encode("utf-8")).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+                sign = 1.0 if digest[4] % 2 == 0 else -1.0
+                vector[bucket] += sign
+            embeddings.append(vector)
+        return embeddings
+
+
+class EmbeddingIndex():
+    """ Embedding index of the generated book content with a top-k cosine search.
+        The matrix is kept L2-normalized, so the search is a single matrix-vector product.
+    """
+
+    MATRIX_FILE_NAME = "embeddings.npy"
+    METADATA_FILE_NAME = "embeddings.json"
+
+    def __init__(self, index_path: str, embed_function, batch_size: int = 64):
+        """ Set up the index and load it from disk if it exists.
+
+        Args:
+            index_path (str): Directory to store the index in.
+            embed_function (callable): Function mapping a list of texts to a list of vectors.
+            batch_size (int, optional): Maximum number of texts per embedding call. Defaults to 64.
+        """
+        self.matrix_path = os.path.join(index_path, self.MATRIX_FILE_NAME)
+        self.metadata_path = os.path.join(index_path, self.METADATA_FILE_NAME)
+        self.embed_function = embed_function
+        self.batch_size = batch_size
+
+        self.entries = []
+        self.rows_by_hash = {}
+        self.matrix = None
+        self.kinds = np.empty(0, dtype=object)
+        self.chapters = np.empty(0, dtype=np.int64)
+
+        # Added entries are written by save, once per step of the chain elements.
+        self.dirty = False
+        self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        """ Loads the index from disk, if it has been saved before. """
+        if not (os.path.exists(self.matrix_path) and os.path.exists(self.metadata_path)):
+            return
+
+        with open(self.metadata_path, "r", encoding="utf-8") as f:
+            self.entries = json.load(f)["entries"]
+        # Rows are only appended and the matrix is saved before the metadata, so after a crash
+        # between the two writes the matrix can only have extra rows.
+        self.matrix = np.load(self.matrix_path)[:len(self.entries)]
+        self.rows_by_hash = {entry["hash"]: row for row, entry in enumerate(self.entries)}
+        self.update_metadata_arrays()
+
+    def update_metadata_arrays(self):
+        """ Mirrors kind and chapter of the entries into arrays, so that searches can filter
+            without a loop over the entries. Entries without a chapter get chapter -1.
+        """
+        self.kinds = np.array([entry["kind"] for entry in self.entries], dtype=object)
+        self.chapters = np.array([-1 if entry["chapter"] is None else entry["chapter"]
+                                  for entry in self.entries], dtype=np.int64)
+
+    def save(self):
+        """ Writes the matrix and the metadata of the index to disk if entries were added.
+            Both files are written to a temporary file first and then renamed.
+        """
+        if self.matrix is None or not self.dirty:
+            return
+
+        temp_matrix_path = f"{self.matrix_path}.{os.getpid()}.tmp"
+        with open(temp_matrix_path, "wb") as f:
+            np.save(f, self.matrix)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_matrix_path, self.matrix_path)
+        write_file(self.metadata_path, json.dumps({"entries": self.entries}, indent=4))
+        self.dirty = False
+
+    def add(self, texts: list[str], kind: str, chapter: int = None) -> int:
+        """ Adds texts to the index. Texts that are already indexed are not embedded again.
+            The index is written to disk by save.
+
+        Args:
+            texts (list[str]): Texts to add.
+            kind (str): Kind of content, e.g. "summary", "outline" or "chapter".
+            chapter (int, optional): Index of the chapter the texts belong to. Defaults to None.
+
+        Returns:
+            int: Number of texts that were newly embedded.
+        """
+        new_texts = {}
+        for text in texts:
+            key = text_hash(text)
+            if key not in self.rows_by_hash and key not in new_texts:
+                new_texts[key] = text
+
+        if not new_texts:
+            return 0
+
+        keys = list(new_texts.keys())
+        vectors = []
+        for start in range(0, len(keys), self.batch_size):
+            batch = [new_texts[key] for key in keys[start:start + self.batch_size]]
+            vectors += self.embed_function(batch)
+
+        vectors = self.normalize(np.asarray(vectors, dtype=np.float32))
+        self.matrix = vectors if self.matrix is None else np.vstack([self.matrix, vectors])
+
+        for key in keys:
+            self.rows_by_hash[key] = len(self.entries)
+            self.entries.append({"hash": key,
+                                 "kind": kind,
+                                 "chapter": chapter,
+                                 "text": new_texts[key]})
+        self.update_metadata_arrays()
+
+        self.dirty = True
+        return len(keys)
+
+    def add_document(self, text: str, kind: str, chapter: int = None) -> int:
+        """ Splits a document into paragraphs and adds them to the index.
+
+        Args:
+            text (str): Document to add.
+            kind (str): Kind of content, e.g. "summary", "outline" or "chapter".
+            chapter (int, optional): Index of the chapter the document belongs to. Defaults to None.
+
+        Returns:
+            int: Number of paragraphs that were newly embedded.
+        """
+        return self.add(split_paragraphs(text), kind=kind, chapter=chapter)
+
+    def search(self, query: str, k: int = 4, kinds: list = None, before_chapter: int = None):
+        """ Returns the k indexed passages that are most similar to the query.
+
+        Args:
+            query (str): Query text.
+            k (int, optional): Number of passages to return. Defaults to 4.
+            kinds (list, optional): Only consider these kinds of content. Defaults to None.
+            before_chapter (int, optional): Only consider chapters before this one. Defaults to None.
+
+        Returns:
+            list: Entries as dictionaries with an additional "score", best match first.
+        """
+        if self.matrix is None or k <= 0:
+            return []
+
+        mask = np.ones(len(self.entries), dtype=bool)
+        if kinds is not None:
+            mask &= np.isin(self.kinds, list(kinds))
+        if before_chapter is not None:
+            mask &= (self.chapters >= 0) & (self.chapters < before_chapter)
+
+        candidates = np.flatnonzero(mask)
+        if len(candidates) == 0:
+            return []
+
+        query_row = self.rows_by_hash.get(text_hash(query))
+        if query_row is not None:
+            query_vector = self.matrix[query_row]
+        else:
+            query_vector = self.normalize(
+                np.asarray(self.embed_function([query]), dtype=np.float32))[0]
+
+        scores = self.matrix[candidates] @ query_vector
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [dict(self.entries[candidates[i]], score=float(scores[i])) for i in top]
+
+    @staticmethod
+    def normalize(vectors):
+        """ L2-normalizes the rows of a matrix. Zero rows are left untouched. """
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
@@ -0,0 +1,184 @@
+""" Hedged requests to cut the tail latency of chat calls.
+If a request takes longer than a percentile of the recent latencies, a duplicate is sent and
+the first response wins. A budget caps the share of duplicated requests and the tokens that
+the discarded responses cost.
+"""
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from source.telemetry import percentile
+
+
+class LatencyTracker():
+    """ Keeps a window of recent latencies per key, e.g. per model. """
+
+    def __init__(self,
+                 hedge_percentile: float = 95,
+                 window: int = 200,
+                 min_samples: int = 20,
+                 min_delay: float = 1.0):
+        """ Set up the tracker.
+
+        Args:
+            hedge_percentile (float, optional): Percentile of the recent latencies after which a
+                request is hedged. Defaults to 95.
+            window (int, optional): Number of recent latencies per key. Defaults to 200.
+            min_samples (int, optional): Number of latencies needed before hedging starts.
+                Defaults to 20.
+            min_delay (float, optional): Minimum delay in seconds before a request is hedged.
+                Defaults to 1.0.
+        """
+        self.hedge_percentile = hedge_percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, key: str, seconds: float):
+        """ Records the latency of a request. """
+        with self.lock:
+            self.samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def threshold(self, key: str):
+        """ Returns the delay after which a request is hedged, or None without enough history. """
+        with self.lock:
+            samples = list(self.samples.get(key, []))
+        if len(samples) < self.min_samples:
+            return None
+        return max(self.min_delay, percentile(samples, self.hedge_percentile))
+
+
+class RequestHedger():
+    """ Sends a duplicate of slow requests and returns the first response. """
+
+    def __init__(self,
+                 tracker: LatencyTracker = None,
+                 max_hedge_ratio: float = 0.1,
+                 max_extra_tokens: int = None,
+                 max_workers: int = 32,
+                 telemetry=None,
+                 name: str = "openai.chat",
+                 clock=time.monotonic):
+        """ Set up the hedger.
+
+        Args:
+            tracker (LatencyTracker, optional): Tracker of the recent latencies.
+                Defaults to a new LatencyTracker.
+            max_hedge_ratio (float, optional): Maximum share of requests that are duplicated.
+                Defaults to 0.1.
+            max_extra_tokens (int, optional): Maximum number of tokens spent on discarded
+                responses. Defaults to None (unlimited).
+            max_workers (int, optional): Maximum number of requests in flight. Defaults to 32.
+            telemetry (Telemetry, optional): Telemetry to record latencies and counters in.
+                Defaults to None.
+            name (str, optional): Name of the requests in the telemetry. Defaults to "openai.chat".
+            clock (callable, optional): Returns the time the latencies are measured with.
+                Defaults to time.monotonic.
+        """
+        self.tracker = tracker if tracker is not None else LatencyTracker()
+        self.max_hedge_ratio = max_hedge_ratio
+        self.max_extra_tokens = max_extra_tokens
+        self.telemetry = telemetry
+        self.name = name
+        self.clock = clock
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.extra_tokens = 0
+
+    def can_hedge(self) -> bool:
+        """ Returns whether the budget allows another duplicate request. """
+        with self.lock:
+            if self.hedges + 1 > self.max_hedge_ratio * self.requests:
+                return False
+            return self.max_extra_tokens is None or self.extra_tokens < self.max_extra_tokens
+
+    def charge_extra_tokens(self, tokens: int):
+        """ Charges the tokens of a discarded response to the hedging budget. """
+        with self.lock:
+            self.extra_tokens += tokens
+        if self.telemetry is not None:
+            self.telemetry.increment(f"{self.name}.hedge_extra_tokens", tokens)
+
+    def run(self, key: str, primary, secondary=None, on_discarded=None):
+        """ Sends a request and hedges it if it is slow.
+
+        Args:
+            key (str): Key of the latency history, e.g. the model.
+            primary (callable): Sends the request.
+            secondary (callable, optional): Sends the duplicate, e.g. to a secondary backend.
+                Defaults to the primary.
+            on_discarded (callable, optional): Called with the response that lost the race,
+                e.g. to record its usage. Defaults to None.
+
+        Returns:
+            Any: The first successful response.
+        """
+        with self.lock:
+            self.requests += 1
+        start_time = self.clock()
+
+        def record_primary(future):
+            if future.exception() is None:
+                latency = self.clock() - start_time
+                self.tracker.record(key, latency)
+                if self.telemetry is not None:
+                    self.telemetry.record_latency(f"{self.name}.unhedged", latency)
+
+        primary_future = self.executor.submit(primary)
+        primary_future.add_done_callback(record_primary)
+
+        futures = [primary_future]
+        threshold = self.tracker.threshold(key)
+        done, _ = wait(futures, timeout=threshold)
+        if not done and self.can_hedge():
+            with self.lock:
+                self.hedges += 1
+            if self.telemetry is not None:
+                self.telemetry.increment(f"{self.name}.hedged")
+            futures.append(self.executor.submit(secondary or primary))
+
+        # Take the first successful response.
+        winner = None
+        pending = set(futures)
+        while winner is None and pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((future for future in done if future.exception() is None), None)
+        if winner is None:
+            primary_future.result()
+
+        if winner is not primary_future:
+            with self.lock:
+                self.hedge_wins += 1
+            if self.telemetry is not None:
+                self.telemetry.increment(f"{self.name}.hedge_wins")
+
+        # Cancel the losers. Requests that are already sent cannot be aborted, their
+        # responses are discarded.
+        for future in futures:
+            if future is winner or future.cancel():
+                continue
+            if on_discarded is not None:
+                future.add_done_callback(
+                    lambda future: on_discarded(future.result()) if future.exception() is None else None)
+
+        if self.telemetry is not None:
+            self.telemetry.record_latency(self.name, self.clock() - start_time)
+
+        return winner.result()
+
+    def format_report(self) -> str:
+        """ Formats the number of hedged requests and the effect on the p99 latency. """
+        report = (f"Hedged {self.hedges} of {self.requests} requests, "
+                  f"{self.hedge_wins} duplicates won, {self.extra_tokens} extra tokens")
+        if self.telemetry is not None:
+            hedged = self.telemetry.latency_summary(self.name)
+            unhedged = self.telemetry.latency_summary(f"{self.name}.unhedged")
+            report += f", p99 {unhedged['p99']:.2f} s without hedging, {hedged['p99']:.2f} s with hedging"
+        return report
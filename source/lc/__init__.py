@@ -1,2 +1,3 @@
 from .lccontrol import LCControl
 from .lc_chainstep import LCChainStep
+from .lc_stepgraph import LCStepGraph
@@ -1,12 +1,16 @@
 """ Module for the chain element of the book project using LangChain."""
 from source.lc.lcbasebookchainelement import LCBaseBookChainElement
+from source.convergence import ConvergenceDetector
 
 
 class LCChainStep(LCBaseBookChainElement):
     """ The single chain element that gets initialized with a step name
         and added to the chain executor. Executes a single step of the book project.
         One step entails a step for creation ("head"), and a loop of refing steps, aka
-        "review" and "rewrite". The loop is executed a number of times ("iterations").
+        "review" and "rewrite". The loop is executed a number of times ("iterations"),
+        or until a rewrite changes the draft less than the "convergence_threshold".
+        The template ids of all phases are read from steps.json. The results of the steps
+        the step depends on are available as placeholders under their output keys.
 
     Args:
         LCBaseBookChainElement (class): Inherits from the LCBaseBookChainElement class.
@@ -14,11 +18,8 @@ class LCChainStep(LCBaseBookChainElement):
 
     def __init__(self, step_name):
         #super().__init__()
-         
+
         self.step_name = step_name
-        
-               
-        
 
         self.done = False
 
@@ -27,67 +28,131 @@ class LCChainStep(LCBaseBookChainElement):
 
     def step(self, llm_connection, project_control):  # pylint: disable=arguments-renamed
         dict_step_commands = project_control.get_step_commands(self.step_name)
-        
+        output_key = dict_step_commands.get("output_key")
+
+        # Results are memoized: a completed step is not run again.
+        step_progress = project_control.load_step_progress(self.step_name)
+        if step_progress is not None and step_progress["done"]:
+            print(f"{self.step_name}: Already completed")
+            self.done = True
+            return
+
+        # Charge the requests of this step to it, even if other steps run concurrently.
+        project_control.usage_ledger.set_step(self.step_name, thread_local=True)
+
         prompt_placeholders = {}
         prompt_placeholders["book_description"] = project_control.get_book_description()
+        prompt_placeholders.update(
+            project_control.get_step_outputs(dict_step_commands.get("depends_on", [])))
         progress_keys = dict_step_commands["progress_keys"]
 
-        # For testing purposes only
-        head_sys_message = "lc_write_plot_system_message"
-        review_sys_message = "lc_write_plot_system_message"
-        rewrite_sys_message = "lc_write_plot_system_message"
-
-        head_message = "lc_write_plot_prompt"
-        review_message = "lc_review_plot"
-        rewrite_message = "lc_rewrite_plot"
-        # End of testing purposes
-
         project_control.set_current_status(self.step_name, "Started")
 
         if ("load_history" in dict_step_commands):
             prompt_placeholders.update(project_control.load_current_progress())
 
-        if ("head" in dict_step_commands):
+        # Resume an interrupted step after its last completed sub-step.
+        completed_substeps = []
+        if step_progress is not None:
+            completed_substeps = step_progress.get("completed_substeps", [])
+            prompt_placeholders.update(step_progress["progress"])
+            if completed_substeps:
+                print(f"{self.step_name}: Resuming after {completed_substeps[-1]}")
+
+        def checkpoint(substep):
+            """ Saves the placeholders after every sub-step. """
+            completed_substeps.append(substep)
+            progress = {key: prompt_placeholders[key]
+                        for key in progress_keys if key in prompt_placeholders}
+            project_control.save_step_progress(self.step_name, progress,
+                                               completed_substeps=completed_substeps)
+
+        if ("head" in dict_step_commands and "head" not in completed_substeps):
             print(f"Started {self.step_name}")
+            head_commands = dict_step_commands["head"]
 
-            system_message = project_control.get_prompt_template(head_sys_message)
-            message = project_control.get_prompt_template(
-                                head_message).format(**prompt_placeholders)
-
-            prompt_placeholders[progress_keys[0]] = (
-                                llm_connection.query_local_cm(system_message=system_message,
-                                                        message=message)
-                                )
+            prompt_placeholders[progress_keys[0]] = self.query(
+                llm_connection, project_control,
+                head_commands["head_sys_message"], head_commands["head_message"],
+                prompt_placeholders)
+            checkpoint("head")
 
         if ("refining" in dict_step_commands):
-            
-            iterations = dict_step_commands["refining"]["iterations"]
-            for i in range(1, iterations + 1):
-                print(f"{self.step_name}: Refining {i}/{iterations}")
-
-                system_message = project_control.get_prompt_template(review_sys_message)
-                message = project_control.get_prompt_template(
-                                review_message).format(**prompt_placeholders)
+            refining_commands = dict_step_commands["refining"]
 
-                prompt_placeholders[progress_keys[1]] = (
-                                llm_connection.query_local_cm(system_message=system_message,
-                                                        message=message)
-                                )
+            iterations = refining_commands["iterations"]
+            convergence_detector = None
+            if "convergence_threshold" in refining_commands:
+                convergence_detector = ConvergenceDetector(
+                    threshold=refining_commands["convergence_threshold"])
 
-                system_message = project_control.get_prompt_template(rewrite_sys_message)
-                message = project_control.get_prompt_template(
-                                rewrite_message).format(**prompt_placeholders)
+            for i in range(1, iterations + 1):
+                if "converged" in completed_substeps:
+                    break
+                if f"rewrite_{i}" in completed_substeps:
+                    continue
+                print(f"{self.step_name}: Refining {i}/{iterations}")
 
-                prompt_placeholders[progress_keys[2]] = (
-                                llm_connection.query_local_cm(system_message=system_message,
-                                                        message=message)
-                                )
+                if f"review_{i}" not in completed_substeps:
+                    prompt_placeholders[progress_keys[1]] = self.query(
+                        llm_connection, project_control,
+                        refining_commands["review_sys_message"], refining_commands["review_message"],
+                        prompt_placeholders)
+                    checkpoint(f"review_{i}")
+
+                prompt_placeholders[progress_keys[2]] = self.query(
+                    llm_connection, project_control,
+                    refining_commands["rewrite_sys_message"], refining_commands["rewrite_message"],
+                    prompt_placeholders)
+
+                # The rewrite is the draft that the next iteration reviews.
+                previous_draft = prompt_placeholders[progress_keys[0]]
+                prompt_placeholders[progress_keys[0]] = prompt_placeholders[progress_keys[2]]
+                checkpoint(f"rewrite_{i}")
+
+                if (convergence_detector is not None
+                        and convergence_detector.converged(previous_draft,
+                                                           prompt_placeholders[progress_keys[0]])):
+                    report = convergence_detector.format_report(iterations, i)
+                    print(f"{self.step_name}: {report}")
+                    project_control.set_current_status(self.step_name, report)
+                    checkpoint("converged")
+                    break
 
         progress = {key: prompt_placeholders[key]
                     for key in progress_keys if key in prompt_placeholders}
-        project_control.save_current_progress(progress)
+        if output_key is not None:
+            progress[output_key] = prompt_placeholders[progress_keys[0]]
+        project_control.save_step_progress(self.step_name, progress, done=True,
+                                           completed_substeps=completed_substeps)
 
         project_control.set_current_status(self.step_name, "Completed")
 
         print(f"{self.step_name}: Completed")
         self.done = True
+
+    def query(self, llm_connection, project_control, system_template: str,
+              message_template: str, prompt_placeholders: dict) -> str:
+        """ Fills the templates of a sub-step and queries the local chat model.
+
+        Args:
+            llm_connection (LCControl): Connection to the LLMs.
+            project_control (Project): The project.
+            system_template (str): Template id of the system message.
+            message_template (str): Template id of the message.
+            prompt_placeholders (dict): Placeholders for the templates.
+
+        Raises:
+            ValueError: Raises ValueError if the model returned no answer.
+
+        Returns:
+            str: The answer of the model.
+        """
+        system_message = project_control.get_prompt_template(system_template)
+        message = project_control.get_prompt_template(message_template).format(**prompt_placeholders)
+
+        reply = llm_connection.query_local_cm(system_message=system_message, message=message)
+        if reply is None:
+            # Never store a missing answer as a placeholder of later sub-steps.
+            raise ValueError(f"{self.step_name}: No answer for {message_template}")
+        return reply
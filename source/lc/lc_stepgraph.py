@@ -0,0 +1,115 @@
+""" Module for the step graph of the book project using LangChain.
+The steps in steps.json form a graph through their "depends_on" lists. Steps whose
+dependencies are completed run concurrently, e.g. characters and setting once the plot exists.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from source.lc.lcbasebookchainelement import LCBaseBookChainElement
+from source.lc.lc_chainstep import LCChainStep
+
+
+class LCStepGraph(LCBaseBookChainElement):
+    """ Chain element that executes the steps of steps.json in the order of their dependencies.
+
+    Args:
+        LCBaseBookChainElement (class): Inherits from the LCBaseBookChainElement class.
+    """
+
+    def __init__(self, step_names: list = None, max_workers: int = 2):
+        """ Set up the step graph.
+
+        Args:
+            step_names (list, optional): Steps to execute. Their dependencies are added
+                automatically. Defaults to None, which executes all steps in steps.json.
+            max_workers (int, optional): Maximum number of steps that run concurrently.
+                Defaults to 2.
+        """
+        #super().__init__()
+
+        self.step_name = "Step Graph"
+        self.step_names = step_names
+        self.max_workers = max_workers
+
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    def build_graph(self, project_control) -> dict:
+        """ Collects the steps to execute and their dependencies and validates the graph.
+
+        Args:
+            project_control (Project): The project with the step commands.
+
+        Raises:
+            ValueError: Raises ValueError if a step depends on an unknown step or if the
+                dependencies contain a cycle.
+
+        Returns:
+            Dictionary: Dependencies by step name.
+        """
+        all_steps = project_control.step_commands_dict
+        pending = list(self.step_names) if self.step_names is not None else list(all_steps)
+
+        graph = {}
+        while pending:
+            step_name = pending.pop()
+            if step_name in graph:
+                continue
+            if step_name not in all_steps:
+                raise ValueError(f"Unknown step in step graph: {step_name}")
+
+            graph[step_name] = list(all_steps[step_name].get("depends_on", []))
+            pending.extend(graph[step_name])
+
+        # Kahn's algorithm: every step must become ready eventually, otherwise there is a cycle.
+        remaining = {step_name: set(dependencies) for step_name, dependencies in graph.items()}
+        while remaining:
+            ready = [step_name for step_name, dependencies in remaining.items() if not dependencies]
+            if not ready:
+                raise ValueError(f"Cycle in step graph between: {', '.join(sorted(remaining))}")
+            for step_name in ready:
+                del remaining[step_name]
+            for dependencies in remaining.values():
+                dependencies.difference_update(ready)
+
+        return graph
+
+    def step(self, llm_connection, project_control):  # pylint: disable=arguments-renamed
+        graph = self.build_graph(project_control)
+        self.set_progress_total(len(graph))
+
+        completed = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(completed) < len(graph):
+                for step_name, dependencies in graph.items():
+                    if (step_name in completed or step_name in running.values()
+                            or not set(dependencies) <= completed):
+                        continue
+
+                    chain_step = LCChainStep(step_name)
+                    future = executor.submit(self.run_step, chain_step,
+                                             llm_connection, project_control)
+                    running[future] = step_name
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    # Reraises the exceptions of the step, e.g. BudgetExceeded.
+                    future.result()
+                    step_name = running.pop(future)
+                    completed.add(step_name)
+                    self.advance_progress(current=step_name)
+
+        self.done = True
+
+    def run_step(self, chain_step: LCChainStep, llm_connection, project_control):
+        """ Executes a single step until it is done. Runs in a worker thread.
+
+        Args:
+            chain_step (LCChainStep): The step to execute.
+            llm_connection (LCControl): Connection to the LLMs.
+            project_control (Project): The project.
+        """
+        while not chain_step.is_done():
+            chain_step.step(llm_connection=llm_connection, project_control=project_control)
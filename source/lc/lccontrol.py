@@ -1,9 +1,44 @@
 """ Module that manages the connections and queries to the LLMs."""
+from contextlib import nullcontext
+
+from retry import retry
 from langchain_community.llms import Ollama
 from langchain_community.chat_models import ChatOllama
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.callbacks import BaseCallbackHandler
+
+from source.budget import BudgetExceeded
+from source.cassette import cassette_call
+from source.singleflight import SINGLE_FLIGHT
+from source.transport import get_http_client
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """ Collects the token usage from the generation metadata of a LangChain model call.
+        ChatOpenAI reports it in llm_output["token_usage"], Ollama in the generation info
+        as "prompt_eval_count" and "eval_count".
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.prompt_tokens = None
+        self.completion_tokens = None
+
+    def on_llm_end(self, response, **kwargs):
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        if "prompt_tokens" in token_usage:
+            self.prompt_tokens = token_usage["prompt_tokens"]
+            self.completion_tokens = token_usage.get("completion_tokens", 0)
+            return
+
+        for generations in response.generations:
+            for generation in generations:
+                generation_info = generation.generation_info or {}
+                if "eval_count" in generation_info:
+                    self.prompt_tokens = generation_info.get("prompt_eval_count", 0)
+                    self.completion_tokens = generation_info["eval_count"]
 
 
 class LCControl():
@@ -13,13 +48,16 @@ class LCControl():
                  project_control,
                  gpt_model: str,
                  ollama_cm_model: str,
-                 ollama_llm_model: str):
+                 ollama_llm_model: str,
+                 concurrency_limiter=None):
         """ Set up the project and all required objects.
 
         Args:
             gpt_model (str): Version of OpenAI's ChatGPT to use in project.
             ollama_cm_model (str): Local Chat Model that is run in Ollama to use in project. 
             ollama_llm_model (str): Local LLM that is run in Ollama to use in project.
+            concurrency_limiter (AdaptiveConcurrencyLimiter, optional): Limits the queries to
+                the local models in flight. Defaults to None.
 
         Raises:
             ValueError: Raises ValueError if OPENAI_API_KEY environment variable is not set.
@@ -27,9 +65,15 @@ class LCControl():
         """
         self.project_control = project_control
 
+        # Identical queries in flight at the same time are sent only once.
+        self.single_flight = SINGLE_FLIGHT
+
+        # Queries to the local models wait for a slot of the Ollama server.
+        self.concurrency_limiter = concurrency_limiter
         
         if gpt_model:
-            self.gpt = ChatOpenAI(openai_api_key=self.project_control.api_key, model=gpt_model)
+            self.gpt = ChatOpenAI(openai_api_key=self.project_control.api_key, model=gpt_model,
+                                  http_client=get_http_client())
 
         if ollama_cm_model:
             self.local_cm = ChatOllama(model=ollama_cm_model)
@@ -93,16 +137,49 @@ class LCControl():
         parser = StrOutputParser()
         chain = prompt | model | parser
 
+        self.project_control.check_cancelled()
+
+        budget = self.project_control.budget
+        if budget is not None and budget.usage_ratio() >= 1.0:
+            raise BudgetExceeded(f"Budget used up. Spent so far: {budget.spent_tokens} tokens, "
+                                 f"${budget.spent_cost:.2f}.")
+
         if self.project_control.verbose:
             print('----------QUERY-----------')
             print(print(prompt))
             print('----------END QUERY-----------')
 
-        try:
-            reply = chain.invoke({})
-        except ConnectionError as e:
-            print(f"Could not connect to Local LLM with error {e}")
-            return None
+        usage_handler = UsageCallbackHandler()
+
+        def send_query():
+            reply = self.invoke(chain, usage_handler, self.get_concurrency_limiter(model))
+            return {"reply": reply,
+                    "prompt_tokens": usage_handler.prompt_tokens,
+                    "completion_tokens": usage_handler.completion_tokens}
+
+        request = {"model": self.get_model_name(model),
+                   "system_message": system_message,
+                   "message": message}
+
+        def send_recorded_query():
+            return cassette_call(self.project_control.cassette, "langchain", "query", request,
+                                 send_query)
+
+        if self.single_flight is not None:
+            key = self.single_flight.request_key("langchain.query", request)
+            result, shared = self.single_flight.do(key, send_recorded_query)
+        else:
+            result, shared = send_recorded_query(), False
+
+        reply = result["reply"]
+        usage_handler.prompt_tokens = result["prompt_tokens"]
+        usage_handler.completion_tokens = result["completion_tokens"]
+
+        # A shared reply was paid for by the caller that sent the query.
+        if shared:
+            self.project_control.telemetry.increment("langchain.query.coalesced")
+        else:
+            self.record_usage(model, usage_handler, system_message + message, reply)
 
         if self.project_control.verbose:
             print('----------ANSWER-----------')
@@ -111,6 +188,32 @@ class LCControl():
 
         return reply
 
+    @retry(OSError, tries=6, delay=10, max_delay=120, backoff=2)
+    def invoke(self, chain, usage_handler, concurrency_limiter=None):
+        """ Invokes a chain. Connection errors, e.g. while the Ollama server is restarting or busy,
+            pause and retry the query instead of losing it. requests' ConnectionError and Timeout
+            are OSErrors. The slot of the concurrency limiter is only held while the query is
+            sent, not during the pauses.
+
+        Args:
+            chain (Runnable): The chain of prompt, model and parser.
+            usage_handler (UsageCallbackHandler): Handler that collects the reported usage.
+            concurrency_limiter (AdaptiveConcurrencyLimiter, optional): Limiter of the model.
+                Defaults to None.
+
+        Returns:
+            str: The reply of the model.
+        """
+        slot = concurrency_limiter.slot() if concurrency_limiter is not None else nullcontext({})
+        try:
+            with slot as request:
+                reply = chain.invoke({}, config={"callbacks": [usage_handler]})
+                request["tokens"] = usage_handler.completion_tokens
+                return reply
+        except OSError as e:
+            print(f"Could not connect to LLM with error {e}. Retrying.")
+            raise
+
     def print_messages(self, messages):
         for message in messages:
             print("\033[92m", end="")
@@ -120,7 +223,39 @@ class LCControl():
             print("")
             print("\033[0m", end="")
 
+    def record_usage(self, model, usage_handler, prompt: str, reply: str):
+        """ Records the usage of a query in the project. Falls back to an estimate with the
+            TokenCounter if the model did not report its usage.
+
+        Args:
+            model (BaseLanguageModel): The model that answered the query.
+            usage_handler (UsageCallbackHandler): Handler that collected the reported usage.
+            prompt (str): Text of the prompt.
+            reply (str): Text of the reply.
+        """
+        model_name = self.get_model_name(model)
+
+        if usage_handler.prompt_tokens is not None:
+            self.project_control.record_usage(model_name, usage_handler.prompt_tokens,
+                                              usage_handler.completion_tokens, backend="langchain")
+        else:
+            self.project_control.record_usage(model_name,
+                                              self.project_control.estimate_tokens(prompt),
+                                              self.project_control.estimate_tokens(reply),
+                                              backend="langchain", estimated=True)
+
+    def get_concurrency_limiter(self, model):
+        """ Returns the concurrency limiter of a model. Only the local models share the limit
+            of the Ollama server.
+        """
+        if model is getattr(self, "gpt", None):
+            return None
+        return self.concurrency_limiter
+
+    def get_model_name(self, model) -> str:
+        """ Returns the name of a LangChain model. """
+        return getattr(model, "model_name", None) or getattr(model, "model", "unknown")
+
     def get_token_count(self):
         """ Returns the total number of tokens used in all steps. """
-        # TODO: Implement token count for assistants
-        return 0
+        return self.project_control.usage_ledger.total_tokens()
@@ -0,0 +1,182 @@
+""" MinHash index with locality-sensitive hashing to find near-duplicate paragraphs.
+Each paragraph is reduced to a signature of minimum hash values over its word shingles.
+The signatures are split into bands, paragraphs sharing a band are candidates, and candidates
+are confirmed by the estimated Jaccard similarity of their signatures.
+"""
+import os
+import re
+import json
+import random
+import hashlib
+
+from source.artifactstore import write_file
+
+
+class MinHashIndex():
+    """ Incremental MinHash/LSH index of paragraphs, optionally persisted to a JSON file. """
+
+    MERSENNE_PRIME = (1 << 61) - 1
+    MAX_HASH = (1 << 32) - 1
+
+    def __init__(self,
+                 index_path: str = None,
+                 num_permutations: int = 64,
+                 bands: int = 16,
+                 shingle_size: int = 5,
+                 threshold: float = 0.5,
+                 seed: int = 1):
+        """ Set up the index and load it from disk if it exists.
+
+        Args:
+            index_path (str, optional): JSON file to persist the index in. Defaults to None.
+            num_permutations (int, optional): Length of the signatures. Defaults to 64.
+            bands (int, optional): Number of LSH bands. Must divide num_permutations. Defaults to 16.
+            shingle_size (int, optional): Number of words per shingle. Defaults to 5.
+            threshold (float, optional): Similarity above which paragraphs count as duplicates.
+                Defaults to 0.5.
+            seed (int, optional): Seed for the hash permutations. Defaults to 1.
+
+        Raises:
+            ValueError: Raises ValueError if bands does not divide num_permutations.
+        """
+        if num_permutations % bands != 0:
+            raise ValueError(f"bands ({bands}) must divide num_permutations ({num_permutations}).")
+
+        self.index_path = index_path
+        self.num_permutations = num_permutations
+        self.bands = bands
+        self.rows = num_permutations // bands
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        self.seed = seed
+
+        generator = random.Random(seed)
+        self.permutations = [(generator.randint(1, self.MERSENNE_PRIME - 1),
+                              generator.randint(0, self.MERSENNE_PRIME - 1))
+                             for _ in range(num_permutations)]
+
+        self.signatures = {}
+        self.buckets = {}
+        self.load()
+
+    def __contains__(self, key):
+        return key in self.signatures
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def shingles(self, text: str) -> set:
+        """ Returns the hashed word shingles of a text. """
+        words = re.findall(r"\w+", text.lower())
+        if len(words) < self.shingle_size:
+            words_groups = [words] if words else []
+        else:
+            words_groups = [words[i:i + self.shingle_size]
+                            for i in range(len(words) - self.shingle_size + 1)]
+
+        shingles = set()
+        for group in words_groups:
+            digest = hashlib.blake2b(" ".join(group).encode("utf-8"), digest_size=8).digest()
+            shingles.add(int.from_bytes(digest, "little") & self.MAX_HASH)
+        return shingles
+
+    def signature(self, text: str) -> list:
+        """ Returns the MinHash signature of a text. """
+        shingles = self.shingles(text)
+        if not shingles:
+            return [self.MAX_HASH] * self.num_permutations
+
+        return [min(((a * shingle + b) % self.MERSENNE_PRIME) & self.MAX_HASH for shingle in shingles)
+                for a, b in self.permutations]
+
+    def band_keys(self, signature: list) -> list:
+        """ Returns the LSH bucket keys of a signature, one per band. """
+        return [f"{band}:" + ",".join(str(value) for value in
+                                      signature[band * self.rows:(band + 1) * self.rows])
+                for band in range(self.bands)]
+
+    def similarity(self, signature_a: list, signature_b: list) -> float:
+        """ Estimates the Jaccard similarity of two texts from their signatures. """
+        equal = sum(1 for a, b in zip(signature_a, signature_b) if a == b)
+        return equal / self.num_permutations
+
+    def add(self, key: str, text: str, save: bool = True):
+        """ Adds a paragraph to the index.
+
+        Args:
+            key (str): Unique key of the paragraph, e.g. "c3p12".
+            text (str): The paragraph.
+            save (bool, optional): Whether to persist the index afterwards. Defaults to True.
+        """
+        self.insert(key, self.signature(text))
+        if save:
+            self.save()
+
+    def insert(self, key: str, signature: list):
+        """ Inserts a precomputed signature into the signatures and the buckets. """
+        if key in self.signatures:
+            for band_key in self.band_keys(self.signatures[key]):
+                self.buckets[band_key].discard(key)
+
+        self.signatures[key] = signature
+        for band_key in self.band_keys(signature):
+            self.buckets.setdefault(band_key, set()).add(key)
+
+    def remove_prefix(self, prefix: str):
+        """ Removes all paragraphs whose key starts with the prefix, e.g. all paragraphs of a chapter. """
+        for key in [key for key in self.signatures if key.startswith(prefix)]:
+            for band_key in self.band_keys(self.signatures[key]):
+                self.buckets[band_key].discard(key)
+            del self.signatures[key]
+        self.save()
+
+    def query(self, text: str) -> list:
+        """ Finds indexed paragraphs that are near-duplicates of the text.
+
+        Args:
+            text (str): Paragraph to check.
+
+        Returns:
+            list: Tuples of key and estimated similarity, most similar first.
+        """
+        signature = self.signature(text)
+
+        candidates = set()
+        for band_key in self.band_keys(signature):
+            candidates |= self.buckets.get(band_key, set())
+
+        matches = []
+        for key in candidates:
+            similarity = self.similarity(signature, self.signatures[key])
+            if similarity >= self.threshold:
+                matches.append((key, similarity))
+
+        return sorted(matches, key=lambda match: match[1], reverse=True)
+
+    def load(self):
+        """ Loads the signatures from disk and rebuilds the buckets. """
+        if self.index_path is None or not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            index_dict = json.load(f)
+
+        # Signatures computed with other parameters are not comparable.
+        if (index_dict.get("num_permutations") != self.num_permutations
+                or index_dict.get("shingle_size") != self.shingle_size
+                or index_dict.get("seed") != self.seed):
+            return
+
+        for key, signature in index_dict["signatures"].items():
+            self.insert(key, signature)
+
+    def save(self):
+        """ Writes the signatures to disk atomically, so that a crash cannot truncate them. """
+        if self.index_path is None:
+            return
+
+        index_dict = {"num_permutations": self.num_permutations,
+                      "shingle_size": self.shingle_size,
+                      "seed": self.seed,
+                      "signatures": self.signatures}
+        write_file(self.index_path, json.dumps(index_dict))
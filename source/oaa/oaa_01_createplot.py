@@ -15,8 +15,9 @@ class CreatePlot(OAABaseBookChainElement):
 
     def step(self, llm_connection):
         
-        llm_connection.query_assistant("BAI_Writer", 
+        answer = llm_connection.query_assistant("BAI_Writer", 
                                    "Create the plotline for a science fiction novel.")
+        print(answer)
         
         
 
@@ -1,14 +1,25 @@
 """ Module to control process, handling of assistants, threads, messages and run commands. """
 
 import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from openai.types.beta import Assistant
 
 from source.oaa.openaiagents import OpenAIAgents
+from source.budget import BudgetExceeded
 
 
 class OAAControl():
     """ Class to control process, handling of assistants, threads, messages and run commands."""
 
     PATHCONTROLTEMPLATES = "source/oaa/templates/"
+    CACHE_FILE_NAME = "assistants_cache.json"
+    CACHE_TTL_SECONDS = 24 * 60 * 60
+    MAX_BOOTSTRAP_WORKERS = 8
 
     def __init__(self,
                  project_control,
@@ -20,20 +31,23 @@ class OAAControl():
         self.gpt_model = gpt_model
 
         self.handler = OpenAIAgents(book_path=self.project_control.book_path,
-                                    api_key=self.project_control.api_key)
+                                    api_key=self.project_control.api_key,
+                                    cassette=self.project_control.cassette)
 
-        # Retrieve assistants if project is already initialized
-        if self.project_control.status:
-            try:
-                file_path = os.path.join(self.project_control.output_path, "agents.json")
-                agent_dict = self.project_control.read_json(file_path)
-                for assistant_id in agent_dict.keys():
-                    self.handler.retrieve_assistant(assistant_id)
+        # Runs on independent threads can be queried concurrently.
+        self.runs = []
+        self.runs_lock = threading.Lock()
 
-            except FileNotFoundError as exc:
-                raise FileNotFoundError("Could not retrieve assistants from file.\n"
-                                        f"File not found: {file_path}\n"
-                                        "Please reset project directory") from exc
+        self.agents_file_path = os.path.join(self.project_control.output_path, "agents.json")
+        self.cache_file_path = os.path.join(self.project_control.output_path, self.CACHE_FILE_NAME)
+
+        # Retrieve assistants if they have been created before. An unchanged set of assistants
+        # is served from the local cache without any request to OpenAI.
+        if os.path.exists(self.agents_file_path):
+            agent_dict = self.project_control.read_json(self.agents_file_path)
+            if not self.load_cached_assistants(agent_dict):
+                self.run_concurrently(self.handler.retrieve_assistant, list(agent_dict.keys()))
+                self.write_assistants_cache(agent_dict)
 
         # Otherwise, create new assistants and write their ids and names
         # to a file in the output directory
@@ -41,16 +55,86 @@ class OAAControl():
             try:
                 file_path = os.path.join(
                     self.PATHCONTROLTEMPLATES, "agents.json")
-                agent_dict = self.project_control.read_json(file_path)
+                template_dict = self.project_control.read_json(file_path)
             except FileNotFoundError as exc:
                 raise FileNotFoundError("Could not find template file for agents.\n"
                                         f"File not found: {file_path}") from exc
 
-            for key, value in agent_dict.items():
-                self.handler.create_new_assistant(key, value, self.gpt_model)
-                self.project_control.write_json(
-                                    os.path.join(self.project_control.output_path, "agents.json"),
-                                self.handler.get_all_assistants())
+            self.run_concurrently(
+                lambda item: self.handler.create_new_assistant(item[0], item[1], self.gpt_model),
+                list(template_dict.items()))
+
+            agent_dict = self.handler.get_all_assistants()
+            self.project_control.write_json(self.agents_file_path, agent_dict)
+            self.write_assistants_cache(agent_dict)
+
+    def run_concurrently(self, function, items: list):
+        """ Calls a function for every item concurrently and waits for all of them.
+
+        Args:
+            function (callable): Function to call with a single item.
+            items (list): Items to call the function with.
+        """
+        if not items:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(len(items), self.MAX_BOOTSTRAP_WORKERS)) as executor:
+            list(executor.map(function, items))
+
+    def get_config_hash(self, agent_dict: dict) -> str:
+        """ Returns a hash of everything the cached assistants depend on.
+
+        Args:
+            agent_dict (dict): Dictionary with assistant ids as keys and names as values.
+
+        Returns:
+            str: Hex digest of the configuration.
+        """
+        template_path = os.path.join(self.PATHCONTROLTEMPLATES, "agents.json")
+        template_dict = {}
+        if os.path.exists(template_path):
+            template_dict = self.project_control.read_json(template_path)
+
+        config = {"assistants": agent_dict,
+                  "templates": template_dict,
+                  "model": self.gpt_model}
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def load_cached_assistants(self, agent_dict: dict) -> bool:
+        """ Loads the assistants from the local cache if it is fresh and matches the configuration.
+
+        Args:
+            agent_dict (dict): Dictionary with assistant ids as keys and names as values.
+
+        Returns:
+            bool: True if the assistants were loaded from the cache, False otherwise.
+        """
+        if not os.path.exists(self.cache_file_path):
+            return False
+
+        cache_dict = self.project_control.read_json(self.cache_file_path)
+        if time.time() - cache_dict.get("time", 0) > self.CACHE_TTL_SECONDS:
+            return False
+        if cache_dict.get("config_hash") != self.get_config_hash(agent_dict):
+            return False
+
+        for assistant_dict in cache_dict["assistants"]:
+            self.handler.add_assistant(Assistant.model_validate(assistant_dict))
+
+        print(f"Loaded {len(cache_dict['assistants'])} assistants from cache.")
+        return True
+
+    def write_assistants_cache(self, agent_dict: dict):
+        """ Writes the metadata of all assistants to the local cache.
+
+        Args:
+            agent_dict (dict): Dictionary with assistant ids as keys and names as values.
+        """
+        cache_dict = {"time": time.time(),
+                      "config_hash": self.get_config_hash(agent_dict),
+                      "assistants": [assistant.model_dump(mode="json")
+                                     for assistant in self.handler.get_assistant_objects()]}
+        self.project_control.write_json(self.cache_file_path, cache_dict)
 
     def query_assistant(self, assistant_name: str, message_text: str, thread_id: str = None):
         """ Query the OpenAI assistant with the message.
@@ -62,6 +146,9 @@ class OAAControl():
 
         Raises:
             ValueError: Assistant of given name not found.
+
+        Returns:
+            str: The answer of the assistant.
         """
 
         assistant = self.handler.get_assistant_from_name(assistant_name)
@@ -74,24 +161,71 @@ class OAAControl():
         message = self.handler.attach_message(thread_id,
                                               message_text)
 
-        # OpenAI does not (yet?) provide a call to retrieve
-        # the number of tokens used by assistants
-        # Instead, we will count the tokens via the TikTokCounter
-        # token_count = self.token_counter.num_tokens_from_messages(messages=message.content,
-        #                                                                model=assistant.model)
+        self.project_control.check_cancelled()
+
+        budget = self.project_control.budget
+        if budget is not None and budget.usage_ratio() >= 1.0:
+            raise BudgetExceeded(f"Budget used up. Spent so far: {budget.spent_tokens} tokens, "
+                                 f"${budget.spent_cost:.2f}.")
+
         run = self.handler.create_run(assistant.id, thread_id)
         print(f"thread_id: {thread_id}")
         print(f"run_id: {run.id}")
 
-        dict_run = {"thread_id": thread_id,
-                    "run_id": run.id}
+        with self.runs_lock:
+            self.runs.append({"thread_id": thread_id,
+                              "run_id": run.id})
+            self.project_control.write_json(os.path.join(
+                self.project_control.output_path, "run.json"), {"runs": self.runs})
+
+        run = self.handler.wait_for_run(run)
+        thread_messages = self.handler.list_messages(thread_id)
+
+        # Messages are listed newest first.
+        answer = ""
+        for thread_message in thread_messages.data:
+            if thread_message.role == "assistant":
+                answer = "\n\n".join(content.text.value for content in thread_message.content
+                                      if content.type == "text")
+                break
 
-        self.project_control.write_json(os.path.join(
-            self.project_control.output_path, "run.json"), dict_run)
+        self.record_usage(run, assistant.model, message_text, answer)
 
-        print(self.handler.retrieve_answer(run))
+        return answer
+
+    def record_usage(self, run, model: str, message_text: str, answer: str):
+        """ Records the usage of a completed run in the project. Falls back to an estimate
+            with the TokenCounter if the run does not report its usage.
+
+        Args:
+            run (Run): The completed run.
+            model (str): Model of the assistant.
+            message_text (str): The query.
+            answer (str): The answer of the assistant.
+        """
+        usage = getattr(run, "usage", None)
+        if usage is not None:
+            self.project_control.record_usage(model, usage.prompt_tokens, usage.completion_tokens,
+                                              backend="assistants")
+        else:
+            self.project_control.record_usage(model,
+                                              self.project_control.estimate_tokens(message_text),
+                                              self.project_control.estimate_tokens(answer),
+                                              backend="assistants", estimated=True)
+
+    def query_assistants(self, queries: list, max_workers: int = 8):
+        """ Query assistants concurrently, each query on its own thread.
+
+        Args:
+            queries (list): Tuples of assistant name and message text.
+            max_workers (int, optional): Maximum number of concurrent runs. Defaults to 8.
+
+        Returns:
+            list: The answers in the order of the queries.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda query: self.query_assistant(*query), queries))
 
     def get_token_count(self):
         """ Returns the total number of tokens used in all steps. """
-        # TODO: Implement token count for assistants
-        return 0
+        return self.project_control.usage_ledger.total_tokens()
@@ -1,9 +1,16 @@
 """ Module to manage assistants, threads, messages and runs on OpenAI. """
 
 import os
+import time
+import threading
+from types import SimpleNamespace
 from retry import retry
 from openai import OpenAI
-from openai.types.beta import Assistant
+from openai.types.beta import Assistant, AssistantDeleted, Thread
+from openai.types.beta.threads import Run, ThreadMessage
+
+from source.cassette import cassette_call
+from source.transport import get_http_client
 
 
 class AssistantNotFound(Exception):
@@ -18,20 +25,51 @@ class AssistantNotFound(Exception):
         return f'{self.message}: {self.assistant_id}'
 
 
+class RunFailed(Exception):
+    """ Exception raised when a run does not complete on OpenAI."""
+
+    def __init__(self, run_id, status, message="Run did not complete"):
+        self.run_id = run_id
+        self.status = status
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f'{self.message}: {self.run_id} ({self.status})'
+
+
 class OpenAIAgents():
     """ Class to manage assistants, threads, messages and runs on OpenAI. """
 
     JSON_FILE_NAME = 'assistants.json'
     ASSISTANT_PREFIX = "AIB_"
 
-    def __init__(self, book_path: str, api_key: str):
+    # A run does not change anymore once it has reached one of these statuses.
+    TERMINAL_RUN_STATUSES = {"completed", "failed", "cancelled", "expired", "requires_action"}
+
+    def __init__(self, book_path: str, api_key: str, cassette=None):
 
         self.file_path = os.path.join(book_path, self.JSON_FILE_NAME)
-        self.client = OpenAI(api_key=api_key)
+        self.client = OpenAI(api_key=api_key, http_client=get_http_client())
+        self.cassette = cassette
 
         self.assistants_dict = {}
+        self.assistant_ids_by_name = {}
+        self.assistants_lock = threading.Lock()
         self.has_history = False
 
+    def add_assistant(self, assistant: Assistant):
+        """ Register an assistant object, e.g. one that was created, retrieved or loaded from a cache.
+
+        Args:
+            assistant (Assistant): OpenAI Assistant object
+        """
+        with self.assistants_lock:
+            self.assistants_dict[assistant.id] = {"object": assistant,
+                                                  "name": assistant.name,
+                                                  }
+            self.assistant_ids_by_name[assistant.name] = assistant.id
+
     def create_new_assistant(self, name: str, instructions: str, model: str):
         """ Create an assistant on OpenAI.
 
@@ -41,15 +79,12 @@ class OpenAIAgents():
             model (String): Model to use for the assistant
         """
 
-        assistant = self.client.beta.assistants.create(
-            name=name,
-            instructions=instructions,
-            model=model
-        )
+        request = {"name": name, "instructions": instructions, "model": model}
+        assistant = cassette_call(self.cassette, "assistants", "create_assistant", request,
+                                  lambda: self.client.beta.assistants.create(**request),
+                                  decode=Assistant.model_validate)
 
-        self.assistants_dict[assistant.id] = {"object": assistant,
-                                              "name": assistant.name,
-                                              }
+        self.add_assistant(assistant)
 
     def retrieve_assistant(self, assistant_id: str):
         """ Retrieve an assistant from OpenAI.
@@ -61,19 +96,20 @@ class OpenAIAgents():
             Assistant: OpenAI Assistant object
         """
 
-        assistant = self.client.beta.assistants.retrieve(assistant_id)
+        assistant = cassette_call(self.cassette, "assistants", "retrieve_assistant",
+                                  {"assistant_id": assistant_id},
+                                  lambda: self.client.beta.assistants.retrieve(assistant_id),
+                                  decode=Assistant.model_validate)
 
         if not assistant:
             raise AssistantNotFound(assistant_id)
 
-        self.assistants_dict[assistant.id] = {"object": assistant,
-                                              "name": assistant.name,
-                                              }
+        self.add_assistant(assistant)
 
     def flush_assistants(self):
         """ Delete all assistants from OpenAI. """
 
-        for assistant_id in self.assistants_dict:
+        for assistant_id in list(self.assistants_dict):
             self.delete_assistant(assistant_id)
 
         os.remove(self.file_path)
@@ -84,8 +120,13 @@ class OpenAIAgents():
         Args:
             assistant_id (String): ID of Assistant to delete
         """
-        self.client.beta.assistants.delete(assistant_id)
-        self.assistants_dict.pop(assistant_id, None)
+        cassette_call(self.cassette, "assistants", "delete_assistant", {"assistant_id": assistant_id},
+                      lambda: self.client.beta.assistants.delete(assistant_id),
+                      decode=AssistantDeleted.model_validate)
+        with self.assistants_lock:
+            items = self.assistants_dict.pop(assistant_id, None)
+            if items is not None and self.assistant_ids_by_name.get(items["name"]) == assistant_id:
+                del self.assistant_ids_by_name[items["name"]]
 
     def assistant_exists(self, name: str):
         """ Check if an assistant with the given name exists.
@@ -96,11 +137,7 @@ class OpenAIAgents():
         Returns:
             Boolean: True if assistant exists, False otherwise
         """
-        for items in self.assistants_dict.values():
-            if items['name'] == name:
-                return True
-
-        return False
+        return name in self.assistant_ids_by_name
 
     def get_all_assistants(self):
         """ Return a dictionary of assistants with their IDs as keys and names as values.
@@ -110,6 +147,14 @@ class OpenAIAgents():
         """
         return {key: value["name"] for key, value in self.assistants_dict.items()}
 
+    def get_assistant_objects(self) -> list:
+        """ Return all OpenAI Assistant objects.
+
+        Returns:
+            List: OpenAI Assistant objects
+        """
+        return [value["object"] for value in self.assistants_dict.values()]
+
     def get_assistant_from_name(self, name: str) -> Assistant | None:
         """ Return OpenAI Assistant object to the given name.
 
@@ -120,11 +165,11 @@ class OpenAIAgents():
             Assistant | None: OpenAI Assistant object or None if not found
         """
 
-        for items in self.assistants_dict.values():
-            if items['name'] == name:
-                return items['object']
+        assistant_id = self.assistant_ids_by_name.get(name)
+        if assistant_id is None:
+            return None
 
-        return None
+        return self.assistants_dict[assistant_id]['object']
 
     def create_thread(self):
         """ Create a new threat on OpenAI.
@@ -132,37 +177,101 @@ class OpenAIAgents():
         Returns:
             Thread Object: Thread object
         """
-        return self.client.beta.threads.create()
+        return cassette_call(self.cassette, "assistants", "create_thread", {},
+                             self.client.beta.threads.create,
+                             decode=Thread.model_validate)
 
     def attach_message(self, thread_id: str, message: str):
         role = "user"  # As of beta, only user is supported
 
-        return self.client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role=role,
-            content=message
-        )
+        request = {"thread_id": thread_id, "role": role, "content": message}
+        return cassette_call(self.cassette, "assistants", "attach_message", request,
+                             lambda: self.client.beta.threads.messages.create(**request),
+                             decode=ThreadMessage.model_validate)
 
     def create_run(self, assistant_id: str, thread_id: str):
 
-        return self.client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=assistant_id,
-        )
+        request = {"thread_id": thread_id, "assistant_id": assistant_id}
+        return cassette_call(self.cassette, "assistants", "create_run", request,
+                             lambda: self.client.beta.threads.runs.create(**request),
+                             decode=Run.model_validate)
 
+    @retry(tries=5, delay=1, backoff=2)
     def retrieve_run(self, run_id, thread_id):
 
-        return self.client.beta.threads.runs.retrieve(
-            thread_id=thread_id,
-            run_id=run_id,
-        )
+        request = {"thread_id": thread_id, "run_id": run_id}
+        return cassette_call(self.cassette, "assistants", "retrieve_run", request,
+                             lambda: self.client.beta.threads.runs.retrieve(**request),
+                             decode=Run.model_validate)
+
+    def wait_for_run(self, run,
+                     initial_delay: float = 0.25,
+                     max_delay: float = 5.0,
+                     backoff: float = 1.5,
+                     timeout: float = 600.0):
+        """ Wait until a run has reached a terminal status. The run is refreshed with
+            retrieve_run, starting with sub-second delays that grow up to max_delay,
+            so that short answers are picked up quickly and long ones are not polled too often.
+
+        Args:
+            run (Run): Run object as returned by create_run.
+            initial_delay (float, optional): First delay in seconds. Defaults to 0.25.
+            max_delay (float, optional): Maximum delay in seconds. Defaults to 5.0.
+            backoff (float, optional): Factor the delay grows with. Defaults to 1.5.
+            timeout (float, optional): Seconds after which to give up. Defaults to 600.
+
+        Raises:
+            RunFailed: Raises RunFailed if the run does not complete in time or ends
+                with another status than "completed".
+
+        Returns:
+            Run: The completed run.
+        """
+        delay = initial_delay
+        start_time = time.monotonic()
+
+        while run.status not in self.TERMINAL_RUN_STATUSES:
+            if time.monotonic() - start_time > timeout:
+                raise RunFailed(run.id, run.status, message="Run timed out")
+
+            # Replayed runs already have their recorded statuses.
+            if self.cassette is None or not self.cassette.skips_waits:
+                time.sleep(delay)
+            delay = min(delay * backoff, max_delay)
+            run = self.retrieve_run(run.id, run.thread_id)
+
+        if run.status != "completed":
+            raise RunFailed(run.id, run.status)
+
+        return run
 
-    @retry(tries=20, delay=30)
     def retrieve_answer(self, run):
-        print(run.status)
+        """ Wait for a run to complete and return the messages of its thread.
 
-        assert run.status == "completed"
+        Args:
+            run (Run): Run object as returned by create_run.
 
-        return self.client.beta.threads.messages.list(
-            thread_id=run.thread_id
-        )
+        Returns:
+            SyncCursorPage: Messages of the thread, newest first.
+        """
+        run = self.wait_for_run(run)
+
+        return self.list_messages(run.thread_id)
+
+    def list_messages(self, thread_id: str):
+        """ List the messages of a thread.
+
+        Args:
+            thread_id (str): ID of the thread
+
+        Returns:
+            SyncCursorPage: Messages of the thread, newest first.
+        """
+        # Only the messages of the page are recorded, replayed pages are plain namespaces.
+        return cassette_call(self.cassette, "assistants", "list_messages", {"thread_id": thread_id},
+                             lambda: self.client.beta.threads.messages.list(thread_id=thread_id),
+                             encode=lambda page: {"data": [message.model_dump(mode="json")
+                                                           for message in page.data]},
+                             decode=lambda page: SimpleNamespace(
+                                 data=[ThreadMessage.model_validate(message)
+                                       for message in page["data"]]))
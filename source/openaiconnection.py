@@ -1,6 +1,41 @@
+import time
+import threading
+
 from openai import OpenAI
+from openai.types import CreateEmbeddingResponse
+from openai.types.chat import ChatCompletion
 from retry import retry
 
+from source.budget import BudgetExceeded
+from source.cassette import cassette_call
+from source.prompttemplate import PromptTemplate
+from source.singleflight import SINGLE_FLIGHT
+from source.transport import get_http_client
+from source.structuredoutput import get_json_mode_model
+
+
+
+def stitch_continuation(text: str, continuation: str, min_overlap: int = 10, max_overlap: int = 1_000) -> str:
+    """ Joins a truncated answer and its continuation. Models often repeat the last words of
+        the partial answer, so the longest overlap between the end of the text and the start of
+        the continuation is removed.
+
+    Args:
+        text (str): The truncated answer.
+        continuation (str): The continuation.
+        min_overlap (int, optional): Minimum length of an overlap in characters. Defaults to 10.
+        max_overlap (int, optional): Maximum length of an overlap in characters. Defaults to 1000.
+
+    Returns:
+        str: The stitched answer.
+    """
+    stripped = continuation.lstrip()
+    for length in range(min(max_overlap, len(text), len(stripped)), min_overlap - 1, -1):
+        if text.endswith(stripped[:length]):
+            return text + stripped[length:]
+
+    # A continuation that starts with whitespace starts a new word or paragraph.
+    return text + continuation
 
 
 class OpenAIConnection():
@@ -9,7 +44,7 @@ class OpenAIConnection():
         
         self.project_control = project_control
 
-        self.client = OpenAI(api_key=self.project_control.api_key)
+        self.client = OpenAI(api_key=self.project_control.api_key, http_client=get_http_client())
 
         # For 3.5 use only the 16k model.
         self.chatbot_model_long = "gpt-3.5-turbo-16k"
@@ -19,25 +54,93 @@ class OpenAIConnection():
         self.chatbot_model_4_long = "gpt-4-32k"
         self.chatbot_contextmax_4 = 8_192
         self.chatbot_contextmax_4_long = 32_768
-        
-        
 
-    @retry(tries=5, delay=5)
+        self.context_sizes = {
+            self.chatbot_model_long: self.chatbot_contextmax_long,
+            self.chatbot_model_4: self.chatbot_contextmax_4,
+            self.chatbot_model_4_long: self.chatbot_contextmax_4_long,
+            # JSON mode versions of the models.
+            "gpt-3.5-turbo-0125": 16_385,
+            "gpt-4-turbo": 128_000,
+        }
+
+        # Models whose completion is limited below the rest of their context.
+        self.max_completion_tokens = {
+            "gpt-3.5-turbo-0125": 4_096,
+            "gpt-4-turbo": 4_096,
+        }
+
+        self.embedding_model = "text-embedding-ada-002"
+        self.embedding_batch_size = 512
+        self.embedding_cache = {}
+
+        # Chat calls may come from several threads at once, e.g. parallel outline lines.
+        self.lock = threading.Lock()
+
+        # Answers cut off at the token limit are continued up to max_continuations times.
+        self.max_continuations = 3
+        self.min_continuation_tokens = 256
+        self.continuation_context_chars = 6_000
+
+        # Optional RequestHedger that duplicates slow chat requests.
+        self.hedger = None
+
+        # Identical chat requests in flight at the same time are sent only once.
+        self.single_flight = SINGLE_FLIGHT
+
+
     def embed(self, texts: list[str]):
+        """ Embeds a list of texts. Duplicates are embedded only once, texts that have been
+            embedded before are served from an in-memory cache, and the rest is sent in batches.
+
+        Args:
+            texts (list[str]): Texts to embed.
+
+        Returns:
+            list: One embedding (list of floats) per text.
+        """
         assert isinstance(texts, list)
         assert all(isinstance(text, str) for text in texts)
 
-        response = self.client.embeddings.create(
-            input=texts,
-            model="text-embedding-ada-002",
+        missing_texts = list(dict.fromkeys(text for text in texts
+                                           if text not in self.embedding_cache))
 
-        )
+        for start in range(0, len(missing_texts), self.embedding_batch_size):
+            batch = missing_texts[start:start + self.embedding_batch_size]
+            for text, embedding in zip(batch, self.embed_batch(batch)):
+                self.embedding_cache[text] = embedding
 
-        embeddings = [element["embedding"] for element in response.data]
-        return embeddings
+        return [self.embedding_cache[text] for text in texts]
 
     @retry(tries=5, delay=5)
-    def chat(self, messages, long=False, version4=False):
+    def embed_batch(self, texts: list[str]):
+        """ Sends a single embedding request for a batch of texts. """
+
+        request = {"input": texts, "model": self.embedding_model}
+        response = cassette_call(self.project_control.cassette, "openai", "embed", request,
+                                 lambda: self.client.embeddings.create(**request),
+                                 decode=CreateEmbeddingResponse.model_validate)
+
+        with self.lock:
+            self.project_control.record_usage(self.embedding_model, response.usage.prompt_tokens, 0,
+                                              backend="openai")
+
+        embeddings = [element.embedding for element in response.data]
+        return embeddings
+
+    def chat(self, messages, long=False, version4=False, json_mode=False):
+        """ Sends a chat request.
+
+        Args:
+            messages (list): Messages of the request.
+            long (bool, optional): Whether to use the long context model. Defaults to False.
+            version4 (bool, optional): Whether to use GPT-4. Defaults to False.
+            json_mode (bool, optional): Request a JSON object. The request is sent to the
+                JSON mode version of the model, e.g. gpt-4-turbo for gpt-4. Defaults to False.
+
+        Returns:
+            dict: The answer message with "role" and "content".
+        """
 
         if self.project_control.verbose:
             print('----------MESSAGE-----------')
@@ -48,29 +151,68 @@ class OpenAIConnection():
 
         if version4:
             model = self.chatbot_model_4 if not long else self.chatbot_model_4_long
-            max_tokens = self.chatbot_contextmax_4 if not long else self.chatbot_contextmax_4_long
         else:
             model = self.chatbot_model_long
-            max_tokens = self.chatbot_contextmax_long
+
+        # Stop before the request if the run is cancelled.
+        self.project_control.check_cancelled()
+
+        # Downgrade the model or shrink the context if the budget runs low.
+        budget = self.project_control.budget
+        if budget is not None:
+            model, messages = budget.adjust(model, messages,
+                                            self.project_control.token_counter.num_tokens_from_messages)
+
+        # JSON requests go to the JSON mode version of the model.
+        response_format = None
+        if json_mode and get_json_mode_model(model) is not None:
+            model = get_json_mode_model(model)
+            response_format = {"type": "json_object"}
 
         tokens_messages = self.project_control.token_counter.num_tokens_from_messages(messages, model)
         print(f"tokens for message: {tokens_messages}")
 
         if self.project_control.logger.is_logging():
-            self.project_control.logger.write_messages(messages, tokens_messages, appendix="message")
+            with self.lock:
+                self.project_control.logger.write_messages(messages, tokens_messages, appendix="message")
+
+        response = self.send_chat(model, messages, tokens_messages, response_format)
+        content = response.choices[0].message.content
+        finish_reason = response.choices[0].finish_reason
 
-        max_tokens = max_tokens - tokens_messages
+        # Continue answers that were cut off at the token limit instead of throwing them away.
+        if finish_reason == "length":
+            self.project_control.telemetry.increment("openai.chat.truncated")
+        continuations = 0
+        while finish_reason == "length" and continuations < self.max_continuations:
+            continuations += 1
+            self.project_control.telemetry.increment("openai.chat.continuations")
+            if self.project_control.verbose:
+                print(f"Answer truncated at the token limit. "
+                      f"Requesting continuation {continuations}/{self.max_continuations}.")
 
-        response = self.client.chat.completions.create(
-            model=model,
-            max_tokens=max_tokens,
-            messages=messages
-        )
+            continuation_messages = self.get_continuation_messages(messages, content)
+            tokens_continuation = self.project_control.token_counter.num_tokens_from_messages(
+                continuation_messages, model)
+            if self.context_sizes[model] - tokens_continuation < self.min_continuation_tokens:
+                break
+            # Keep the partial answer if the budget cannot pay for a useful continuation.
+            if budget is not None:
+                remaining_tokens = budget.remaining_completion_tokens(model, tokens_continuation)
+                if remaining_tokens is not None and remaining_tokens < self.min_continuation_tokens:
+                    break
 
-        self.project_control.token_count += response.usage.total_tokens
+            # The partial answer is not valid JSON, so the continuation is plain text.
+            continuation = self.send_chat(model, continuation_messages, tokens_continuation, None)
+            content = stitch_continuation(content, continuation.choices[0].message.content)
+            finish_reason = continuation.choices[0].finish_reason
+
+        if finish_reason == "length":
+            self.project_control.telemetry.increment("openai.chat.truncated_final")
+            print("Answer is still truncated after the continuations.")
 
         response = {"role": response.choices[0].message.role,
-                    "content": response.choices[0].message.content}
+                    "content": content}
 
         if self.project_control.verbose:
             print('----------ANSWER-----------')
@@ -78,10 +220,108 @@ class OpenAIConnection():
             print('----------END ANSWER-----------')
 
         if self.project_control.logger.is_logging():
-            self.project_control.logger.write_messages([response], tokens_messages, appendix="answer")
+            with self.lock:
+                self.project_control.logger.write_messages([response], tokens_messages, appendix="answer")
 
         return response
 
+    def send_chat(self, model, messages, tokens_messages, response_format):
+        """ Sends a chat request through the single-flight layer and the hedger and records
+            its usage. The completion may use the rest of the context of the model, as far as
+            the budget allows.
+
+        Args:
+            model (str): The model.
+            messages (list): Messages of the request.
+            tokens_messages (int): Number of tokens of the messages.
+            response_format (dict | None): Response format of the request.
+
+        Raises:
+            BudgetExceeded: Raises BudgetExceeded if the budget leaves no completion tokens.
+
+        Returns:
+            ChatCompletion: The response.
+        """
+        max_tokens = min(self.context_sizes[model] - tokens_messages,
+                         self.max_completion_tokens.get(model, self.context_sizes[model]))
+
+        # Cap the completion to the remaining budget, so that a single request cannot overrun it.
+        budget = self.project_control.budget
+        if budget is not None:
+            remaining_tokens = budget.remaining_completion_tokens(model, tokens_messages)
+            if remaining_tokens is not None:
+                if remaining_tokens == 0:
+                    raise BudgetExceeded(f"The budget leaves no completion tokens for {model}.")
+                max_tokens = min(max_tokens, remaining_tokens)
+
+        def send_request():
+            return self.complete(model, max_tokens, messages, response_format)
+
+        def send_hedged_request():
+            if self.hedger is not None:
+                return self.hedger.run(model, send_request,
+                                       on_discarded=lambda discarded: self.record_discarded(model, discarded))
+
+            start_time = time.monotonic()
+            response = send_request()
+            self.project_control.telemetry.record_latency("openai.chat", time.monotonic() - start_time)
+            return response
+
+        if self.single_flight is not None:
+            key = self.single_flight.request_key("openai.chat", model, max_tokens, messages, response_format)
+            response, shared = self.single_flight.do(key, send_hedged_request)
+        else:
+            response, shared = send_hedged_request(), False
+
+        # A shared response was paid for by the caller that sent it.
+        if shared:
+            self.project_control.telemetry.increment("openai.chat.coalesced")
+        else:
+            with self.lock:
+                self.project_control.record_usage(model, response.usage.prompt_tokens,
+                                                  response.usage.completion_tokens, backend="openai")
+
+        return response
+
+    def get_continuation_messages(self, messages, partial_answer):
+        """ Builds the request that continues a truncated answer. The earlier conversation is
+            dropped, since the truncated answer already filled the context: only the system
+            messages, the request and the end of the partial answer are sent.
+
+        Args:
+            messages (list): Messages of the original request.
+            partial_answer (str): The answer so far.
+
+        Returns:
+            list: Messages of the continuation request.
+        """
+        system_messages = [message for message in messages[:-1] if message["role"] == "system"]
+        return system_messages + [
+            messages[-1],
+            {"role": "assistant", "content": partial_answer[-self.continuation_context_chars:]},
+            {"role": "user", "content": PromptTemplate.get("continue_truncated_answer")}]
+
+    def record_discarded(self, model, response):
+        """ Records the usage of a hedged response that lost the race. Its tokens are paid for,
+            so they are charged to the ledger, the budget and the hedging budget.
+        """
+        with self.lock:
+            self.project_control.record_usage(model, response.usage.prompt_tokens,
+                                              response.usage.completion_tokens, backend="openai-hedge")
+        self.hedger.charge_extra_tokens(response.usage.total_tokens)
+
+    @retry(tries=5, delay=5)
+    def complete(self, model, max_tokens, messages, response_format=None):
+        """ Sends a single chat completion request. Failed requests are retried. """
+
+        request = {"model": model, "max_tokens": max_tokens, "messages": messages}
+        if response_format is not None:
+            request["response_format"] = response_format
+
+        return cassette_call(self.project_control.cassette, "openai", "chat", request,
+                             lambda: self.client.chat.completions.create(**request),
+                             decode=ChatCompletion.model_validate)
+
     def print_messages(self, messages):
         for message in messages:
             print("\033[92m", end="")
@@ -0,0 +1,285 @@
+""" Pre-flight planner that projects the calls, tokens, cost and wall-clock time of a book.
+Walks the artifacts that exist already, so only the remaining work is projected. Prompts are
+rendered from the real templates and counted with the TokenCounter, and completions are
+estimated from the artifacts written so far or from defaults.
+"""
+import os
+import math
+
+from source.prompttemplate import PromptTemplate
+from source.artifactstore import open_artifact_store
+from source.pricing import estimate_cost
+from source.structuredoutput import strip_list_marker
+
+
+class BookPlanner():
+    """ Projects the remaining work of a book written with the OpenAI chain elements. """
+
+    # Completion tokens per call if there is no artifact to estimate them from.
+    DEFAULT_COMPLETION_TOKENS = {
+        "titles": 100,
+        "toc": 250,
+        "summary": 350,
+        "outline": 250,
+        "chapter_line": 450,
+    }
+    DEFAULT_CHAPTERS = 12
+    DEFAULT_OUTLINE_LINES = 8
+    RETRIEVAL_PASSAGE_TOKENS = 120
+
+    def __init__(self,
+                 book_path: str,
+                 token_counter,
+                 model: str = "gpt-3.5-turbo-16k",
+                 context_size: int = 16_384,
+                 tokens_per_second: float = 40.0,
+                 seconds_per_call: float = 1.5,
+                 parallel_lines: bool = False,
+                 workers: int = 8,
+                 retrieval_top_k: int = None):
+        """ Set up the planner.
+
+        Args:
+            book_path (str): Path to the book directory.
+            token_counter (TokenCounter): Token counter to count the prompts with.
+            model (str, optional): Model the calls go to. Defaults to "gpt-3.5-turbo-16k".
+            context_size (int, optional): Context window of the model. Defaults to 16384.
+            tokens_per_second (float, optional): Expected completion speed. Defaults to 40.
+            seconds_per_call (float, optional): Expected latency per call. Defaults to 1.5.
+            parallel_lines (bool, optional): Whether outline lines are expanded in parallel.
+                Defaults to False.
+            workers (int, optional): Maximum number of parallel requests. Defaults to 8.
+            retrieval_top_k (int, optional): Number of retrieved passages per chapter, if the
+                chapters are written with retrieval instead of the whole history. Defaults to None.
+        """
+        self.book_path = book_path
+        self.output_path = os.path.join(book_path, "output")
+        self.store = open_artifact_store(self.output_path)
+        self.token_counter = token_counter
+        self.model = model
+        self.context_size = context_size
+        self.tokens_per_second = tokens_per_second
+        self.seconds_per_call = seconds_per_call
+        self.parallel_lines = parallel_lines
+        self.workers = workers
+        self.retrieval_top_k = retrieval_top_k
+
+    def read(self, file_name: str, default: str = None):
+        """ Reads an artifact from the store, or returns the default if it is missing. """
+        if not self.store.exists(file_name):
+            return default
+        return self.store.read(file_name)
+
+    def read_description(self) -> str:
+        """ Reads the book description. """
+        with open(os.path.join(self.book_path, "description.txt"), "r", encoding="utf-8") as f:
+            return f.read()
+
+    def count(self, messages: list) -> int:
+        """ Counts the tokens of messages. """
+        return self.token_counter.num_tokens_from_messages(messages, self.model)
+
+    def call(self, prompt_tokens: int, completion_tokens: int) -> dict:
+        """ Returns the projection of a single call. """
+        return {"prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "seconds": self.seconds_per_call + completion_tokens / self.tokens_per_second,
+                "overflow": prompt_tokens + completion_tokens > self.context_size}
+
+    def estimate_completion_tokens(self, stage: str, kind: str) -> int:
+        """ Estimates the completion tokens of a call from the average size of existing artifacts. """
+        names = self.store.names(stage)
+        if not names:
+            return self.DEFAULT_COMPLETION_TOKENS[kind]
+
+        tokens = 0
+        for name in names:
+            tokens += self.count([{"role": "assistant", "content": self.store.read(name)}])
+        return tokens // len(names)
+
+    def get_chapter_titles(self) -> list:
+        """ Returns the chapter titles, or placeholders if the table of contents is missing. """
+        toc = self.read("toc.txt")
+        if toc is None:
+            return [f"Chapter {index + 1}" for index in range(self.DEFAULT_CHAPTERS)]
+        return [title for title in toc.split("\n") if title.strip() != ""]
+
+    def get_book_title(self) -> str:
+        """ Returns the book title, or a placeholder if it is missing. """
+        titles = self.read("book_titles.txt", "1. Title")
+        return strip_list_marker(titles.split("\n")[0])
+
+    def plan_find_book_title(self) -> list:
+        if self.store.exists("book_titles.txt"):
+            return []
+
+        description = self.read_description()
+        messages = [{"role": "system", "content": PromptTemplate.get("find_book_title_system_message")},
+                    {"role": "user", "content": PromptTemplate.get("find_book_description_prompt").format(description)}]
+        completion_tokens = self.DEFAULT_COMPLETION_TOKENS["titles"]
+        first_call = self.call(self.count(messages), completion_tokens)
+
+        messages += [{"role": "user", "content": PromptTemplate.get("rank_book_titles")}]
+        second_call = self.call(self.count(messages) + completion_tokens, completion_tokens)
+
+        return [first_call, second_call]
+
+    def plan_write_table_of_contents(self) -> list:
+        if self.store.exists("toc.txt"):
+            return []
+
+        messages = [{"role": "system", "content": PromptTemplate.get("write_toc_system_message")},
+                    {"role": "user", "content": PromptTemplate.get("write_toc_firstdraft").format(
+                        self.get_book_title(), self.read_description())}]
+        completion_tokens = self.DEFAULT_COMPLETION_TOKENS["toc"]
+        first_call = self.call(self.count(messages), completion_tokens)
+
+        messages += [{"role": "user", "content": PromptTemplate.get("write_toc_review_draft")}]
+        second_call = self.call(self.count(messages) + completion_tokens, completion_tokens)
+
+        return [first_call, second_call]
+
+    def plan_write_chapter_summaries(self) -> list:
+        completion_tokens = self.estimate_completion_tokens("chapter", "summary")
+        system_message = {"role": "system", "content": PromptTemplate.get("write_chaptersummary_system_message")}
+
+        calls = []
+        for chapter_index, chapter_title in enumerate(self.get_chapter_titles()):
+            if self.read(f"chapter_{chapter_index}.txt") is not None:
+                continue
+            prompt = PromptTemplate.get("write_chapter_summary").format(
+                self.get_book_title(), self.read_description(), chapter_title)
+            calls.append(self.call(self.count([system_message, {"role": "user", "content": prompt}]),
+                                   completion_tokens))
+        return calls
+
+    def plan_write_chapter_outlines(self) -> list:
+        completion_tokens = self.estimate_completion_tokens("chapteroutline", "outline")
+        summary_tokens = self.estimate_completion_tokens("chapter", "summary")
+        system_message = {"role": "system", "content": PromptTemplate.get("write_chapteroutline_system_message")}
+
+        calls = []
+        for chapter_index in range(len(self.get_chapter_titles())):
+            if self.read(f"chapteroutline_{chapter_index}.txt") is not None:
+                continue
+
+            summary = self.read(f"chapter_{chapter_index}.txt")
+            prompt = PromptTemplate.get("write_chapteroutline").format(self.get_book_title(), summary or "")
+            prompt_tokens = self.count([system_message, {"role": "user", "content": prompt}])
+            if summary is None:
+                prompt_tokens += summary_tokens
+            calls.append(self.call(prompt_tokens, completion_tokens))
+        return calls
+
+    def plan_write_chapters(self) -> list:
+        """ Projects the chapter calls. Without retrieval, WriteChapters keeps the whole history
+            of the earlier chapters in its messages, which is reflected in the prompt sizes.
+        """
+        system_message = {"role": "system", "content": PromptTemplate.get("write_chapters_system_message")}
+        history_tokens = self.count([system_message])
+        line_prompt_tokens = self.count([{"role": "user", "content": PromptTemplate.get("write_chapter_line")}])
+        outline_tokens = self.estimate_completion_tokens("chapteroutline", "outline")
+        summary_tokens = self.estimate_completion_tokens("chapter", "summary")
+        completion_tokens = self.DEFAULT_COMPLETION_TOKENS["chapter_line"]
+
+        # Estimate the completion tokens per outline line from the chapters written so far.
+        lines_written = 0
+        tokens_written = 0
+        for chapter_index in range(len(self.get_chapter_titles())):
+            chapter = self.read(f"chapterfull_{chapter_index}.txt")
+            outline = self.read(f"chapteroutline_{chapter_index}.txt")
+            if chapter is not None and outline is not None:
+                lines_written += len(outline.split("\n"))
+                tokens_written += self.count([{"role": "assistant", "content": chapter}])
+        if lines_written > 0:
+            completion_tokens = max(tokens_written // lines_written, 1)
+
+        calls = []
+        for chapter_index in range(len(self.get_chapter_titles())):
+            outline = self.read(f"chapteroutline_{chapter_index}.txt")
+            outline_lines = outline.split("\n") if outline is not None else [""] * self.DEFAULT_OUTLINE_LINES
+            chapter_prompt_tokens = self.count([{"role": "user", "content": PromptTemplate.get("write_chapter").format(
+                self.read(f"chapter_{chapter_index}.txt") or "", outline or "")}])
+            if outline is None:
+                chapter_prompt_tokens += outline_tokens + summary_tokens
+
+            chapter_exists = self.read(f"chapterfull_{chapter_index}.txt") is not None
+            if self.retrieval_top_k is not None:
+                history_tokens = self.count([system_message]) + self.retrieval_top_k * self.RETRIEVAL_PASSAGE_TOKENS
+
+            chapter_calls = []
+            context_tokens = history_tokens + chapter_prompt_tokens
+            for _ in outline_lines:
+                if self.parallel_lines:
+                    chapter_calls.append(self.call(context_tokens + 2 * line_prompt_tokens, completion_tokens))
+                else:
+                    chapter_calls.append(self.call(context_tokens + line_prompt_tokens, completion_tokens))
+                    context_tokens += line_prompt_tokens + completion_tokens
+
+            # The chapter stays in the history of the following chapters.
+            history_tokens += chapter_prompt_tokens + len(outline_lines) * completion_tokens
+            if not self.parallel_lines:
+                history_tokens += len(outline_lines) * line_prompt_tokens
+
+            if chapter_exists:
+                continue
+
+            # Parallel lines of a chapter overlap in time, bounded by the number of workers.
+            if self.parallel_lines and chapter_calls:
+                waves = math.ceil(len(chapter_calls) / self.workers)
+                wave_seconds = max(call["seconds"] for call in chapter_calls) * waves
+                for call in chapter_calls:
+                    call["seconds"] = wave_seconds / len(chapter_calls)
+
+            calls += chapter_calls
+        return calls
+
+    def plan(self) -> list:
+        """ Projects the remaining work per chain element.
+
+        Returns:
+            list: One dictionary per element with calls, tokens, cost, seconds and overflows.
+        """
+        element_calls = [
+            ("FindBookTitle", self.plan_find_book_title()),
+            ("WriteTableOfContents", self.plan_write_table_of_contents()),
+            ("WriteChapterSummaries", self.plan_write_chapter_summaries()),
+            ("WriteChapterOutlines", self.plan_write_chapter_outlines()),
+            ("WriteChapters", self.plan_write_chapters()),
+            ("JoinBook", []),
+        ]
+
+        plan = []
+        for element_name, calls in element_calls:
+            prompt_tokens = sum(call["prompt_tokens"] for call in calls)
+            completion_tokens = sum(call["completion_tokens"] for call in calls)
+            plan.append({"element": element_name,
+                         "calls": len(calls),
+                         "prompt_tokens": prompt_tokens,
+                         "completion_tokens": completion_tokens,
+                         "cost": estimate_cost(self.model, prompt_tokens, completion_tokens),
+                         "seconds": sum(call["seconds"] for call in calls),
+                         "overflows": sum(1 for call in calls if call["overflow"])})
+        return plan
+
+    def format_plan(self, plan: list) -> str:
+        """ Formats a plan as a table with a total row. """
+        header = f"{'Element':<24}{'Calls':>7}{'Prompt tok':>12}{'Compl. tok':>12}{'Cost ($)':>10}{'Time':>10}"
+        lines = [f"Plan for {self.book_path} ({self.model})", header, "-" * len(header)]
+
+        total = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0, "seconds": 0.0, "overflows": 0}
+        for row in plan + [dict(total, element="Total")]:
+            if row["element"] == "Total":
+                row = dict(total, element="Total")
+                lines.append("-" * len(header))
+            else:
+                for key in total:
+                    total[key] += row[key]
+            minutes, seconds = divmod(int(row["seconds"]), 60)
+            lines.append(f"{row['element']:<24}{row['calls']:>7}{row['prompt_tokens']:>12}"
+                         f"{row['completion_tokens']:>12}{row['cost']:>10.2f}{minutes:>7}:{seconds:02}")
+
+        if total["overflows"] > 0:
+            lines.append(f"Warning: {total['overflows']} calls are projected to exceed the context "
+                         f"window of {self.context_size} tokens.")
+        return "\n".join(lines)
@@ -0,0 +1,27 @@
+""" Prices of the OpenAI models, used to project and report the cost of a book. """
+
+# US dollars per 1000 tokens: (prompt, completion).
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-3.5-turbo-0125": (0.0005, 0.0015),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4-turbo": (0.01, 0.03),
+    "text-embedding-ada-002": (0.0001, 0.0),
+}
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int = 0) -> float:
+    """ Estimates the cost of a request in US dollars. Unknown models, e.g. local ones, are free.
+
+    Args:
+        model (str): Name of the model.
+        prompt_tokens (int): Number of prompt tokens.
+        completion_tokens (int, optional): Number of completion tokens. Defaults to 0.
+
+    Returns:
+        float: Cost in US dollars.
+    """
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
@@ -0,0 +1,143 @@
+""" Profiling of the chain elements.
+Every step of an element runs under cProfile and tracemalloc and is timed. A sampler thread
+records the stacks of all threads, including the worker threads of parallel elements, as
+collapsed stacks that flamegraph tools read directly.
+"""
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+class ChainProfiler():
+    """ Collects CPU profiles, allocations, wall-clock spans and stack samples per element. """
+
+    def __init__(self, profile_path: str, sample_interval: float = 0.005, top_functions: int = 20):
+        """ Set up the profiler.
+
+        Args:
+            profile_path (str): Directory to write the profiles to.
+            sample_interval (float, optional): Seconds between two stack samples.
+                Defaults to 0.005.
+            top_functions (int, optional): Number of functions per element in the summary.
+                Defaults to 20.
+        """
+        self.profile_path = profile_path
+        self.sample_interval = sample_interval
+        self.top_functions = top_functions
+
+        self.profiles = {}
+        self.spans = []
+        self.stack_counts = {}
+        self.current_element = "idle"
+        self.start_time = None
+
+        self.sampler = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        """ Starts the allocation tracking and the stack sampler. """
+        os.makedirs(self.profile_path, exist_ok=True)
+        tracemalloc.start()
+        self.start_time = time.perf_counter()
+
+        self.stop_event.clear()
+        self.sampler = threading.Thread(target=self.sample_stacks, name="ChainProfilerSampler",
+                                        daemon=True)
+        self.sampler.start()
+
+    @contextmanager
+    def profile_element(self, element_name: str):
+        """ Profiles a single step of an element.
+
+        Args:
+            element_name (str): Name of the element.
+        """
+        profile = self.profiles.setdefault(element_name, cProfile.Profile())
+        self.current_element = element_name
+        tracemalloc.reset_peak()
+        allocated_before, _ = tracemalloc.get_traced_memory()
+        start_time = time.perf_counter()
+
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            duration = time.perf_counter() - start_time
+            allocated_after, peak = tracemalloc.get_traced_memory()
+            self.current_element = "idle"
+
+            self.spans.append({"element": element_name,
+                               "start": round(start_time - self.start_time, 6),
+                               "duration": round(duration, 6),
+                               "allocated_bytes": allocated_after - allocated_before,
+                               "peak_bytes": peak})
+
+    def sample_stacks(self):
+        """ Samples the stacks of all other threads until the profiler is stopped. """
+        own_thread_id = threading.get_ident()
+        while not self.stop_event.wait(self.sample_interval):
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id == own_thread_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(self.current_element)
+
+                collapsed = ";".join(reversed(stack))
+                self.stack_counts[collapsed] = self.stack_counts.get(collapsed, 0) + 1
+
+    def stop(self):
+        """ Stops the sampler and writes all profiles. """
+        self.stop_event.set()
+        if self.sampler is not None:
+            self.sampler.join()
+
+        top_allocations = tracemalloc.take_snapshot().statistics("lineno")[:self.top_functions]
+        tracemalloc.stop()
+
+        for element_name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(self.profile_path, f"{element_name}.pstats"))
+
+        with open(os.path.join(self.profile_path, "stacks.collapsed"), "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stack_counts.items()):
+                f.write(f"{stack} {count}\n")
+
+        with open(os.path.join(self.profile_path, "spans.json"), "w", encoding="utf-8") as f:
+            json.dump(self.spans, f, indent=4)
+
+        with open(os.path.join(self.profile_path, "summary.txt"), "w", encoding="utf-8") as f:
+            self.write_summary(f, top_allocations)
+
+        print(f"Profiles written to {self.profile_path}")
+
+    def write_summary(self, f, top_allocations: list):
+        """ Writes the wall-clock time, memory and hottest functions per element.
+
+        Args:
+            f (TextIO): File to write to.
+            top_allocations (list): Largest allocations still alive at the end of the run.
+        """
+        for element_name, profile in self.profiles.items():
+            element_spans = [span for span in self.spans if span["element"] == element_name]
+            wall_time = sum(span["duration"] for span in element_spans)
+            peak = max(span["peak_bytes"] for span in element_spans)
+            print(f"===== {element_name}: {len(element_spans)} steps, {wall_time:.3f} s wall-clock, "
+                  f"peak {peak / 1024:.0f} KiB =====", file=f)
+
+            stats = pstats.Stats(profile, stream=f)
+            stats.sort_stats("cumulative").print_stats(self.top_functions)
+
+        print("===== Largest allocations alive at the end =====", file=f)
+        for statistic in top_allocations:
+            print(statistic, file=f)
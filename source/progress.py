@@ -0,0 +1,207 @@
+""" Live progress of a book with an ETA from the observed throughput.
+The chain elements report their work units, e.g. chapter summaries or outline lines, and the
+connections report every request. The progress, throughput and ETA are printed as a status line
+and written to output/live_progress.json for dashboards.
+"""
+import json
+import time
+import datetime
+import threading
+from collections import deque
+
+from source.artifactstore import write_file
+
+
+def format_seconds(seconds) -> str:
+    """ Formats seconds as H:MM:SS, or "?" if they are unknown. """
+    if seconds is None:
+        return "?"
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+class ProgressTracker():
+    """ Tracks the work units of the chain elements and the throughput of the requests.
+        Thread-safe.
+    """
+
+    def __init__(self, progress_path: str = None, window: float = 60.0, min_interval: float = 1.0):
+        """ Set up the tracker.
+
+        Args:
+            progress_path (str, optional): JSON file to write the progress to. Defaults to None.
+            window (float, optional): Seconds of recent requests the throughput is measured over.
+                Defaults to 60.
+            min_interval (float, optional): Minimum seconds between two writes of the progress
+                file. Defaults to 1.
+        """
+        self.progress_path = progress_path
+        self.window = window
+        self.min_interval = min_interval
+
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.start_time = time.time()
+        self.elements = {}
+        self.requests = deque()
+        self.total_requests = 0
+        self.total_tokens = 0
+        self.last_save = 0.0
+
+    def get_element(self, element_name: str) -> dict:
+        """ Returns the entry of an element. Has to be called with the lock held. """
+        return self.elements.setdefault(element_name, {"status": "pending",
+                                                       "units_total": None,
+                                                       "units_done": 0,
+                                                       "planned_seconds": None,
+                                                       "started": None,
+                                                       "finished": None,
+                                                       "current": None})
+
+    def plan(self, element_name: str, units: int, seconds: float = None):
+        """ Sets the projected work of an element before it starts, e.g. from the BookPlanner.
+
+        Args:
+            element_name (str): Name of the element.
+            units (int): Projected number of work units.
+            seconds (float, optional): Projected seconds for these units. Defaults to None.
+        """
+        with self.lock:
+            element = self.get_element(element_name)
+            element["units_total"] = units
+            element["planned_seconds"] = seconds
+
+    def start(self, element_name: str):
+        """ Marks an element as running. """
+        with self.lock:
+            element = self.get_element(element_name)
+            if element["started"] is None:
+                element["started"] = time.time()
+            element["status"] = "running"
+        self.save()
+
+    def set_total(self, element_name: str, units: int):
+        """ Sets the number of work units of an element once the element knows it. """
+        with self.lock:
+            self.get_element(element_name)["units_total"] = units
+        self.save()
+
+    def advance(self, element_name: str, units: int = 1, current: str = None):
+        """ Records completed work units of an element and prints the status line.
+
+        Args:
+            element_name (str): Name of the element.
+            units (int, optional): Number of completed units. Defaults to 1.
+            current (str, optional): Description of the unit, e.g. "chapter 3, line 2".
+                Defaults to None.
+        """
+        with self.lock:
+            element = self.get_element(element_name)
+            element["units_done"] += units
+            element["current"] = current
+        print(self.format_line(element_name))
+        self.save()
+
+    def finish(self, element_name: str):
+        """ Marks an element as completed. """
+        with self.lock:
+            element = self.get_element(element_name)
+            element["status"] = "done"
+            element["finished"] = time.time()
+            element["started"] = element["started"] or element["finished"]
+            element["units_total"] = element["units_done"]
+        self.save(force=True)
+
+    def record_request(self, prompt_tokens: int, completion_tokens: int):
+        """ Records a completed request for the throughput. """
+        now = time.time()
+        with self.lock:
+            self.requests.append((now, completion_tokens))
+            self.total_requests += 1
+            self.total_tokens += prompt_tokens + completion_tokens
+            while self.requests and self.requests[0][0] < now - self.window:
+                self.requests.popleft()
+
+    def throughput(self) -> tuple:
+        """ Returns the completion tokens and calls per second over the recent window. """
+        now = time.time()
+        with self.lock:
+            recent = [request for request in self.requests if request[0] >= now - self.window]
+        seconds = max(min(self.window, now - self.start_time), 1.0)
+        return sum(tokens for _, tokens in recent) / seconds, len(recent) / seconds
+
+    def seconds_per_unit(self, element: dict, correction: float):
+        """ Returns the expected seconds per remaining unit of an element. Observed units of
+            the element are preferred, otherwise the projection is scaled by the ratio of
+            observed to projected time of the elements done so far.
+        """
+        if element["units_done"] > 0 and element["started"] is not None:
+            end_time = element["finished"] or time.time()
+            return (end_time - element["started"]) / element["units_done"]
+        if element["planned_seconds"] is not None and element["units_total"]:
+            return element["planned_seconds"] / element["units_total"] * correction
+        return None
+
+    def snapshot(self) -> dict:
+        """ Returns the progress, throughput and ETAs of the book and its elements. """
+        tokens_per_second, calls_per_second = self.throughput()
+        with self.lock:
+            elements = {name: dict(element) for name, element in self.elements.items()}
+            total_requests = self.total_requests
+            total_tokens = self.total_tokens
+
+        # Ratio of observed to projected time of the completed elements.
+        observed = sum(element["finished"] - element["started"] for element in elements.values()
+                       if element["status"] == "done" and element["planned_seconds"])
+        projected = sum(element["planned_seconds"] for element in elements.values()
+                        if element["status"] == "done" and element["planned_seconds"])
+        correction = observed / projected if projected else 1.0
+
+        book_eta = 0.0
+        for element in elements.values():
+            remaining = max((element["units_total"] or 0) - element["units_done"], 0)
+            seconds_per_unit = self.seconds_per_unit(element, correction)
+            if element["status"] == "done":
+                element["eta_seconds"] = 0.0
+            elif element["units_total"] is None or seconds_per_unit is None:
+                element["eta_seconds"] = None
+            else:
+                element["eta_seconds"] = remaining * seconds_per_unit
+            if element["eta_seconds"] is None and element["status"] != "done":
+                book_eta = None
+            elif book_eta is not None:
+                book_eta += element["eta_seconds"]
+
+        return {"updated": time.time(),
+                "elapsed_seconds": time.time() - self.start_time,
+                "units_done": sum(element["units_done"] for element in elements.values()),
+                "units_total": sum(element["units_total"] or 0 for element in elements.values()),
+                "requests": total_requests,
+                "tokens": total_tokens,
+                "tokens_per_second": tokens_per_second,
+                "calls_per_second": calls_per_second,
+                "eta_seconds": book_eta,
+                "elements": elements}
+
+    def format_line(self, element_name: str) -> str:
+        """ Formats the status line of an element. """
+        snapshot = self.snapshot()
+        element = snapshot["elements"][element_name]
+        total = element["units_total"] if element["units_total"] is not None else "?"
+        current = f" ({element['current']})" if element["current"] else ""
+        return (f"[{element_name}] {element['units_done']}/{total}{current} | "
+                f"{snapshot['tokens_per_second']:.1f} tokens/s, {snapshot['calls_per_second']:.2f} calls/s | "
+                f"ETA {format_seconds(element['eta_seconds'])}, book {format_seconds(snapshot['eta_seconds'])}")
+
+    def save(self, force: bool = False):
+        """ Writes the progress file, at most once per min_interval unless forced. """
+        if self.progress_path is None:
+            return
+
+        with self.lock:
+            if not force and time.time() - self.last_save < self.min_interval:
+                return
+            self.last_save = time.time()
+
+        # A write with an older snapshot must not replace a newer one.
+        with self.save_lock:
+            write_file(self.progress_path, json.dumps(self.snapshot(), indent=4))
@@ -5,8 +5,17 @@ Initializes the project and provides methods to read and write json files.
 import os
 import json
 import datetime
+import threading
 from source.writelogs import WriteLogs
 from source.tokencounter import TokenCounter
+from source.usageledger import UsageLedger
+from source.telemetry import Telemetry
+from source.progress import ProgressTracker
+from source.artifactstore import open_artifact_store, parse_artifact_name, write_file, STAGES
+
+
+class JobCancelled(Exception):
+    """ Exception raised before the next request when the job of a book is cancelled. """
 
 
 class Project():
@@ -19,7 +28,9 @@ class Project():
                  book_path: str,
                  verbose: bool = False,
                  logging: bool = False,
-                 persistent_logging: bool = False) -> None:
+                 persistent_logging: bool = False,
+                 budget=None,
+                 sqlite: bool = False) -> None:
 
         # Files and paths
         self.steps_json_path = os.path.join("source", "lc", "steps.json")
@@ -30,6 +41,9 @@ class Project():
         self.description_path = os.path.join(self.book_path, "description.txt")
         self.progress_file_path = os.path.join(self.output_path, "progress.json")
 
+        self.sqlite = sqlite
+        self.store = None
+
         self.verbose = verbose
         self.logging = logging
         self.persistent_logging = persistent_logging
@@ -42,6 +56,12 @@ class Project():
         )
         self.token_counter = TokenCounter()
         self.token_count = 0
+        # Requests of concurrent threads record their usage at the same time.
+        self.usage_lock = threading.Lock()
+        self.budget = budget
+        self.usage_ledger = UsageLedger(os.path.join(self.output_path, "usage.json"))
+        self.telemetry = Telemetry(os.path.join(self.output_path, "telemetry.json"))
+        self.progress = ProgressTracker(os.path.join(self.output_path, "live_progress.json"))
 
         # Init variables
         self.api_key = os.getenv("OPENAI_API_KEY")
@@ -53,6 +73,15 @@ class Project():
 
         self.step_commands_dict = self.read_json(self.steps_json_path)
 
+        # Steps of the step graph may run concurrently and share the status and progress files.
+        self.lock = threading.RLock()
+
+        # Cassette to record or replay the exchanges with the LLMs. Set by writebook.
+        self.cassette = None
+
+        # Event that cancels the run, e.g. set by the daemon. Set by writebook.
+        self.cancel_event = None
+
         self.status = {}   
         self.setup()
 
@@ -65,8 +94,13 @@ class Project():
         """
 
         # Check status of project
-        if not os.path.exists(self.output_path):
-            os.makedirs(self.output_path)
+        initialized = os.path.exists(self.output_path)
+        os.makedirs(self.output_path, exist_ok=True)
+
+        # The status, the progress and the artifacts of the chain elements share one store.
+        self.store = open_artifact_store(self.output_path, sqlite=self.sqlite)
+
+        if not initialized:
             self.set_current_status("Project initialized", "Completed")
         else:
             try:
@@ -83,26 +117,83 @@ class Project():
             current_step (str): Current step in process.
             current_status (str): Status of current step.
         """
-        current_status = self.status.get("Current status")
+        with self.lock:
+            current_status = self.status.get("Current status")
+
+            # Save current status to status dictionary
+            if current_status is not None:
+                self.status[current_status["Time"]] = (
+                        f'{current_status["Step"]}: {current_status["Status"]}')
+
+            # Set new current status
+            self.status["Current status"] = {
+                "Time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "Step": current_step,
+                "Status": current_step_status}
+
+            # Write status to file
+            self.write_json(self.status_file_path, self.status)
+
+    def record_usage(self,
+                     model: str,
+                     prompt_tokens: int,
+                     completion_tokens: int,
+                     backend: str,
+                     estimated: bool = False):
+        """ Records the usage of a request in the token count, the usage ledger and the budget.
+            Thread-safe, requests of concurrent threads may record at the same time.
 
-        # Save current status to status dictionary
-        if current_status is not None:
-            self.status[current_status["Time"]] = (
-                    f'{current_status["Step"]}: {current_status["Status"]}')
+        Args:
+            model (str): Model that answered the request.
+            prompt_tokens (int): Number of prompt tokens.
+            completion_tokens (int): Number of completion tokens.
+            backend (str): Backend that sent the request.
+            estimated (bool, optional): Whether the numbers are estimates. Defaults to False.
+        """
+        with self.usage_lock:
+            self.token_count += prompt_tokens + completion_tokens
+        self.usage_ledger.record(model, prompt_tokens, completion_tokens,
+                                 backend=backend, estimated=estimated)
+        if self.budget is not None:
+            self.budget.charge(model, prompt_tokens, completion_tokens)
+        self.progress.record_request(prompt_tokens, completion_tokens)
 
-        # Set new current status
-        self.status["Current status"] = {
-            "Time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "Step": current_step,
-            "Status": current_step_status}
+    def get_usage(self) -> dict:
+        """ Returns the usage of the book so far.
 
-        # Write status to file
-        self.write_json(self.status_file_path, self.status)
+        Returns:
+            Dictionary: Usage per chain element or step and per model, and the totals.
+        """
+        usage = self.usage_ledger.snapshot()
+        with self.usage_lock:
+            usage["token_count"] = self.token_count
+        return usage
+
+    def check_cancelled(self):
+        """ Stops the run before the next request if it is cancelled.
+
+        Raises:
+            JobCancelled: Raises JobCancelled if the cancel event is set.
+        """
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise JobCancelled("The job was cancelled.")
+
+    def estimate_tokens(self, text: str) -> int:
+        """ Estimates the number of tokens of a text for backends that do not report usage.
+
+        Args:
+            text (str): Text to count.
+
+        Returns:
+            int: Estimated number of tokens.
+        """
+        return self.token_counter.num_tokens_from_string(text, "gpt-3.5-turbo")
 
     def write_current_status(self):
         """ Writes the current status to the status JSON."""
 
-        self.write_json(self.status_file_path, self.status)
+        with self.lock:
+            self.write_json(self.status_file_path, self.status)
 
     def save_current_progress(self, progress: list):
         """ Saves the current progress to the progress JSON.
@@ -110,8 +201,10 @@ class Project():
         Args:
             progress (list): List with recent conversation history.
         """
-        dict_progress = {"progress": progress}
-        self.write_json(self.progress_file_path, dict_progress)
+        with self.lock, self.store.transaction():
+            dict_progress = self.read_progress()
+            dict_progress["progress"] = progress
+            self.write_json(self.progress_file_path, dict_progress)
 
     def load_current_progress(self):
         """ Loads the current progress from the progress JSON.
@@ -122,8 +215,74 @@ class Project():
         dict_progress = self.read_json(self.progress_file_path)
         return dict_progress["progress"]
 
+    def read_progress(self) -> dict:
+        """ Reads the progress JSON, or returns an empty dictionary if it does not exist yet.
+
+        Returns:
+            Dictionary: Dictionary from the progress JSON.
+        """
+        if not self.store.exists(os.path.basename(self.progress_file_path)):
+            return {}
+        return self.read_json(self.progress_file_path)
+
+    def save_step_progress(self, step_name: str, progress: dict, done: bool = False,
+                           completed_substeps: list = None):
+        """ Saves the progress of a single step of the step graph. Every step has its own
+            entry, so that steps running concurrently do not overwrite each other. The
+            conversation progress of save_current_progress is left untouched.
+
+        Args:
+            step_name (str): Name of the step.
+            progress (dict): Placeholders produced by the step so far.
+            done (bool, optional): Whether the step is completed. Defaults to False.
+            completed_substeps (list, optional): Sub-steps that are completed, e.g. "head",
+                "review_1" and "rewrite_1", to resume an interrupted step. Defaults to None.
+        """
+        with self.lock, self.store.transaction():
+            dict_progress = self.read_progress()
+            dict_progress.setdefault("steps", {})[step_name] = {
+                "progress": progress,
+                "done": done,
+                "completed_substeps": completed_substeps or []}
+            self.write_json(self.progress_file_path, dict_progress)
+
+    def load_step_progress(self, step_name: str):
+        """ Loads the progress of a single step of the step graph.
+
+        Args:
+            step_name (str): Name of the step.
+
+        Returns:
+            Dictionary | None: Progress and done flag of the step, or None if it has not run yet.
+        """
+        with self.lock:
+            return self.read_progress().get("steps", {}).get(step_name)
+
+    def get_step_outputs(self, step_names: list) -> dict:
+        """ Collects the results of completed steps of the step graph.
+
+        Args:
+            step_names (list): Names of the steps.
+
+        Raises:
+            ValueError: Raises ValueError if one of the steps is not completed yet.
+
+        Returns:
+            Dictionary: Results of the steps by the output keys in the step commands.
+        """
+        outputs = {}
+        for step_name in step_names:
+            step_progress = self.load_step_progress(step_name)
+            if step_progress is None or not step_progress["done"]:
+                raise ValueError(f"Step {step_name} is not completed yet.")
+
+            output_key = self.get_step_commands(step_name)["output_key"]
+            outputs[output_key] = step_progress["progress"][output_key]
+        return outputs
+
     def read_json(self, file_path: str) -> dict:
         """ Reads a json file and returns dictionary from json.
+            Files of the output directory are read from the artifact store.
 
         Args:
             file_path (String): Path to the json file.
@@ -131,6 +290,10 @@ class Project():
         Returns:
             Dictionary: Dictionary from json file.
         """
+        artifact_name = self.get_artifact_name(file_path)
+        if artifact_name is not None:
+            return json.loads(self.store.read(artifact_name))
+
         json_dict = {}
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
@@ -140,15 +303,38 @@ class Project():
         return json_dict
 
     def write_json(self, file_path: str, json_dict: dict):
-        """ Stores a dictionary into a json file.
+        """ Stores a dictionary into a json file. The file is written to a temporary file first
+            and then renamed, so that a crash never leaves a truncated file behind.
+            Files of the output directory are written to the artifact store.
 
         Args:
             file_path (String): Path to the json file.
             json_dict (Dictionary): Dictionary to store in json file.
         """
+        artifact_name = self.get_artifact_name(file_path)
+        if artifact_name is not None:
+            self.store.write(artifact_name, json.dumps(json_dict, indent=4))
+            return
+
+        write_file(file_path, json.dumps(json_dict, indent=4))
+
+    def get_artifact_name(self, file_path: str):
+        """ Returns the name of a file in the artifact store, or None if the file is not
+            stored there, e.g. the step commands or the assistants of the OAA backend.
+
+        Args:
+            file_path (String): Path to the file.
+
+        Returns:
+            String | None: Name of the artifact.
+        """
+        if self.store is None or os.path.dirname(os.path.abspath(file_path)) != os.path.abspath(self.output_path):
+            return None
 
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(json_dict, f, indent=4)
+        artifact_name = os.path.basename(file_path)
+        if parse_artifact_name(artifact_name)[0] not in STAGES:
+            return None
+        return artifact_name
 
     def get_prompt_template(self, template_id: str):
         """ Get the prompt template from the prompt_templates folder.
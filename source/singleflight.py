@@ -0,0 +1,75 @@
+""" Single-flight coalescing of identical requests.
+While a request is in flight, identical requests do not go out again but wait for the
+outstanding one and share its response. The requests are identified by a hash of their content.
+"""
+import json
+import hashlib
+import threading
+
+
+class _Call():
+    """ A request in flight and the callers waiting for it. """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight():
+    """ Coalesces concurrent calls with the same key into one. Thread-safe. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    @staticmethod
+    def request_key(*parts) -> str:
+        """ Returns a hash of the content of a request. """
+        request_json = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(request_json.encode("utf-8")).hexdigest()
+
+    def do(self, key: str, function) -> tuple:
+        """ Calls the function, unless a call with the same key is in flight already.
+            In that case waits for it and returns its result, or raises its exception.
+
+        Args:
+            key (str): Key of the request, e.g. from request_key.
+            function (callable): Sends the request.
+
+        Returns:
+            tuple: The result, and whether it was shared from another caller's request.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+        return call.result, False
+
+
+# Shared by all connections in the process, so that requests of several books coalesce as well.
+SINGLE_FLIGHT = SingleFlight()
@@ -0,0 +1,246 @@
+""" Structured JSON outputs for the book chain elements.
+The answers are requested as JSON objects that follow a small JSON schema and are validated
+locally. Only the fields that are missing or invalid are requested again with a short repair
+prompt, instead of re-running the whole step.
+"""
+import re
+import json
+
+from source.prompttemplate import PromptTemplate
+
+
+# Models that accept response_format={"type": "json_object"}. Other models only get the
+# format instructions in the prompt, the local validation and repair work the same for both.
+JSON_MODE_MODELS = {
+    "gpt-3.5-turbo",
+    "gpt-3.5-turbo-1106",
+    "gpt-3.5-turbo-0125",
+    "gpt-4-turbo",
+    "gpt-4-turbo-preview",
+    "gpt-4-1106-preview",
+    "gpt-4-0125-preview",
+    "gpt-4o",
+    "gpt-4o-mini",
+}
+
+# JSON mode capable versions of the models the chain elements are configured with. Structured
+# requests are sent to these, so that JSON mode is used in practice and not only the repairs.
+JSON_MODE_VERSIONS = {
+    "gpt-3.5-turbo-16k": "gpt-3.5-turbo-0125",
+    "gpt-4": "gpt-4-turbo",
+    "gpt-4-32k": "gpt-4-turbo",
+}
+
+TITLES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "titles": {"type": "array", "items": {"type": "string", "minLength": 1}, "minItems": 1},
+    },
+    "required": ["titles"],
+}
+
+TOC_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "chapters": {"type": "array", "items": {"type": "string", "minLength": 1}, "minItems": 1},
+    },
+    "required": ["chapters"],
+}
+
+SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string", "minLength": 1},
+        "summary": {"type": "string", "minLength": 20},
+    },
+    "required": ["title", "summary"],
+}
+
+OUTLINE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "points": {"type": "array", "items": {"type": "string", "minLength": 1}, "minItems": 1},
+    },
+    "required": ["points"],
+}
+
+
+class StructuredOutputError(ValueError):
+    """ Exception raised when an answer stays invalid after all repair attempts. """
+
+
+def supports_json_mode(model: str) -> bool:
+    """ Returns whether a model accepts the JSON response format. """
+    return model in JSON_MODE_MODELS
+
+
+def get_json_mode_model(model: str):
+    """ Returns the model to send a JSON mode request to: the model itself if it accepts the
+        JSON response format, otherwise its JSON mode capable version.
+
+    Args:
+        model (str): The configured model.
+
+    Returns:
+        str | None: The model, or None if there is no JSON mode capable version.
+    """
+    if supports_json_mode(model):
+        return model
+    return JSON_MODE_VERSIONS.get(model)
+
+
+def strip_list_marker(line: str) -> str:
+    """ Removes list numbering, bullets and surrounding quotes from a line, e.g. '1. "Title"'.
+
+    Args:
+        line (str): Line of a list.
+
+    Returns:
+        str: The bare list item.
+    """
+    line = re.sub(r"^\s*(?:\d+[.):]|[-*•])\s*", "", line)
+    return line.strip().strip("*").strip().strip("\"'").strip()
+
+
+def parse_json(content: str) -> dict:
+    """ Parses the JSON object in an answer. Tolerates code fences and text around the object.
+
+    Args:
+        content (str): The answer of the model.
+
+    Raises:
+        ValueError: Raises ValueError if the answer contains no JSON object.
+
+    Returns:
+        dict: The parsed object.
+    """
+    content = re.sub(r"```(?:json)?", "", content)
+    start_index = content.find("{")
+    end_index = content.rfind("}")
+    if start_index == -1 or end_index < start_index:
+        raise ValueError("Answer contains no JSON object.")
+
+    data = json.loads(content[start_index:end_index + 1])
+    if not isinstance(data, dict):
+        raise ValueError("Answer is not a JSON object.")
+    return data
+
+
+def validate_value(value, schema: dict):
+    """ Validates a value against a subset of JSON schema: type, minLength, minItems and items.
+
+    Args:
+        value (Any): The value.
+        schema (dict): The schema of the value.
+
+    Returns:
+        str | None: Description of the first error, or None if the value is valid.
+    """
+    types = {"string": str, "array": list, "object": dict, "integer": int, "number": (int, float)}
+    expected_type = schema.get("type")
+    if expected_type in types and (not isinstance(value, types[expected_type])
+                                   or isinstance(value, bool)):
+        return f"must be of type {expected_type}"
+
+    if expected_type == "string" and len(value.strip()) < schema.get("minLength", 0):
+        return f"must have at least {schema['minLength']} characters"
+
+    if expected_type == "array":
+        if len(value) < schema.get("minItems", 0):
+            return f"must have at least {schema['minItems']} items"
+        for index, item in enumerate(value):
+            error = validate_value(item, schema.get("items", {}))
+            if error is not None:
+                return f"item {index} {error}"
+
+    if expected_type == "object":
+        errors = validate(value, schema)
+        if errors:
+            return "; ".join(f"{field} {error}" for field, error in errors.items())
+
+    return None
+
+
+def validate(data: dict, schema: dict) -> dict:
+    """ Validates the fields of an object.
+
+    Args:
+        data (dict): The object.
+        schema (dict): Object schema with "properties" and "required".
+
+    Returns:
+        dict: Errors by field name. Empty if the object is valid.
+    """
+    errors = {}
+    for field in schema.get("required", []):
+        if field not in data:
+            errors[field] = "is missing"
+
+    for field, field_schema in schema.get("properties", {}).items():
+        if field in data:
+            error = validate_value(data[field], field_schema)
+            if error is not None:
+                errors[field] = error
+
+    return errors
+
+
+def request_json(llm_connection, messages: list, schema: dict,
+                 version4: bool = False, max_repairs: int = 2) -> dict:
+    """ Requests a JSON object, validates it and repairs invalid fields.
+
+    Args:
+        llm_connection (OpenAIConnection): Connection to the model.
+        messages (list): Messages of the request. The format instructions are added to the
+            last message.
+        schema (dict): Object schema of the answer.
+        version4 (bool, optional): Whether to use GPT-4. Defaults to False.
+        max_repairs (int, optional): Maximum number of repair requests. Defaults to 2.
+
+    Raises:
+        StructuredOutputError: Raises StructuredOutputError if fields are still invalid
+            after all repair requests.
+
+    Returns:
+        dict: The valid object.
+    """
+    instructions = PromptTemplate.get("json_format_instructions").format(json.dumps(schema))
+    messages = messages[:-1] + [{"role": messages[-1]["role"],
+                                 "content": messages[-1]["content"] + "\n\n" + instructions}]
+
+    response_message = llm_connection.chat(messages, version4=version4, json_mode=True)
+    try:
+        data = parse_json(response_message["content"])
+    except ValueError:
+        data = {}
+    errors = validate(data, schema)
+
+    for repair in range(max_repairs):
+        if not errors:
+            break
+        print(f"Repairing invalid fields ({repair + 1}/{max_repairs}): {', '.join(errors)}")
+
+        repair_schema = {"type": "object",
+                         "properties": {field: schema["properties"][field] for field in errors
+                                        if field in schema.get("properties", {})},
+                         "required": list(errors)}
+        error_lines = "\n".join(f"- {field}: {error}" for field, error in errors.items())
+        prompt = PromptTemplate.get("repair_json_fields").format(error_lines, json.dumps(repair_schema))
+
+        repair_message = llm_connection.chat(
+            messages + [response_message, {"role": "user", "content": prompt}],
+            version4=version4, json_mode=True)
+        try:
+            repaired = parse_json(repair_message["content"])
+        except ValueError:
+            repaired = {}
+
+        # Keep the valid fields and only take over the repaired ones.
+        data.update({field: value for field, value in repaired.items() if field in errors})
+        errors = validate(data, schema)
+
+    if errors:
+        raise StructuredOutputError("Invalid fields after repair: " +
+                                    "; ".join(f"{field} {error}" for field, error in errors.items()))
+
+    return data
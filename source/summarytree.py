@@ -0,0 +1,135 @@
+""" Hierarchical summary tree of the chapters written so far.
+Every chapter is condensed into a short summary, consecutive chapters are merged into part
+summaries, and the parts before a chapter into a book summary. A new chapter gets the book
+summary and the chapter summaries of its own part as a "story so far" of bounded size, instead
+of the whole raw history. Summaries are cached with a hash of their source text in the artifact
+store, so only changed chapters and the parts and book summaries above them are summarized again.
+"""
+import json
+import hashlib
+import threading
+
+from source.prompttemplate import PromptTemplate
+
+
+class SummaryTree():
+    """ Chapter, part and book summaries, cached by the hash of their source text. """
+
+    FILE_NAME = "summarytree.json"
+
+    def __init__(self,
+                 store,
+                 chat_function,
+                 chapters_per_part: int = 4,
+                 chapter_words: int = 120,
+                 part_words: int = 200,
+                 book_words: int = 300):
+        """ Set up the tree and load the cached summaries.
+
+        Args:
+            store (FileArtifactStore | SQLiteArtifactStore): Artifact store of the book.
+            chat_function (callable): Sends messages to the LLM and returns the answer message,
+                e.g. the chat method of the OpenAIConnection.
+            chapters_per_part (int, optional): Number of chapters merged into a part.
+                Defaults to 4.
+            chapter_words (int, optional): Maximum words of a chapter summary. Defaults to 120.
+            part_words (int, optional): Maximum words of a part summary. Defaults to 200.
+            book_words (int, optional): Maximum words of a book summary. Defaults to 300.
+        """
+        self.store = store
+        self.chat_function = chat_function
+        self.chapters_per_part = chapters_per_part
+        self.chapter_words = chapter_words
+        self.part_words = part_words
+        self.book_words = book_words
+
+        self.lock = threading.RLock()
+        self.summaries = {"chapters": {}, "parts": {}, "books": {}}
+        if store.exists(self.FILE_NAME):
+            self.summaries.update(json.loads(store.read(self.FILE_NAME)))
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        """ Returns the hash a summary is cached with. """
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+    def summarize(self, level: str, key: int, source_text: str, template_id: str, words: int) -> str:
+        """ Returns the cached summary of a source text, or summarizes it if the text changed.
+
+        Args:
+            level (str): "chapters", "parts" or "books".
+            key (int): Index of the chapter or part, or number of parts of a book summary.
+            source_text (str): Text to summarize.
+            template_id (str): Prompt template of the summary.
+            words (int): Maximum words of the summary.
+
+        Returns:
+            str: The summary.
+        """
+        source_hash = self.text_hash(source_text)
+        with self.lock:
+            entry = self.summaries[level].get(str(key))
+            if entry is not None and entry["hash"] == source_hash:
+                return entry["summary"]
+
+        print(f"Summarizing {level[:-1]} {key}...")
+        prompt = PromptTemplate.get(template_id).format(words, source_text)
+        response_message = self.chat_function([{"role": "user", "content": prompt}])
+        summary = response_message["content"].strip()
+
+        with self.lock:
+            self.summaries[level][str(key)] = {"hash": source_hash, "summary": summary}
+            self.store.write(self.FILE_NAME, json.dumps(self.summaries, indent=4))
+        return summary
+
+    def update_chapter(self, chapter_index: int, chapter_text: str) -> str:
+        """ Summarizes a chapter, unless its text is unchanged.
+
+        Args:
+            chapter_index (int): Index of the chapter.
+            chapter_text (str): Text of the chapter.
+
+        Returns:
+            str: The chapter summary.
+        """
+        return self.summarize("chapters", chapter_index, chapter_text,
+                              "summarize_chapter", self.chapter_words)
+
+    def get_chapter_summaries(self, first_chapter: int, end_chapter: int) -> list:
+        """ Returns the summaries of the chapters in a range that are summarized already. """
+        with self.lock:
+            chapters = self.summaries["chapters"]
+            return [f"Chapter {chapter_index + 1}: {chapters[str(chapter_index)]['summary']}"
+                    for chapter_index in range(first_chapter, end_chapter)
+                    if str(chapter_index) in chapters]
+
+    def part_summary(self, part_index: int) -> str:
+        """ Returns the summary of a part, merged from the summaries of its chapters. """
+        first_chapter = part_index * self.chapters_per_part
+        chapter_summaries = self.get_chapter_summaries(first_chapter, first_chapter + self.chapters_per_part)
+        return self.summarize("parts", part_index, "\n\n".join(chapter_summaries),
+                              "summarize_story", self.part_words)
+
+    def story_so_far(self, before_chapter: int) -> str:
+        """ Returns the context of bounded size for a chapter: a summary of the parts before its
+            part, and the summaries of the earlier chapters of its part.
+
+        Args:
+            before_chapter (int): Index of the chapter that is about to be written.
+
+        Returns:
+            str: The story so far, or an empty string for the first chapter.
+        """
+        part_index = before_chapter // self.chapters_per_part
+        sections = []
+
+        if part_index > 0:
+            part_summaries = [f"Part {index + 1}: {self.part_summary(index)}" for index in range(part_index)]
+            if part_index == 1:
+                sections.append(part_summaries[0])
+            else:
+                sections.append(self.summarize("books", part_index, "\n\n".join(part_summaries),
+                                               "summarize_story", self.book_words))
+
+        sections += self.get_chapter_summaries(part_index * self.chapters_per_part, before_chapter)
+        return "\n\n".join(sections)
@@ -0,0 +1,92 @@
+""" Telemetry of the requests: latency distributions and counters, written to a JSON file. """
+import json
+import math
+import threading
+
+from source.artifactstore import write_file
+
+
+def percentile(values: list, q: float) -> float:
+    """ Returns the q-th percentile of a list of values (nearest rank).
+
+    Args:
+        values (list): The values.
+        q (float): Percentile between 0 and 100.
+
+    Returns:
+        float: The percentile, or 0.0 for an empty list.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Telemetry():
+    """ Collects latencies and counters of the backends. Thread-safe. """
+
+    def __init__(self, telemetry_path: str = None):
+        """ Set up empty telemetry.
+
+        Args:
+            telemetry_path (str, optional): JSON file to write the telemetry to. Defaults to None.
+        """
+        self.telemetry_path = telemetry_path
+        self.latencies = {}
+        self.counters = {}
+        self.sections = {}
+        self.lock = threading.Lock()
+
+    def record_latency(self, name: str, seconds: float):
+        """ Records the latency of a request, e.g. "openai.chat". """
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def increment(self, name: str, value: float = 1):
+        """ Increments a counter, e.g. the number of hedged requests. """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_section(self, name: str, values: dict):
+        """ Stores a section of values from another component, e.g. the HTTP pool metrics. """
+        with self.lock:
+            self.sections[name] = dict(values)
+
+    def latency_summary(self, name: str) -> dict:
+        """ Returns count, p50, p90, p99 and max of a latency in seconds. """
+        with self.lock:
+            values = list(self.latencies.get(name, []))
+        return {"count": len(values),
+                "p50": percentile(values, 50),
+                "p90": percentile(values, 90),
+                "p99": percentile(values, 99),
+                "max": max(values, default=0.0)}
+
+    def summary(self) -> dict:
+        """ Returns all latency summaries and counters. """
+        with self.lock:
+            names = list(self.latencies)
+            counters = dict(self.counters)
+            sections = dict(self.sections)
+        return {"latencies": {name: self.latency_summary(name) for name in names},
+                "counters": counters,
+                **sections}
+
+    def save(self):
+        """ Writes the summary to the telemetry file atomically. """
+        if self.telemetry_path is None:
+            return
+
+        write_file(self.telemetry_path, json.dumps(self.summary(), indent=4))
+
+    def format_summary(self) -> str:
+        """ Formats the latency summaries and counters as lines of text. """
+        summary = self.summary()
+        lines = [f"{name}: {latency['count']} requests, p50 {latency['p50']:.2f} s, "
+                 f"p99 {latency['p99']:.2f} s, max {latency['max']:.2f} s"
+                 for name, latency in summary["latencies"].items()]
+        lines += [f"{name}: {value}" for name, value in summary["counters"].items()]
+        for name in self.sections:
+            lines += [f"{name}.{key}: {value}" for key, value in summary[name].items()]
+        return "\n".join(lines)
@@ -0,0 +1,123 @@
+""" Process-wide HTTP transport for all OpenAI-using backends.
+OpenAIConnection, OpenAIAgents and the ChatOpenAI model of LCControl share one pooled
+httpx.Client, so that all backends and all books of a batch reuse the same keep-alive
+connections and TLS sessions. The pool is observed through the httpcore trace extension.
+"""
+import time
+import threading
+
+import httpx
+
+
+class PoolMetrics():
+    """ Counts the requests and connections of the pool and the time spent waiting for a
+        connection. Thread-safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.connect_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def tracer(self):
+        """ Returns a trace extension for a single request. The time from sending the request
+            until its headers go out, minus the time to open a new connection, is the time the
+            request waited for a free connection of the pool.
+        """
+        start_time = time.monotonic()
+        state = {"connect_started": None, "connect_seconds": 0.0}
+
+        def trace(event_name: str, info: dict):  # pylint: disable=unused-argument
+            now = time.monotonic()
+            if event_name in ("connection.connect_tcp.started", "connection.start_tls.started"):
+                state["connect_started"] = now
+
+            elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                state["connect_seconds"] += now - state["connect_started"]
+                if event_name == "connection.connect_tcp.complete":
+                    with self.lock:
+                        self.connections_opened += 1
+
+            elif event_name.endswith(".send_request_headers.started"):
+                wait_seconds = max(0.0, now - start_time - state["connect_seconds"])
+                with self.lock:
+                    self.requests += 1
+                    self.connect_seconds += state["connect_seconds"]
+                    self.wait_seconds += wait_seconds
+                    self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+        return trace
+
+    def summary(self, open_connections: int) -> dict:
+        """ Returns the metrics of the pool. """
+        with self.lock:
+            return {"open_connections": open_connections,
+                    "connections_opened": self.connections_opened,
+                    "requests": self.requests,
+                    "connect_seconds": round(self.connect_seconds, 3),
+                    "wait_seconds": round(self.wait_seconds, 3),
+                    "max_wait_seconds": round(self.max_wait_seconds, 3)}
+
+
+_lock = threading.Lock()
+_client = None
+_max_connections = 16
+_keepalive_expiry = 60.0
+_metrics = PoolMetrics()
+
+
+def configure(concurrency: int, keepalive_expiry: float = 60.0):
+    """ Sizes the pool to the configured concurrency. Has to be called before the first backend
+        is created, the pool of an existing client cannot be resized.
+
+    Args:
+        concurrency (int): Maximum number of parallel requests, e.g. the --workers setting.
+        keepalive_expiry (float, optional): Seconds an idle connection is kept open.
+            Defaults to 60.
+    """
+    global _max_connections, _keepalive_expiry  # pylint: disable=global-statement
+    with _lock:
+        # Hedged duplicates and the assistants' polling need a few connections on top.
+        max_connections = 2 * concurrency + 4
+        if _client is not None and max_connections > _max_connections:
+            print(f"HTTP pool already created with {_max_connections} connections. "
+                  f"Cannot grow it to {max_connections}.")
+            return
+        _max_connections = max(_max_connections, max_connections)
+        _keepalive_expiry = keepalive_expiry
+
+
+def get_http_client() -> httpx.Client:
+    """ Returns the process-wide HTTP client. It is created on first use. """
+    global _client  # pylint: disable=global-statement
+    with _lock:
+        if _client is None:
+            _client = httpx.Client(
+                limits=httpx.Limits(max_connections=_max_connections,
+                                    max_keepalive_connections=_max_connections,
+                                    keepalive_expiry=_keepalive_expiry),
+                # The default timeouts of the OpenAI client.
+                timeout=httpx.Timeout(600.0, connect=5.0),
+                event_hooks={"request": [_add_tracer]})
+        return _client
+
+
+def _add_tracer(request: httpx.Request):
+    """ Event hook that adds the trace extension to every request. """
+    request.extensions["trace"] = _metrics.tracer()
+
+
+def open_connections() -> int:
+    """ Returns the number of connections the pool currently holds. """
+    with _lock:
+        client = _client
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    return len(getattr(pool, "connections", []))
+
+
+def get_pool_metrics() -> dict:
+    """ Returns the metrics of the pool, e.g. for the telemetry. """
+    return _metrics.summary(open_connections())
@@ -0,0 +1,128 @@
+""" Ledger of the token usage and cost of all requests, aggregated per chain step and per model.
+All backends record into the same ledger, so that their throughput and cost can be compared.
+"""
+import json
+import threading
+
+from source.pricing import estimate_cost
+from source.artifactstore import write_file
+
+
+def new_usage() -> dict:
+    """ Returns an empty usage entry of a model. """
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+
+
+class UsageLedger():
+    """ Aggregates the usage of the requests per chain step and per model and writes it to a
+        JSON file. Thread-safe.
+    """
+
+    def __init__(self, ledger_path: str = None):
+        """ Set up an empty ledger.
+
+        Args:
+            ledger_path (str, optional): JSON file to write the ledger to. Defaults to None.
+        """
+        self.ledger_path = ledger_path
+        self.current_step = "Unassigned"
+        self.steps = {}
+        self.models = {}
+        # Reentrant, the totals are computed while a record holds the lock.
+        self.lock = threading.RLock()
+        self.thread_steps = threading.local()
+
+    def set_step(self, step_name: str, thread_local: bool = False):
+        """ Sets the chain step that the following requests are charged to.
+
+        Args:
+            step_name (str): Name of the step.
+            thread_local (bool, optional): Only set the step for requests of the calling thread,
+                e.g. for steps that run concurrently. Defaults to False.
+        """
+        if thread_local:
+            self.thread_steps.step_name = step_name
+        else:
+            self.current_step = step_name
+
+    def record(self, model: str, prompt_tokens: int, completion_tokens: int,
+               backend: str, estimated: bool = False):
+        """ Records the usage of a single request for the current step.
+
+        Args:
+            model (str): Model that answered the request.
+            prompt_tokens (int): Number of prompt tokens.
+            completion_tokens (int): Number of completion tokens.
+            backend (str): Backend that sent the request, e.g. "openai", "assistants" or "langchain".
+            estimated (bool, optional): Whether the numbers are estimates instead of reported
+                usage. Defaults to False.
+        """
+        step_name = getattr(self.thread_steps, "step_name", self.current_step)
+        cost = estimate_cost(model, prompt_tokens, completion_tokens)
+        with self.lock:
+            step = self.steps.setdefault(step_name, {"calls": 0,
+                                                        "estimated_calls": 0,
+                                                        "prompt_tokens": 0,
+                                                        "completion_tokens": 0,
+                                                        "cost": 0.0,
+                                                        "backends": [],
+                                                        "models": {}})
+            step["calls"] += 1
+            step["estimated_calls"] += 1 if estimated else 0
+            step["prompt_tokens"] += prompt_tokens
+            step["completion_tokens"] += completion_tokens
+            step["cost"] += cost
+            if backend not in step["backends"]:
+                step["backends"].append(backend)
+
+            for usage in (step["models"].setdefault(model, new_usage()),
+                          self.models.setdefault(model, new_usage())):
+                usage["calls"] += 1
+                usage["prompt_tokens"] += prompt_tokens
+                usage["completion_tokens"] += completion_tokens
+                usage["cost"] += cost
+
+            self.save()
+
+    def total_tokens(self) -> int:
+        """ Returns the number of tokens of all recorded requests. """
+        with self.lock:
+            return sum(step["prompt_tokens"] + step["completion_tokens"] for step in self.steps.values())
+
+    def total_cost(self) -> float:
+        """ Returns the cost of all recorded requests in US dollars. """
+        with self.lock:
+            return sum(step["cost"] for step in self.steps.values())
+
+    def snapshot(self) -> dict:
+        """ Returns a copy of the usage per step and per model and the totals. """
+        with self.lock:
+            return json.loads(json.dumps({"steps": self.steps,
+                                          "models": self.models,
+                                          "total_tokens": self.total_tokens(),
+                                          "total_cost": self.total_cost()}))
+
+    def save(self):
+        """ Writes the ledger to its JSON file atomically. """
+        if self.ledger_path is None:
+            return
+
+        with self.lock:
+            write_file(self.ledger_path, json.dumps(self.snapshot(), indent=4))
+
+    def format_summary(self) -> str:
+        """ Formats the usage per step as lines of text. """
+        lines = []
+        snapshot = self.snapshot()
+        for step_name, step in snapshot["steps"].items():
+            estimated = f", {step['estimated_calls']} estimated" if step["estimated_calls"] else ""
+            lines.append(f"{step_name}: {step['calls']} calls{estimated}, "
+                         f"{step['prompt_tokens']} prompt tokens, "
+                         f"{step['completion_tokens']} completion tokens, "
+                         f"${step['cost']:.2f}")
+        for model, usage in snapshot["models"].items():
+            lines.append(f"{model}: {usage['calls']} calls, "
+                         f"{usage['prompt_tokens'] + usage['completion_tokens']} tokens, "
+                         f"${usage['cost']:.2f}")
+        lines.append(f"Total cost: ${snapshot['total_cost']:.2f}")
+        return "\n".join(lines)
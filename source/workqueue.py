@@ -0,0 +1,232 @@
+""" Lease-based work queue on a shared filesystem.
+Work units are small JSON files that move between directories by atomic renames:
+pending/ -> leased/ -> done/, or failed/ after too many attempts. A worker owns a unit while
+the rename into leased/ succeeded and keeps the lease alive by touching the file. Leases that
+are not renewed expire, e.g. when the worker died, and the unit is pending again. Any number of
+processes on any number of hosts can work on the same queue directory.
+Units may run more than once, so running a unit has to be idempotent. The book units are,
+because every unit skips an artifact that exists already and writes its artifact atomically.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+import traceback
+
+
+class WorkQueue():
+    """ Queue of work units in a directory. """
+
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, queue_path: str, lease_seconds: float = 60.0, max_attempts: int = 3):
+        """ Set up the queue directories.
+
+        Args:
+            queue_path (str): Directory of the queue, on a filesystem shared by all workers.
+            lease_seconds (float, optional): Seconds after which a lease that is not renewed
+                expires. Defaults to 60.
+            max_attempts (int, optional): Number of failed attempts after which a unit is
+                moved to failed/. Defaults to 3.
+        """
+        self.queue_path = queue_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for state in (self.PENDING, self.LEASED, self.DONE, self.FAILED):
+            os.makedirs(os.path.join(queue_path, state), exist_ok=True)
+
+    def path(self, state: str, unit_name: str) -> str:
+        """ Returns the path of a unit in a state. """
+        return os.path.join(self.queue_path, state, unit_name)
+
+    def names(self, state: str) -> list:
+        """ Returns the sorted names of the units in a state. """
+        return sorted(name for name in os.listdir(os.path.join(self.queue_path, state))
+                      if name.endswith(".json"))
+
+    @staticmethod
+    def unit_name(unit: dict) -> str:
+        """ Returns the file name of a unit. Units sort by priority, so that books are finished
+            depth first, and the same unit always has the same name.
+        """
+        book_id = hashlib.sha1(unit["book_path"].encode("utf-8")).hexdigest()[:10]
+        chapter = unit.get("chapter")
+        chapter_part = f"{chapter:04d}" if chapter is not None else "book"
+        return f"{unit.get('priority', 5)}_{book_id}_{unit['stage']}_{chapter_part}.json"
+
+    def write_unit(self, state: str, unit: dict):
+        """ Writes a unit atomically into a state. """
+        unit_path = self.path(state, self.unit_name(unit))
+        temp_path = f"{unit_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(unit, f, indent=4)
+        os.replace(temp_path, unit_path)
+
+    def enqueue(self, unit: dict) -> bool:
+        """ Adds a unit, unless it is queued, leased or done already.
+
+        Args:
+            unit (dict): The unit, with at least "book_path" and "stage".
+
+        Returns:
+            bool: Whether the unit was added.
+        """
+        unit_name = self.unit_name(unit)
+        if any(os.path.exists(self.path(state, unit_name))
+               for state in (self.PENDING, self.LEASED, self.DONE)):
+            return False
+        self.write_unit(self.PENDING, dict(unit, attempts=unit.get("attempts", 0)))
+        return True
+
+    def reclaim_expired(self) -> int:
+        """ Moves units whose lease expired back to pending.
+
+        Returns:
+            int: Number of reclaimed units.
+        """
+        reclaimed = 0
+        now = time.time()
+        for unit_name in self.names(self.LEASED):
+            try:
+                if now - os.path.getmtime(self.path(self.LEASED, unit_name)) < self.lease_seconds:
+                    continue
+                os.rename(self.path(self.LEASED, unit_name), self.path(self.PENDING, unit_name))
+                reclaimed += 1
+                print(f"Lease of {unit_name} expired. Queued again.")
+            except FileNotFoundError:
+                # Completed or reclaimed by another worker in the meantime.
+                continue
+        return reclaimed
+
+    def claim(self):
+        """ Leases the first pending unit.
+
+        Returns:
+            tuple | None: Name and content of the unit, or None if no unit is pending.
+        """
+        self.reclaim_expired()
+        for unit_name in self.names(self.PENDING):
+            leased_path = self.path(self.LEASED, unit_name)
+            try:
+                # Start the lease before the rename, a rename keeps the old modification time.
+                # Only one worker wins the rename.
+                os.utime(self.path(self.PENDING, unit_name))
+                os.rename(self.path(self.PENDING, unit_name), leased_path)
+            except FileNotFoundError:
+                continue
+            with open(leased_path, "r", encoding="utf-8") as f:
+                return unit_name, json.load(f)
+        return None
+
+    def renew(self, unit_name: str) -> bool:
+        """ Renews the lease of a unit.
+
+        Returns:
+            bool: Whether the unit is still leased.
+        """
+        try:
+            os.utime(self.path(self.LEASED, unit_name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, unit_name: str) -> bool:
+        """ Marks a leased unit as done.
+
+        Returns:
+            bool: Whether the lease was still held. If not, the unit was reclaimed by another
+                worker, which will find its artifact and complete it.
+        """
+        try:
+            os.rename(self.path(self.LEASED, unit_name), self.path(self.DONE, unit_name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def fail(self, unit_name: str, unit: dict, error: str):
+        """ Queues a failed unit again, or moves it to failed/ after too many attempts. """
+        unit = dict(unit, attempts=unit.get("attempts", 0) + 1, error=error)
+        state = self.FAILED if unit["attempts"] >= self.max_attempts else self.PENDING
+        self.write_unit(state, unit)
+        try:
+            os.remove(self.path(self.LEASED, unit_name))
+        except FileNotFoundError:
+            pass
+
+    def is_drained(self) -> bool:
+        """ Returns whether no unit is pending or leased. """
+        return not self.names(self.PENDING) and not self.names(self.LEASED)
+
+
+class QueueWorker():
+    """ Claims units of a queue and runs them until the queue is drained. """
+
+    def __init__(self, queue: WorkQueue, run_unit, poll_interval: float = 2.0):
+        """ Set up the worker.
+
+        Args:
+            queue (WorkQueue): The queue.
+            run_unit (callable): Runs a unit with the id of the worker, e.g. to keep a connection
+                per worker, and returns the units that follow from it.
+            poll_interval (float, optional): Seconds to wait while other workers hold all
+                units. Defaults to 2.
+        """
+        self.queue = queue
+        self.run_unit = run_unit
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.completed = 0
+
+    def run(self, exit_when_drained: bool = True):
+        """ Runs units until the queue is drained.
+
+        Args:
+            exit_when_drained (bool, optional): Whether to return once no unit is pending or
+                leased. Otherwise waits for new units forever. Defaults to True.
+        """
+        print(f"Worker {self.worker_id} started on {self.queue.queue_path}")
+        while True:
+            claimed = self.queue.claim()
+            if claimed is None:
+                if exit_when_drained and self.queue.is_drained():
+                    break
+                time.sleep(self.poll_interval)
+                continue
+            self.run_leased(*claimed)
+        print(f"Worker {self.worker_id} finished {self.completed} units.")
+
+    def run_leased(self, unit_name: str, unit: dict):
+        """ Runs a leased unit while a heartbeat thread renews its lease. """
+        print(f"Worker {self.worker_id} running {unit_name}")
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            while not stop_heartbeat.wait(self.queue.lease_seconds / 3):
+                if not self.queue.renew(unit_name):
+                    print(f"Lost the lease of {unit_name}.")
+                    return
+
+        heartbeat_thread = threading.Thread(target=heartbeat, name="WorkQueueHeartbeat", daemon=True)
+        heartbeat_thread.start()
+        try:
+            next_units = self.run_unit(unit, self.worker_id)
+        except Exception as e:  # pylint: disable=broad-except
+            traceback.print_exc()
+            self.queue.fail(unit_name, unit, f"{type(e).__name__}: {e}")
+            return
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+
+        # Queue the follow-up units before completing, so that a crash in between only
+        # repeats this unit.
+        for next_unit in next_units or []:
+            self.queue.enqueue(next_unit)
+        if self.queue.complete(unit_name):
+            self.completed += 1
@@ -0,0 +1,69 @@
+""" Synthetic inputs for the micro-benchmarks of the local hot paths, sized like a book written
+with a 32k context: a conversation history of about 32k tokens and a book of 24 chapters.
+
+The benchmarks need pytest-benchmark, which is not in requirements.txt, and are skipped without
+it (pip install pytest-benchmark, see the README). Save a baseline and compare later runs against it:
+
+    python -m pytest tests/benchmarks --benchmark-only --benchmark-autosave
+    python -m pytest tests/benchmarks --benchmark-only --benchmark-compare --benchmark-compare-fail=mean:15%
+
+Run the regular tests without the benchmarks with --benchmark-skip.
+"""
+import os
+import random
+
+import pytest
+
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# About 0.75 words per token.
+CONTEXT_WORDS = 24000
+CHAPTERS = 24
+CHAPTER_WORDS = 4000
+
+
+def make_text(rng: random.Random, words: int) -> str:
+    """ Returns deterministic prose-like text of a number of words in paragraphs. """
+    vocabulary = ["the", "keeper", "lighthouse", "climbed", "stairs", "night", "waves", "ship",
+                  "harbor", "storm", "letter", "brother", "secret", "lantern", "island", "fog",
+                  "remembered", "quietly", "against", "whispered", "before", "morning", "rope"]
+    paragraphs = []
+    for start in range(0, words, 120):
+        sentence_words = [rng.choice(vocabulary) for _ in range(min(120, words - start))]
+        paragraphs.append(" ".join(sentence_words).capitalize() + ".")
+    return "\n\n".join(paragraphs)
+
+
+@pytest.fixture(scope="session")
+def history():
+    """ A conversation history of about 32k tokens, as sent with a late chapter. """
+    rng = random.Random(0)
+    messages = [{"role": "system", "content": make_text(rng, 200)}]
+    while sum(len(message["content"].split()) for message in messages) < CONTEXT_WORDS:
+        messages.append({"role": "user", "content": make_text(rng, 150)})
+        messages.append({"role": "assistant", "content": make_text(rng, 600)})
+    return messages
+
+
+@pytest.fixture
+def repository(monkeypatch):
+    """ Runs the benchmark in the repository, where the prompt templates and steps are found. """
+    monkeypatch.chdir(REPOSITORY_PATH)
+    return REPOSITORY_PATH
+
+
+@pytest.fixture
+def book_path(tmp_path):
+    """ A book with titles, table of contents and all chapters written. """
+    rng = random.Random(1)
+    output_path = tmp_path / "output"
+    output_path.mkdir()
+    (tmp_path / "description.txt").write_text(make_text(rng, 100), encoding="utf-8")
+    (output_path / "status.json").write_text("{}", encoding="utf-8")
+    (output_path / "book_titles.txt").write_text("1. The Keeper\n2. The Harbor", encoding="utf-8")
+    (output_path / "toc.txt").write_text(
+        "\n".join(f"{chapter + 1}. Chapter {chapter + 1}" for chapter in range(CHAPTERS)), encoding="utf-8")
+    for chapter in range(CHAPTERS):
+        (output_path / f"chapterfull_{chapter}.txt").write_text(make_text(rng, CHAPTER_WORDS), encoding="utf-8")
+    return str(tmp_path)
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from source.tokencounter import TokenCounter
+from source.prompttemplate import PromptTemplate
+from source.writelogs import WriteLogs
+from source.project import Project
+from source.bookchainelements import JoinBook
+
+
+# Fixed rounds after a warm-up, so that runs are comparable with the saved baseline.
+ROUNDS = 20
+WARMUP_ROUNDS = 2
+
+
+def run(benchmark, function, *args):
+    return benchmark.pedantic(function, args=args, rounds=ROUNDS, warmup_rounds=WARMUP_ROUNDS)
+
+
+def test_num_tokens_from_messages(benchmark, history):
+    token_counter = TokenCounter()
+    try:
+        token_counter.num_tokens_from_string("warm up", "gpt-3.5-turbo")
+    except Exception as exc:
+        pytest.skip(f"The tiktoken encoding is not available: {exc}")
+
+    num_tokens = run(benchmark, token_counter.num_tokens_from_messages, history, "gpt-3.5-turbo")
+    benchmark.extra_info["tokens"] = num_tokens
+    assert num_tokens > 25000
+
+
+def test_prompt_template_get(benchmark, repository):
+    template = run(benchmark, PromptTemplate.get, "write_chapter_line")
+    assert "{}" in template
+
+
+def test_write_messages(benchmark, history, tmp_path):
+    logger = WriteLogs(str(tmp_path), logging=True)
+    run(benchmark, logger.write_messages, history, 32000, "Chapter 24")
+    assert os.path.getsize(tmp_path / "messages.txt") > 100000
+
+
+def test_project_write_json(benchmark, history, book_path, repository, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "benchmark")
+    project = Project(book_path)
+    run(benchmark, project.write_json, project.progress_file_path, {"progress": history})
+    assert project.read_json(project.progress_file_path)["progress"] == history
+
+
+def test_join_book(benchmark, book_path):
+    join_book = JoinBook(book_path)
+
+    # JoinBook skips a book that is joined already, so every round starts without it.
+    def remove_full_book():
+        if join_book.store.exists("fullbook.md"):
+            join_book.store.delete("fullbook.md")
+
+    benchmark.pedantic(join_book.step, args=(None,), setup=remove_full_book,
+                       rounds=ROUNDS, warmup_rounds=WARMUP_ROUNDS)
+    fullbook = join_book.store.read("fullbook.md")
+    assert fullbook.startswith("# The Keeper")
+    chapter_names = join_book.get_chapter_names()
+    assert len(chapter_names) == 24
+    for chapter_name in chapter_names:
+        assert join_book.store.read(chapter_name) in fullbook
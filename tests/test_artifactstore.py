@@ -0,0 +1,69 @@
+import multiprocessing
+
+from source.artifactstore import (FileArtifactStore, SQLiteArtifactStore, DATABASE_NAME,
+                                  parse_artifact_name, open_artifact_store)
+
+
+def test_parse_artifact_name():
+    assert parse_artifact_name("chapteroutline_3.txt") == ("chapteroutline", 3)
+    assert parse_artifact_name("book_titles.json") == ("book_titles", None)
+    assert parse_artifact_name("toc.txt") == ("toc", None)
+
+
+def test_import_lookup_and_export(tmp_path):
+    file_store = FileArtifactStore(str(tmp_path / "output"))
+    (tmp_path / "output").mkdir()
+    for chapter_index in (10, 2, 1):
+        file_store.write(f"chapter_{chapter_index}.txt", f"Summary {chapter_index}")
+    file_store.write("toc.txt", "1. One")
+    (tmp_path / "output" / "usage.json").write_text("{}")
+
+    store = SQLiteArtifactStore(str(tmp_path / "output" / DATABASE_NAME))
+    assert store.import_files(str(tmp_path / "output")) == 4
+    assert store.names("chapter") == ["chapter_1.txt", "chapter_2.txt", "chapter_10.txt"]
+    assert not store.exists("usage.json")
+
+    store.write("chapter_2.txt", "New summary")
+    assert store.export(str(tmp_path / "export")) == 4
+    assert FileArtifactStore(str(tmp_path / "export")).read("chapter_2.txt") == "New summary"
+
+
+def add_chapters(database_path, worker_index, count):
+    store = SQLiteArtifactStore(database_path)
+    for chapter_index in range(count):
+        store.write(f"chapterfull_{worker_index * count + chapter_index}.txt", "text")
+
+        # Read-modify-write of a shared artifact, like the status of the project.
+        with store.transaction():
+            counter = int(store.read("status.json")) if store.exists("status.json") else 0
+            store.write("status.json", str(counter + 1))
+
+
+def test_concurrent_writers(tmp_path):
+    database_path = str(tmp_path / DATABASE_NAME)
+    SQLiteArtifactStore(database_path)
+
+    processes = [multiprocessing.Process(target=add_chapters, args=(database_path, worker_index, 25))
+                 for worker_index in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    store = SQLiteArtifactStore(database_path)
+    assert len(store.names("chapterfull")) == 100
+    assert store.read("status.json") == "100"
+
+
+def test_books_with_a_database_always_use_it(tmp_path):
+    output_path = str(tmp_path / "output")
+    (tmp_path / "output").mkdir()
+    assert isinstance(open_artifact_store(output_path), FileArtifactStore)
+
+    # Another process switches the book to SQLite.
+    SQLiteArtifactStore(str(tmp_path / "output" / DATABASE_NAME)).write("toc.txt", "1. One")
+
+    store = open_artifact_store(output_path)
+    assert isinstance(store, SQLiteArtifactStore)
+    assert store.read("toc.txt") == "1. One"
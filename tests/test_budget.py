@@ -0,0 +1,32 @@
+import pytest
+
+from source.budget import Budget, BudgetExceeded
+
+
+def count_words(messages, model):
+    return sum(len(message["content"].split()) for message in messages)
+
+
+def test_remaining_completion_tokens_of_token_budget():
+    budget = Budget(max_tokens=10_000)
+    budget.charge("gpt-3.5-turbo-16k", 3_000, 1_000)
+    assert budget.remaining_completion_tokens("gpt-3.5-turbo-16k", 2_000) == 4_000
+    assert budget.remaining_completion_tokens("gpt-3.5-turbo-16k", 8_000) == 0
+
+
+def test_remaining_completion_tokens_of_cost_budget():
+    # gpt-4: $0.03 per 1000 prompt tokens, $0.06 per 1000 completion tokens.
+    budget = Budget(max_cost=1.0)
+    assert budget.remaining_completion_tokens("gpt-4", 10_000) == 11_666
+    assert budget.remaining_completion_tokens("local-model", 10_000) is None
+    assert Budget().remaining_completion_tokens("gpt-4", 10_000) is None
+
+
+def test_request_without_room_for_the_completion_is_refused():
+    budget = Budget(max_tokens=1_000, min_completion_tokens=256)
+    messages = [{"role": "user", "content": "word " * 800}]
+    with pytest.raises(BudgetExceeded):
+        budget.adjust("gpt-3.5-turbo-16k", messages, count_words)
+
+    messages = [{"role": "user", "content": "word " * 500}]
+    assert budget.adjust("gpt-3.5-turbo-16k", messages, count_words) == ("gpt-3.5-turbo-16k", messages)
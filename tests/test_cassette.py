@@ -0,0 +1,64 @@
+import pytest
+
+from source.cassette import Cassette, CassetteMiss, cassette_call
+
+
+def test_record_and_replay_in_order(tmp_path):
+    cassette_path = str(tmp_path / Cassette.FILE_NAME)
+    answers = iter(["first", "second"])
+
+    cassette = Cassette(cassette_path, Cassette.RECORD)
+    request = {"model": "gpt-4", "messages": [{"role": "user", "content": "Hello"}]}
+    assert cassette.call("openai", "chat", request, lambda: next(answers)) == "first"
+    assert cassette.call("openai", "chat", request, lambda: next(answers)) == "second"
+    cassette.close()
+
+    def offline():
+        raise AssertionError("Replay must not send requests.")
+
+    cassette = Cassette(cassette_path, Cassette.REPLAY)
+    assert cassette.call("openai", "chat", request, offline) == "first"
+    assert cassette.call("openai", "chat", request, offline) == "second"
+    with pytest.raises(CassetteMiss):
+        cassette.call("openai", "chat", request, offline)
+
+
+def test_replay_decodes_and_misses_unknown_requests(tmp_path):
+    cassette_path = str(tmp_path / Cassette.FILE_NAME)
+
+    cassette = Cassette(cassette_path, Cassette.RECORD)
+    cassette.call("langchain", "query", {"message": "a"}, lambda: {"reply": "b"},
+                  encode=lambda response: response["reply"])
+    cassette.close()
+
+    cassette = Cassette(cassette_path, Cassette.REPLAY, realtime=True)
+    assert cassette.call("langchain", "query", {"message": "a"}, None,
+                         decode=lambda reply: {"reply": reply}) == {"reply": "b"}
+    with pytest.raises(CassetteMiss):
+        cassette.call("langchain", "query", {"message": "other"}, None)
+
+
+def test_cassette_call_without_cassette():
+    assert cassette_call(None, "openai", "chat", {}, lambda: 42) == 42
+
+
+def test_recording_a_resumed_run_keeps_earlier_exchanges(tmp_path):
+    cassette_path = str(tmp_path / Cassette.FILE_NAME)
+
+    cassette = Cassette(cassette_path, Cassette.RECORD)
+    cassette.call("openai", "chat", {"content": "first"}, lambda: "one")
+    cassette.close()
+
+    # The resumed run crashes while the second exchange is being recorded.
+    cassette = Cassette(cassette_path, Cassette.RECORD)
+    cassette.call("openai", "chat", {"content": "second"}, lambda: "two")
+    cassette.file.write('{"key": "interrupted')
+    cassette.file.flush()
+
+    cassette = Cassette(cassette_path, Cassette.RECORD)
+    cassette.call("openai", "chat", {"content": "third"}, lambda: "three")
+    cassette.close()
+
+    cassette = Cassette(cassette_path, Cassette.REPLAY)
+    for content, answer in [("first", "one"), ("second", "two"), ("third", "three")]:
+        assert cassette.call("openai", "chat", {"content": content}, None) == answer
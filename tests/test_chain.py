@@ -0,0 +1,35 @@
+from source.chain import ChainExecutor, BaseChainElement, COMPLETED, BUDGET_EXHAUSTED, CANCELLED
+from source.budget import BudgetExceeded
+from source.project import JobCancelled
+
+
+class Element(BaseChainElement):
+
+    def __init__(self, error=None):
+        self.error = error
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    def step(self, llm_connection):
+        if self.error is not None:
+            raise self.error
+        self.done = True
+
+
+def run(*elements):
+    chain_executor = ChainExecutor(llm_connection=None)
+    for element in elements:
+        chain_executor.add_element(element)
+    return chain_executor.run()
+
+
+def test_run_reports_why_it_stopped():
+    assert run(Element(), Element()) == COMPLETED
+
+    last = Element()
+    assert run(Element(BudgetExceeded("used up")), last) == BUDGET_EXHAUSTED
+    assert not last.done
+
+    assert run(Element(), Element(JobCancelled("cancelled"))) == CANCELLED
@@ -0,0 +1,105 @@
+from source.concurrency import AdaptiveConcurrencyLimiter
+from source.telemetry import Telemetry
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run_window(limiter, clock, latency_of):
+    # Sends a window of requests in batches of the current limit. A batch takes the latency
+    # the server answers that many parallel requests with.
+    remaining = limiter.window
+    while remaining > 0:
+        batch = min(limiter.limit, remaining)
+        for _ in range(batch):
+            limiter.acquire()
+        latency = latency_of(batch)
+        clock.now += latency
+        for _ in range(batch):
+            limiter.release(latency)
+        remaining -= batch
+
+
+def test_limit_settles_around_the_sweet_spot():
+    # Four cores: more parallel requests share them and take longer.
+    def latency_of(parallel):
+        return max(1.0, parallel / 4)
+
+    clock = FakeClock()
+    telemetry = Telemetry()
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_limit=16, window=8,
+                                         telemetry=telemetry, clock=clock)
+    limits = []
+    for _ in range(30):
+        run_window(limiter, clock, latency_of)
+        limits.append(limiter.limit)
+
+    # Grows while the throughput rises, is halved once the latency degrades past the sweet
+    # spot of four, and repeats that cycle.
+    assert limits[:4] == [2, 3, 4, 5]
+    assert limits[7:9] == [7, 3]
+    assert limits[8:16] == limits[16:24]
+    assert min(limits[4:]) == 3 and max(limits) == 7
+
+    snapshot = telemetry.summary()["local_concurrency"]
+    assert snapshot == limiter.snapshot()
+    assert snapshot["increases"] > 0 and snapshot["decreases"] > 0
+    assert snapshot["best_latency"] == 1.0
+    assert snapshot["in_flight"] == 0
+
+
+def test_limit_is_not_raised_when_the_throughput_drops():
+    clock = FakeClock()
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, window=4, clock=clock)
+    run_window(limiter, clock, lambda parallel: 1.0)
+    assert limiter.limit == 3
+    # Same latency per request, but the window takes three times as long, e.g. the server is
+    # busy with other clients between the requests.
+    for batch in (3, 1):
+        for _ in range(batch):
+            limiter.acquire()
+        clock.now += 3.0
+        for _ in range(batch):
+            limiter.release(1.0)
+    assert limiter.limit == 3
+    assert limiter.snapshot()["increases"] == 1
+    assert limiter.snapshot()["decreases"] == 0
+
+
+def test_latency_degradation_halves_the_limit():
+    clock = FakeClock()
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8, window=4, clock=clock)
+    for latency in (1.0, 2.0):
+        for _ in range(4):
+            limiter.acquire()
+        clock.now += latency
+        for _ in range(4):
+            limiter.release(latency)
+    assert limiter.limit == 4
+    assert limiter.snapshot()["decreases"] == 1
+
+
+def test_errors_cut_the_limit():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8, window=4, clock=FakeClock())
+    for _ in range(4):
+        limiter.acquire()
+    for _ in range(3):
+        limiter.release(0.1)
+    limiter.release(0.1, error=True)
+    assert limiter.limit == 4
+    assert limiter.snapshot()["decreases"] == 1
+
+
+def test_slot_measures_latency_per_token_with_the_clock():
+    clock = FakeClock()
+    limiter = AdaptiveConcurrencyLimiter(window=1, clock=clock)
+    with limiter.slot() as request:
+        clock.now += 2.0
+        request["tokens"] = 100
+    assert limiter.snapshot()["latency"] == 0.02
+    assert limiter.snapshot()["tokens_per_second"] == 50.0
@@ -0,0 +1,15 @@
+from source.openaiconnection import stitch_continuation
+
+
+def test_overlap_is_removed():
+    text = "The keeper climbed the spiral stairs and looked"
+    continuation = "the spiral stairs and looked out at the grey sea."
+    assert stitch_continuation(text, continuation) == (
+        "The keeper climbed the spiral stairs and looked out at the grey sea.")
+
+
+def test_continuation_without_overlap_is_appended():
+    assert stitch_continuation("The keeper climbed the st", "airs.") == "The keeper climbed the stairs."
+    assert stitch_continuation("First paragraph.", "\n\nSecond paragraph.") == (
+        "First paragraph.\n\nSecond paragraph.")
+
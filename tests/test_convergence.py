@@ -0,0 +1,36 @@
+from source.convergence import ConvergenceDetector
+from source.embeddingindex import HashingEmbedder
+
+
+DRAFT = ("A lighthouse keeper finds a map hidden in the logbook of her predecessor. "
+         "She follows it to an island that does not appear on any chart.")
+
+
+def test_identical_drafts_converge():
+    detector = ConvergenceDetector(threshold=0.05)
+    assert detector.change(DRAFT, DRAFT) == 0.0
+    assert detector.converged(DRAFT, DRAFT)
+
+
+def test_small_edit_converges_and_rewrite_does_not():
+    detector = ConvergenceDetector(threshold=0.1)
+    assert detector.converged(DRAFT, DRAFT.replace("hidden", "concealed"))
+
+    detector = ConvergenceDetector(threshold=0.1)
+    rewrite = "Two rival merchants race across the desert to reach a city that vanishes at dawn."
+    assert not detector.converged(DRAFT, rewrite)
+
+
+def test_min_iterations_and_report():
+    detector = ConvergenceDetector(threshold=0.05, min_iterations=2)
+    assert not detector.converged(DRAFT, DRAFT)
+    assert detector.converged(DRAFT, DRAFT)
+    assert detector.format_report(5) == "Converged after 2/5 iterations, saved 3"
+    # A resumed loop counts the iterations of the earlier run too.
+    assert detector.format_report(5, 4) == "Converged after 4/5 iterations, saved 1"
+
+
+def test_embedding_change():
+    detector = ConvergenceDetector(threshold=0.05, embed_function=HashingEmbedder().embed)
+    assert detector.change(DRAFT, DRAFT) < 1e-6
+    assert detector.change(DRAFT, "Completely unrelated words about cooking pasta.") > 0.5
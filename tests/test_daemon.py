@@ -0,0 +1,70 @@
+import json
+import time
+import threading
+import urllib.request
+
+from source import chain
+from source.daemon import BookDaemon, JobQueue, RUNNING, QUEUED
+
+
+def request(daemon, method, path, body=None):
+    host, port = daemon.server.server_address[:2]
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    http_request = urllib.request.Request(f"http://{host}:{port}{path}", data=data, method=method)
+    with urllib.request.urlopen(http_request) as response:
+        return json.loads(response.read())
+
+
+def wait_for_status(daemon, job_id, status):
+    for _ in range(200):
+        job = request(daemon, "GET", f"/jobs/{job_id}")
+        if job["status"] == status:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"Job {job_id} did not reach {status}.")
+
+
+def test_submit_run_and_cancel(tmp_path):
+    for book in ("first", "second", "third"):
+        (tmp_path / book).mkdir()
+        (tmp_path / book / "description.txt").write_text("A book.")
+
+    written = []
+
+    def run_job(book_path, cancel_event, chapters=1):
+        if book_path.endswith("second"):
+            cancel_event.wait(timeout=10)
+            return chain.CANCELLED
+        if book_path.endswith("third"):
+            return chain.BUDGET_EXHAUSTED
+        written.append((book_path, chapters))
+        return chain.COMPLETED
+
+    daemon = BookDaemon(run_job, str(tmp_path / "queue.json"), concurrency=2, port=0)
+    daemon.start()
+    try:
+        threading.Thread(target=daemon.server.serve_forever, daemon=True).start()
+
+        job = request(daemon, "POST", "/jobs", {"book_path": str(tmp_path / "first"),
+                                                "options": {"chapters": 3}})
+        wait_for_status(daemon, job["id"], "done")
+        assert written == [(str(tmp_path / "first"), 3)]
+
+        job = request(daemon, "POST", "/jobs", {"book_path": str(tmp_path / "second")})
+        wait_for_status(daemon, job["id"], "running")
+        request(daemon, "DELETE", f"/jobs/{job['id']}")
+        wait_for_status(daemon, job["id"], "cancelled")
+
+        job = request(daemon, "POST", "/jobs", {"book_path": str(tmp_path / "third")})
+        wait_for_status(daemon, job["id"], "budget_exhausted")
+    finally:
+        daemon.server.shutdown()
+        daemon.shutdown()
+
+
+def test_running_jobs_are_queued_again(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.json"))
+    job = queue.submit(str(tmp_path), {})
+    queue.update(job["id"], status=RUNNING)
+
+    assert JobQueue(str(tmp_path / "queue.json")).get(job["id"])["status"] == QUEUED
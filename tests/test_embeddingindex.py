@@ -0,0 +1,91 @@
+import pytest
+
+from source.embeddingindex import EmbeddingIndex, HashingEmbedder, split_paragraphs
+
+
+class CountingEmbedder(HashingEmbedder):
+
+    def __init__(self):
+        super().__init__(dimensions=128)
+        self.calls = []
+
+    def embed(self, texts):
+        self.calls.append(list(texts))
+        return super().embed(texts)
+
+
+@pytest.fixture
+def embedder():
+    return CountingEmbedder()
+
+
+def test_add_deduplicates_and_batches(tmp_path, embedder):
+    index = EmbeddingIndex(str(tmp_path), embedder.embed, batch_size=2)
+
+    added = index.add(["a dragon", "a castle", "a dragon", "a knight", "a ship"], kind="chapter", chapter=0)
+
+    assert added == 4
+    assert len(index) == 4
+    assert [len(batch) for batch in embedder.calls] == [2, 2]
+
+    # Texts that are already indexed are not embedded again.
+    assert index.add(["a castle", "a knight"], kind="chapter", chapter=0) == 0
+    assert len(embedder.calls) == 2
+
+
+def test_search_returns_most_similar_passages(tmp_path, embedder):
+    index = EmbeddingIndex(str(tmp_path), embedder.embed)
+    index.add_document("The dragon burned the northern village.\n\n"
+                       "The queen signed a treaty with the merchants.\n\n"
+                       "Sailors repaired the broken mast of the ship.",
+                       kind="chapter", chapter=0)
+
+    results = index.search("Why did the dragon burn the village?", k=2)
+
+    assert len(results) == 2
+    assert results[0]["text"] == "The dragon burned the northern village."
+    assert results[0]["score"] >= results[1]["score"]
+
+
+def test_search_filters_by_kind_and_chapter(tmp_path, embedder):
+    index = EmbeddingIndex(str(tmp_path), embedder.embed)
+    index.add(["The dragon attacks."], kind="summary", chapter=0)
+    index.add(["The dragon sleeps."], kind="chapter", chapter=1)
+    index.add(["The dragon wakes up."], kind="chapter", chapter=2)
+
+    results = index.search("dragon", k=5, kinds=["chapter"], before_chapter=2)
+
+    assert [result["text"] for result in results] == ["The dragon sleeps."]
+
+
+def test_index_is_persisted(tmp_path, embedder):
+    index = EmbeddingIndex(str(tmp_path), embedder.embed)
+    index.add(["The dragon attacks.", "The queen flees."], kind="chapter", chapter=0)
+    index.save()
+
+    reloaded = EmbeddingIndex(str(tmp_path), embedder.embed)
+
+    assert len(reloaded) == 2
+    assert reloaded.add(["The queen flees."], kind="chapter", chapter=0) == 0
+    assert reloaded.search("queen", k=1)[0]["text"] == "The queen flees."
+
+
+def test_split_paragraphs():
+    assert split_paragraphs("One.\n\n  \nTwo.\nStill two.\n\n") == ["One.", "Two.\nStill two."]
+
+
+def test_extra_matrix_rows_of_an_interrupted_save_are_dropped(tmp_path, embedder):
+    index = EmbeddingIndex(str(tmp_path), embedder.embed)
+    index.add(["The dragon attacks."], kind="chapter", chapter=0)
+    index.save()
+    metadata = (tmp_path / EmbeddingIndex.METADATA_FILE_NAME).read_text()
+
+    # The process dies after the matrix was saved, before the metadata was.
+    index.add(["The queen flees."], kind="chapter", chapter=0)
+    index.save()
+    (tmp_path / EmbeddingIndex.METADATA_FILE_NAME).write_text(metadata)
+
+    reloaded = EmbeddingIndex(str(tmp_path), embedder.embed)
+    assert len(reloaded) == 1
+    assert reloaded.matrix.shape[0] == 1
+    assert reloaded.add(["The queen flees."], kind="chapter", chapter=0) == 1
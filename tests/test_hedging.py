@@ -0,0 +1,63 @@
+import time
+import threading
+
+from source.hedging import LatencyTracker, RequestHedger
+from source.telemetry import Telemetry, percentile
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_hedger(max_hedge_ratio=1.0, clock=time.monotonic):
+    tracker = LatencyTracker(hedge_percentile=90, min_samples=3, min_delay=0.05)
+    for _ in range(3):
+        tracker.record("gpt-4", 0.01)
+    return RequestHedger(tracker, max_hedge_ratio=max_hedge_ratio, telemetry=Telemetry(), clock=clock)
+
+
+def test_slow_request_is_hedged_and_loser_discarded():
+    clock = FakeClock()
+    hedger = make_hedger(clock=clock)
+    primary_released = threading.Event()
+    discarded = []
+
+    # The primary only answers after the hedged duplicate won.
+    def primary():
+        primary_released.wait(timeout=10)
+        return "slow"
+
+    def secondary():
+        clock.now = 0.1
+        return "fast"
+
+    assert hedger.run("gpt-4", primary, secondary, on_discarded=discarded.append) == "fast"
+    assert hedger.hedges == 1 and hedger.hedge_wins == 1
+
+    clock.now = 1.0
+    primary_released.set()
+    hedger.executor.shutdown(wait=True)
+    assert discarded == ["slow"]
+    assert hedger.telemetry.latency_summary("openai.chat.unhedged")["p99"] == 1.0
+    assert hedger.telemetry.latency_summary("openai.chat")["p99"] == 0.1
+    assert hedger.telemetry.summary()["counters"]["openai.chat.hedged"] == 1
+
+
+def test_budget_caps_hedging():
+    hedger = make_hedger(max_hedge_ratio=0.0)
+
+    def request():
+        time.sleep(0.1)
+        return "answer"
+
+    assert hedger.run("gpt-4", request) == "answer"
+    assert hedger.hedges == 0
+
+
+def test_percentile():
+    assert percentile(list(range(1, 101)), 99) == 99
+    assert percentile([], 50) == 0.0
@@ -0,0 +1,29 @@
+import pytest
+
+from source.lc.lc_stepgraph import LCStepGraph
+
+
+class FakeProject():
+    def __init__(self, step_commands_dict):
+        self.step_commands_dict = step_commands_dict
+
+
+def test_build_graph_adds_dependencies():
+    project = FakeProject({"Plot": {"depends_on": []},
+                           "Characters": {"depends_on": ["Plot"]},
+                           "Setting": {"depends_on": ["Plot"]}})
+    graph = LCStepGraph(step_names=["Characters"]).build_graph(project)
+    assert graph == {"Characters": ["Plot"], "Plot": []}
+
+
+def test_build_graph_rejects_unknown_dependency():
+    project = FakeProject({"Plot": {"depends_on": ["Outline"]}})
+    with pytest.raises(ValueError):
+        LCStepGraph().build_graph(project)
+
+
+def test_build_graph_rejects_cycle():
+    project = FakeProject({"Plot": {"depends_on": ["Setting"]},
+                           "Setting": {"depends_on": ["Plot"]}})
+    with pytest.raises(ValueError):
+        LCStepGraph().build_graph(project)
@@ -0,0 +1,53 @@
+import pytest
+
+from source.minhash import MinHashIndex
+
+
+PARAGRAPH = ("The old lighthouse keeper climbed the spiral stairs every night, "
+             "counting the steps and listening to the waves crash against the rocks below.")
+
+
+def test_near_duplicate_is_found():
+    index = MinHashIndex()
+    index.add("c0p0", PARAGRAPH)
+    index.add("c0p1", "The merchants of the harbour town argued about the price of salt and rope.")
+
+    reworded = PARAGRAPH.replace("every night", "each night")
+    matches = index.query(reworded)
+
+    assert [key for key, _ in matches] == ["c0p0"]
+    assert matches[0][1] >= index.threshold
+
+
+def test_unrelated_paragraph_is_not_flagged():
+    index = MinHashIndex()
+    index.add("c0p0", PARAGRAPH)
+
+    assert index.query("A young pilot raced her glider across the desert at dawn.") == []
+
+
+def test_replacing_a_key_removes_the_old_signature():
+    index = MinHashIndex()
+    index.add("c0p0", PARAGRAPH)
+    index.add("c0p0", "A young pilot raced her glider across the desert at dawn.")
+
+    assert len(index) == 1
+    assert index.query(PARAGRAPH) == []
+
+
+def test_index_is_persisted(tmp_path):
+    index_path = str(tmp_path / "minhash.json")
+    MinHashIndex(index_path).add("c0p0", PARAGRAPH)
+
+    reloaded = MinHashIndex(index_path)
+
+    assert "c0p0" in reloaded
+    assert reloaded.query(PARAGRAPH)[0] == ("c0p0", 1.0)
+
+    # Signatures created with different parameters are ignored.
+    assert len(MinHashIndex(index_path, seed=2)) == 0
+
+
+def test_bands_must_divide_permutations():
+    with pytest.raises(ValueError):
+        MinHashIndex(num_permutations=64, bands=10)
@@ -0,0 +1,32 @@
+import os
+import json
+
+from source.chain import BaseChainElement, ChainExecutor
+from source.profiler import ChainProfiler
+
+
+class CountingElement(BaseChainElement):
+    def __init__(self):
+        self.steps = 0
+
+    def is_done(self):
+        return self.steps >= 3
+
+    def step(self, llm_connection):
+        self.steps += 1
+        sum(i * i for i in range(10_000))
+
+
+def test_profiles_are_written_per_element(tmp_path):
+    profile_path = str(tmp_path / "profile")
+    chain_executor = ChainExecutor(None, profiler=ChainProfiler(profile_path))
+    chain_executor.add_element(CountingElement())
+    chain_executor.run()
+
+    assert os.path.exists(os.path.join(profile_path, "CountingElement.pstats"))
+    assert os.path.exists(os.path.join(profile_path, "stacks.collapsed"))
+    assert "CountingElement: 3 steps" in open(os.path.join(profile_path, "summary.txt")).read()
+
+    with open(os.path.join(profile_path, "spans.json")) as f:
+        spans = json.load(f)
+    assert [span["element"] for span in spans] == ["CountingElement"] * 3
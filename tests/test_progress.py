@@ -0,0 +1,37 @@
+import json
+
+from source.progress import ProgressTracker, format_seconds
+
+
+def test_eta_from_plan_and_observed_units(tmp_path):
+    progress_path = tmp_path / "live_progress.json"
+    tracker = ProgressTracker(str(progress_path), min_interval=0.0)
+    tracker.plan("WriteChapterOutlines", 4, seconds=40.0)
+    tracker.plan("WriteChapters", 10, seconds=100.0)
+
+    # Before anything ran, the ETA is the projection.
+    assert tracker.snapshot()["eta_seconds"] == 140.0
+
+    tracker.start("WriteChapterOutlines")
+    tracker.elements["WriteChapterOutlines"]["started"] -= 20.0
+    tracker.record_request(100, 50)
+    tracker.advance("WriteChapterOutlines", current="chapter 1")
+
+    snapshot = json.loads(progress_path.read_text())
+    outlines = snapshot["elements"]["WriteChapterOutlines"]
+    assert outlines["units_done"] == 1
+    assert 59.0 < outlines["eta_seconds"] < 61.0
+    assert snapshot["tokens"] == 150
+
+    # The outlines took twice as long as projected, so do the chapters.
+    tracker.finish("WriteChapterOutlines")
+    tracker.elements["WriteChapterOutlines"]["finished"] = tracker.elements["WriteChapterOutlines"]["started"] + 80.0
+    assert tracker.snapshot()["elements"]["WriteChapters"]["eta_seconds"] == 200.0
+
+
+def test_unknown_eta():
+    tracker = ProgressTracker()
+    tracker.start("Step Graph")
+    assert tracker.snapshot()["eta_seconds"] is None
+    assert format_seconds(None) == "?"
+    assert format_seconds(3725) == "1:02:05"
@@ -0,0 +1,47 @@
+import json
+import threading
+
+from source.project import Project
+
+
+def test_concurrent_usage_and_status_updates(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    (tmp_path / "description.txt").write_text("A book.")
+    project = Project(str(tmp_path))
+
+    def work(thread_index):
+        for request_index in range(100):
+            project.usage_ledger.set_step(f"Element {thread_index % 2}", thread_local=True)
+            project.record_usage("gpt-4" if thread_index % 2 else "gpt-3.5-turbo", 10, 5, backend="openai")
+            project.set_current_status(f"Thread {thread_index}", f"Request {request_index}")
+
+    threads = [threading.Thread(target=work, args=(thread_index,)) for thread_index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    usage = project.get_usage()
+    assert usage["token_count"] == usage["total_tokens"] == 8 * 100 * 15
+    assert usage["models"]["gpt-4"]["calls"] == usage["models"]["gpt-3.5-turbo"]["calls"] == 400
+    assert usage["steps"]["Element 1"]["models"]["gpt-4"]["completion_tokens"] == 400 * 5
+
+    status = json.loads((tmp_path / "output" / "status.json").read_text())
+    assert status["Current status"]["Status"] == "Request 99"
+    assert json.loads((tmp_path / "output" / "usage.json").read_text())["total_tokens"] == 8 * 100 * 15
+    assert not list((tmp_path / "output").glob("*.tmp"))
+
+
+def test_step_progress_does_not_touch_the_current_progress(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    (tmp_path / "description.txt").write_text("A book.")
+    project = Project(str(tmp_path))
+    project.save_current_progress({"draft": "history"})
+
+    # Concurrent steps finish in any order.
+    project.save_step_progress("Creating Characters", {"draft": "characters"}, done=True)
+    project.save_step_progress("Creating Setting", {"draft": "setting v1"})
+
+    assert project.load_current_progress() == {"draft": "history"}
+    assert project.load_step_progress("Creating Characters")["progress"] == {"draft": "characters"}
+    assert project.load_step_progress("Creating Setting")["progress"] == {"draft": "setting v1"}
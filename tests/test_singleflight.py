@@ -0,0 +1,51 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from source.singleflight import SingleFlight
+
+
+def test_identical_requests_in_flight_are_sent_once():
+    single_flight = SingleFlight()
+    calls = []
+    key = SingleFlight.request_key("openai.chat", "gpt-4", [{"role": "user", "content": "TOC?"}])
+
+    def request():
+        calls.append(threading.get_ident())
+        time.sleep(0.2)
+        return "answer"
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: single_flight.do(key, request), range(4)))
+
+    assert len(calls) == 1
+    assert [result for result, _ in results] == ["answer"] * 4
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    assert single_flight.calls == {}
+
+
+def test_sequential_requests_are_not_coalesced():
+    single_flight = SingleFlight()
+    assert single_flight.do("key", lambda: 1) == (1, False)
+    assert single_flight.do("key", lambda: 2) == (2, False)
+
+
+def test_waiters_receive_the_error():
+    single_flight = SingleFlight()
+    started = threading.Event()
+
+    def failing():
+        started.set()
+        time.sleep(0.1)
+        raise ConnectionError("down")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(single_flight.do, "key", failing)
+        started.wait()
+        waiter = executor.submit(single_flight.do, "key", lambda: "unused")
+        with pytest.raises(ConnectionError):
+            leader.result()
+        with pytest.raises(ConnectionError):
+            waiter.result()
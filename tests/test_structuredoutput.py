@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from source.structuredoutput import (
+    get_json_mode_model,
+    parse_json,
+    request_json,
+    strip_list_marker,
+    validate,
+    StructuredOutputError,
+    SUMMARY_SCHEMA,
+    TOC_SCHEMA,
+)
+from source.bookchainelements import WriteChapterSummaries
+
+
+class FakeLLM():
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.calls = []
+
+    def chat(self, messages, version4=False, json_mode=False):
+        self.calls.append(messages)
+        return {"role": "assistant", "content": self.answers.pop(0)}
+
+
+def test_parse_json_tolerates_code_fences():
+    assert parse_json('Here you go:\n```json\n{"chapters": ["A"]}\n```') == {"chapters": ["A"]}
+    with pytest.raises(ValueError):
+        parse_json("1. A\n2. B")
+
+
+def test_validate_reports_invalid_fields_only():
+    errors = validate({"title": "The Storm", "summary": ""}, SUMMARY_SCHEMA)
+    assert list(errors) == ["summary"]
+    assert validate({"chapters": ["A", 3]}, TOC_SCHEMA) == {"chapters": "item 1 must be of type string"}
+
+
+def test_request_json_repairs_only_invalid_fields():
+    summary = "The keeper finds the map and sets sail for the island that is on no chart."
+    llm = FakeLLM([json.dumps({"title": "The Map", "summary": "tbd"}),
+                   json.dumps({"title": "Ignored", "summary": summary})])
+
+    data = request_json(llm, [{"role": "user", "content": "Summarize."}], SUMMARY_SCHEMA)
+
+    assert data == {"title": "The Map", "summary": summary}
+    assert len(llm.calls) == 2
+    assert "- summary:" in llm.calls[1][-1]["content"]
+    assert "- title:" not in llm.calls[1][-1]["content"]
+
+
+def test_request_json_gives_up_after_repairs():
+    llm = FakeLLM(["no json", "still none", "nope"])
+    with pytest.raises(StructuredOutputError):
+        request_json(llm, [{"role": "user", "content": "Chapters?"}], TOC_SCHEMA, max_repairs=2)
+
+
+def test_failed_summary_request_leaves_history_unchanged(tmp_path):
+    (tmp_path / "output").mkdir()
+    (tmp_path / "description.txt").write_text("A lighthouse keeper finds a map.", encoding="utf-8")
+    (tmp_path / "output" / "book_titles.txt").write_text("1. The Keeper", encoding="utf-8")
+    element = WriteChapterSummaries(str(tmp_path))
+    element.messages = [{"role": "system", "content": "You write chapter summaries."}]
+
+    with pytest.raises(StructuredOutputError):
+        element.write_summary(FakeLLM(["no json"] * 3), 0, ["The Map"])
+    assert element.messages == [{"role": "system", "content": "You write chapter summaries."}]
+
+
+def test_strip_list_marker():
+    assert strip_list_marker('1. "The Lighthouse"') == "The Lighthouse"
+    assert strip_list_marker("- **Point**") == "Point"
+
+
+def test_configured_models_use_json_mode_versions():
+    assert get_json_mode_model("gpt-3.5-turbo-16k") == "gpt-3.5-turbo-0125"
+    assert get_json_mode_model("gpt-4") == "gpt-4-turbo"
+    assert get_json_mode_model("gpt-4o") == "gpt-4o"
+    assert get_json_mode_model("llama2") is None
@@ -0,0 +1,40 @@
+from source.artifactstore import FileArtifactStore
+from source.summarytree import SummaryTree
+
+
+class FakeChat():
+    def __init__(self):
+        self.prompts = []
+
+    def __call__(self, messages):
+        self.prompts.append(messages[-1]["content"])
+        return {"role": "assistant", "content": f"summary {len(self.prompts)}"}
+
+
+def test_story_so_far_is_cached_and_rebuilt_incrementally(tmp_path):
+    store = FileArtifactStore(str(tmp_path))
+    chat = FakeChat()
+    tree = SummaryTree(store, chat, chapters_per_part=2)
+    for chapter_index in range(5):
+        tree.update_chapter(chapter_index, f"Text of chapter {chapter_index}.")
+    assert len(chat.prompts) == 5
+
+    # Chapter 5 gets a book summary of parts 1 and 2 and the summary of chapter 4 of its part.
+    story = tree.story_so_far(5)
+    assert len(chat.prompts) == 8
+    assert story.endswith("Chapter 5: summary 5")
+    assert tree.story_so_far(5) == story
+    assert len(chat.prompts) == 8
+
+    # A new tree loads the cache from the store.
+    tree = SummaryTree(store, chat, chapters_per_part=2)
+    tree.update_chapter(0, "Text of chapter 0.")
+    assert tree.story_so_far(5) == story
+    assert len(chat.prompts) == 8
+
+    # A changed chapter rebuilds only its chapter, its part and the book summary.
+    tree.update_chapter(1, "Rewritten chapter 1.")
+    tree.story_so_far(5)
+    assert len(chat.prompts) == 11
+    assert "Rewritten chapter 1." in chat.prompts[8]
+    assert tree.story_so_far(0) == ""
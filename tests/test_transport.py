@@ -0,0 +1,35 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from source import transport
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+def test_client_is_shared_and_reuses_connections():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    before = transport.get_pool_metrics()
+    client = transport.get_http_client()
+    assert transport.get_http_client() is client
+
+    for _ in range(3):
+        assert client.get(f"http://127.0.0.1:{server.server_port}/").text == "ok"
+    server.shutdown()
+
+    after = transport.get_pool_metrics()
+    assert after["requests"] - before["requests"] == 3
+    assert after["connections_opened"] - before["connections_opened"] == 1
+    assert after["open_connections"] >= 1
@@ -0,0 +1,52 @@
+import os
+import multiprocessing
+
+from source.workqueue import WorkQueue, QueueWorker
+
+
+def run_unit(unit, worker_id):
+    # Writes the artifact of the unit atomically and queues the next stage.
+    artifact_path = os.path.join(unit["book_path"], f"{unit['stage']}_{unit['chapter']}.txt")
+    with open(f"{artifact_path}.{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+        f.write(worker_id)
+    os.replace(f"{artifact_path}.{os.getpid()}.tmp", artifact_path)
+
+    if unit["stage"] == "outline":
+        return [dict(unit, stage="chapter", priority=1)]
+    return []
+
+
+def work(queue_path):
+    QueueWorker(WorkQueue(queue_path, lease_seconds=0.5), run_unit, poll_interval=0.05).run()
+
+
+def die_holding_a_lease(queue_path):
+    WorkQueue(queue_path, lease_seconds=0.5).claim()
+
+
+def test_workers_drain_the_queue_and_recover_expired_leases(tmp_path):
+    queue_path = str(tmp_path / "queue")
+    queue = WorkQueue(queue_path, lease_seconds=0.5)
+    for chapter in range(12):
+        queue.enqueue({"book_path": str(tmp_path), "stage": "outline", "chapter": chapter,
+                       "priority": 2})
+    assert not queue.enqueue({"book_path": str(tmp_path), "stage": "outline", "chapter": 0,
+                              "priority": 2})
+
+    # A worker that dies right after claiming a unit.
+    process = multiprocessing.Process(target=die_holding_a_lease, args=(queue_path,))
+    process.start()
+    process.join()
+    assert len(queue.names(WorkQueue.LEASED)) == 1
+
+    processes = [multiprocessing.Process(target=work, args=(queue_path,)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    assert queue.is_drained()
+    assert len(queue.names(WorkQueue.DONE)) == 24
+    for chapter in range(12):
+        assert os.path.exists(tmp_path / f"chapter_{chapter}.txt")
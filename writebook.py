@@ -4,12 +4,27 @@ import time
 import datetime
 import traceback
 import argparse
+import functools
 import dotenv
 
 
 from source.openaiconnection import OpenAIConnection
 from source.project import Project
-from source.chain import ChainExecutor
+from source.chain import ChainExecutor, COMPLETED
+from source.embeddingindex import EmbeddingIndex
+from source.minhash import MinHashIndex
+from source.summarytree import SummaryTree
+from source.planner import BookPlanner
+from source.budget import Budget
+from source.cassette import Cassette
+from source.artifactstore import SQLiteArtifactStore
+from source.daemon import BookDaemon
+from source.workqueue import WorkQueue, QueueWorker
+from source.profiler import ChainProfiler
+from source.hedging import LatencyTracker, RequestHedger
+from source.concurrency import AdaptiveConcurrencyLimiter
+from source import transport
+from source.tokencounter import TokenCounter
 
 from source.bookchainelements import (
     #WritePlot, # Experimental
@@ -28,7 +43,7 @@ from source.oaa import (
 
 from source.lc import (
     LCControl,
-    LCChainStep
+    LCStepGraph
 )
 
 # Load the environment variables.
@@ -52,7 +67,26 @@ def writebook(book_path: str,
               langchain: bool,
               gpt_model: str,
               local_cm:str,
-              local_llm: str):
+              local_llm: str,
+              retrieval: bool = False,
+              deduplicate: bool = False,
+              parallel_lines: bool = False,
+              smooth_transitions: bool = False,
+              workers: int = 8,
+              plan: bool = False,
+              max_tokens: int = None,
+              max_cost: float = None,
+              record: bool = False,
+              replay: bool = False,
+              replay_realtime: bool = False,
+              profile: bool = False,
+              hedge: bool = False,
+              hedge_percentile: float = 95,
+              hedge_budget: float = 0.1,
+              sqlite: bool = False,
+              summary_tree: bool = False,
+              adaptive_concurrency: bool = False,
+              cancel_event=None):
 
     # See if the book path exists. If not, raise an error.
     if not os.path.exists(book_path):
@@ -65,13 +99,50 @@ def writebook(book_path: str,
         raise ExitException(f"File {description_path} does not exist."
                             "Please create it. It should contain a short description of the book.")
 
+    # Print the projected calls, tokens, cost and time of the remaining work and stop.
+    if plan:
+        if assistant or langchain:
+            raise ExitException("Planning is only available for the default OpenAI chain.")
+        planner = BookPlanner(book_path, TokenCounter(),
+                              parallel_lines=parallel_lines,
+                              workers=workers,
+                              retrieval_top_k=4 if retrieval else None)
+        print(planner.format_plan(planner.plan()))
+        return
+
     # Start time.
     start_time = time.time()
-    
+
+    budget = None
+    if max_tokens is not None or max_cost is not None:
+        budget = Budget(max_tokens=max_tokens, max_cost=max_cost)
+
     book_project = Project(book_path=book_path,
                             verbose=verbose,
                             logging=logging,
-                            persistent_logging=persistent_logging)
+                            persistent_logging=persistent_logging,
+                            budget=budget,
+                            sqlite=sqlite)
+
+    # Stop before the next request once the job is cancelled, e.g. through the daemon.
+    book_project.cancel_event = cancel_event
+
+    # Record the exchanges with the LLMs, or replay a recorded run without network access.
+    if record and (replay or replay_realtime):
+        raise ExitException("Cannot record and replay at the same time.")
+    cassette_path = os.path.join(book_path, Cassette.FILE_NAME)
+    if record:
+        book_project.cassette = Cassette(cassette_path, Cassette.RECORD)
+    elif replay or replay_realtime:
+        book_project.cassette = Cassette(cassette_path, Cassette.REPLAY, realtime=replay_realtime)
+
+    # Size the HTTP pool that all OpenAI backends share to the concurrency.
+    transport.configure(workers)
+
+    # Profile the chain elements into output/profile.
+    profiler = None
+    if profile:
+        profiler = ChainProfiler(os.path.join(book_project.output_path, "profile"))
 
     # Create a chain executor.
     if not assistant and not langchain:
@@ -80,14 +151,59 @@ def writebook(book_path: str,
         # Create the model connection.
         model_connection = OpenAIConnection(project_control=book_project)
 
+        # Duplicate chat requests that are slower than the percentile of the recent ones.
+        # Replayed runs have no tail latency to cut.
+        if hedge and book_project.cassette is None:
+            model_connection.hedger = RequestHedger(LatencyTracker(hedge_percentile=hedge_percentile),
+                                                    max_hedge_ratio=hedge_budget,
+                                                    max_workers=2 * workers + 2,
+                                                    telemetry=book_project.telemetry)
+
+        # Create the embedding index for retrieving relevant passages.
+        embedding_index = None
+        if retrieval:
+            embedding_index = EmbeddingIndex(book_project.output_path, model_connection.embed)
+
+        # Create the index for detecting repeated paragraphs.
+        duplicate_index = None
+        if deduplicate:
+            duplicate_index = MinHashIndex(os.path.join(book_project.output_path, "minhash.json"))
+
+        # Seed the progress with the projected work, so that the ETA of the book is known
+        # before the elements that follow have started. The measured throughput corrects it.
+        planner = BookPlanner(book_path, book_project.token_counter,
+                              parallel_lines=parallel_lines,
+                              workers=workers,
+                              retrieval_top_k=4 if retrieval else None)
+        try:
+            element_plans = planner.plan()
+        except Exception as e:  # pylint: disable=broad-except
+            # E.g. the tokenizer cannot be loaded offline. The ETA then starts with the elements.
+            print(f"Could not plan the book, the ETA is estimated from the throughput only: {e}")
+            element_plans = []
+        for element_plan in element_plans:
+            book_project.progress.plan(element_plan["element"], element_plan["calls"],
+                                       element_plan["seconds"])
+
+        # Create the summary tree for the story so far.
+        story_summary_tree = None
+        if summary_tree:
+            story_summary_tree = SummaryTree(book_project.store, model_connection.chat)
+
         # Add the chain elements.
-        chain_executor = ChainExecutor(model_connection)
+        chain_executor = ChainExecutor(model_connection, profiler=profiler)
         # chain_executor.add_element(WritePlot(book_path)) # Experimental
         chain_executor.add_element(FindBookTitle(book_path))
         chain_executor.add_element(WriteTableOfContents(book_path))
-        chain_executor.add_element(WriteChapterSummaries(book_path))
-        chain_executor.add_element(WriteChapterOutlines(book_path))
-        chain_executor.add_element(WriteChapters(book_path))
+        chain_executor.add_element(WriteChapterSummaries(book_path, embedding_index=embedding_index))
+        chain_executor.add_element(WriteChapterOutlines(book_path, embedding_index=embedding_index))
+        chain_executor.add_element(WriteChapters(book_path,
+                                                 embedding_index=embedding_index,
+                                                 duplicate_index=duplicate_index,
+                                                 parallel_lines=parallel_lines,
+                                                 max_workers=workers,
+                                                 smooth_transitions=smooth_transitions,
+                                                 summary_tree=story_summary_tree))
         chain_executor.add_element(JoinBook(book_path))
 
     elif assistant:
@@ -99,26 +215,42 @@ def writebook(book_path: str,
                                       )
 
         # Add the chain elements.
-        chain_executor = ChainExecutor(model_connection)
+        chain_executor = ChainExecutor(model_connection, profiler=profiler)
         chain_executor.add_element(CreatePlot(book_path))
 
     elif langchain:
         # Write the book using LangChain.
         
+        # Find the sweet spot of parallel queries of the Ollama server, up to the workers.
+        concurrency_limiter = None
+        if adaptive_concurrency:
+            concurrency_limiter = AdaptiveConcurrencyLimiter(max_limit=workers,
+                                                             telemetry=book_project.telemetry,
+                                                             name="ollama")
+
         # Create the connection to the Ollama server and setup the project
         model_connection = LCControl(project_control=book_project,
                                      gpt_model=gpt_model,
                                      ollama_cm_model=local_cm,
-                                     ollama_llm_model=local_llm
+                                     ollama_llm_model=local_llm,
+                                     concurrency_limiter=concurrency_limiter
                                      )
 
         # Add the chain elements.
-        chain_executor = ChainExecutor(model_connection, book_project)
-        chain_executor.add_element(LCChainStep("Creating Plot"))
-        #chain_executor.add_element(LCChainStep("Refining Plot"))
+        chain_executor = ChainExecutor(model_connection, book_project, profiler=profiler)
+        chain_executor.add_element(LCStepGraph(max_workers=workers))
 
     # Run the chain.
-    chain_executor.run()
+    try:
+        run_status = chain_executor.run()
+    finally:
+        if book_project.cassette is not None:
+            book_project.cassette.close()
+
+        # Keep the file layout of the output directory up to date for readers of the book.
+        if isinstance(book_project.store, SQLiteArtifactStore):
+            exported = book_project.store.export(book_project.output_path)
+            print(f"Exported {exported} artifacts to {book_project.output_path}")
 
     # Elapsed time.
     elapsed_time = time.time() - start_time
@@ -128,14 +260,117 @@ def writebook(book_path: str,
     with open(summary_file_path, "w", encoding="utf-8") as summary_file:
         total_tokens_used = model_connection.get_token_count()
         print(f"Total tokens used: {total_tokens_used}", file=summary_file)
+        print(book_project.usage_ledger.format_summary(), file=summary_file)
+        book_project.telemetry.set_section("http_pool", transport.get_pool_metrics())
+        if getattr(model_connection, "concurrency_limiter", None) is not None:
+            book_project.telemetry.set_section("ollama_concurrency",
+                                               model_connection.concurrency_limiter.snapshot())
+        print(book_project.telemetry.format_summary(), file=summary_file)
+        if getattr(model_connection, "hedger", None) is not None:
+            print(model_connection.hedger.format_report(), file=summary_file)
+        book_project.telemetry.save()
 
         elapsed_time_string = str(datetime.timedelta(seconds=elapsed_time))
         print(f"Elapsed time: {elapsed_time_string}", file=summary_file)
 
+        # A book that stopped early resumes in the next run.
+        if run_status != COMPLETED:
+            print(f"Book incomplete: {run_status}", file=summary_file)
+
+    if run_status != COMPLETED:
+        book_project.set_current_status("Write book", f"Incomplete: {run_status}")
+        print(f"The book is incomplete ({run_status}). Run again to resume.")
+
+    return run_status
+
+
+# Connections of a queue worker per book, kept for all units of the book.
+_worker_connections = {}
+
+
+def get_worker_connection(book_path: str, worker_id: str) -> OpenAIConnection:
+    """ Returns the connection of a queue worker to write units of a book with. """
+    if book_path not in _worker_connections:
+        book_project = Project(book_path=book_path)
+
+        # Every worker keeps its own ledger, the workers of a book run in different processes.
+        book_project.usage_ledger.ledger_path = os.path.join(book_project.output_path,
+                                                             f"usage_{worker_id}.json")
+        _worker_connections[book_path] = OpenAIConnection(project_control=book_project)
+    return _worker_connections[book_path]
+
+
+def run_work_unit(unit: dict,
+                  worker_id: str,
+                  parallel_lines: bool = False,
+                  smooth_transitions: bool = False,
+                  workers: int = 8) -> list:
+    """ Runs a work unit of a book: the title and table of contents, the summary, outline or
+        text of a chapter, or joining the book. Artifacts that exist already are skipped.
+
+    Args:
+        unit (dict): The unit, with "book_path", "stage" and "chapter".
+        worker_id (str): Id of the worker process.
+        parallel_lines (bool, optional): Whether to expand the outline lines in parallel.
+            Defaults to False.
+        smooth_transitions (bool, optional): Whether to smooth the transitions between
+            parallel outline lines. Defaults to False.
+        workers (int, optional): Maximum number of parallel requests. Defaults to 8.
+
+    Returns:
+        list: The units that follow from the unit.
+    """
+    book_path = unit["book_path"]
+    chapter = unit.get("chapter")
+    model_connection = get_worker_connection(book_path, worker_id)
+    book_project = model_connection.project_control
+    book_project.usage_ledger.set_step(f"{unit['stage']} {chapter}" if chapter is not None else unit["stage"])
+
+    def next_unit(stage, priority, chapter_index=None):
+        return {"book_path": book_path, "stage": stage, "chapter": chapter_index, "priority": priority}
+
+    if unit["stage"] == "toc":
+        for element in (FindBookTitle(book_path), WriteTableOfContents(book_path)):
+            while not element.is_done():
+                element.step(llm_connection=model_connection)
+        chapter_titles = WriteTableOfContents(book_path).get_chapter_titles()
+        return [next_unit("summary", 3, chapter_index) for chapter_index in range(len(chapter_titles))]
+
+    if unit["stage"] == "summary":
+        element = WriteChapterSummaries(book_path)
+        element.step(llm_connection=model_connection)
+        element.write_summary(model_connection, chapter, element.get_chapter_titles())
+        return [next_unit("outline", 2, chapter)]
+
+    if unit["stage"] == "outline":
+        element = WriteChapterOutlines(book_path)
+        element.step(llm_connection=model_connection)
+        element.write_outline(model_connection, f"chapter_{chapter}.txt")
+        return [next_unit("chapter", 1, chapter)]
+
+    if unit["stage"] == "chapter":
+        # Chapters are written independently from each other, without the history of the
+        # chapters before.
+        element = WriteChapters(book_path, parallel_lines=parallel_lines, max_workers=workers,
+                                smooth_transitions=smooth_transitions)
+        element.step(llm_connection=model_connection)
+        element.write_chapter(model_connection, f"chapteroutline_{chapter}.txt")
+
+        # The worker that writes the last chapter queues joining the book.
+        if len(element.get_chapter_names()) == len(element.get_chapter_titles()):
+            return [next_unit("join", 0)]
+        return []
+
+    if unit["stage"] == "join":
+        JoinBook(book_path).step(llm_connection=model_connection)
+        return []
+
+    raise ValueError(f"Unknown work unit stage: {unit['stage']}")
+
 
 def main():
     parser = argparse.ArgumentParser(description="Write books with AI.")
-    parser.add_argument('book_path', type=str,
+    parser.add_argument('book_path', type=str, nargs='?',
                         help='Path to the book directory')
     
     parser.add_argument('--verbose', '--v', action='store_true',
@@ -147,12 +382,86 @@ def main():
     parser.add_argument('--persistent_logging', '--pl', action='store_true',
                         help='Activate persistent logging')
 
-    # OpenAI's assistants take too long to respond, so that option is disabled for now.
-    # parser.add_argument('--assistant', '--a', action='store_true', help='Use OpenAI assistants')
+    parser.add_argument('--assistant', '--a', action='store_true', help='Use OpenAI assistants')
 
     parser.add_argument('--langchain', '--lc', action='store_true',
                         help='Use LangChain')
 
+    parser.add_argument('--retrieval', '--r', action='store_true',
+                        help='Give chapter prompts only the relevant passages of earlier chapters')
+
+    parser.add_argument('--deduplicate', '--dd', action='store_true',
+                        help='Request outline lines again if they repeat earlier paragraphs')
+
+    parser.add_argument('--parallel_lines', '--pll', action='store_true',
+                        help='Expand all outline lines of a chapter in parallel')
+
+    parser.add_argument('--smooth_transitions', '--st', action='store_true',
+                        help='Smooth the transitions between parallel outline lines')
+
+    parser.add_argument('--summary_tree', '--stree', action='store_true',
+                        help='Give chapter prompts a summary of the story so far instead of the whole history')
+
+    parser.add_argument('--workers', '--w', type=int, default=8,
+                        help='Maximum number of parallel requests')
+
+    parser.add_argument('--adaptive_concurrency', '--ac', action='store_true',
+                        help='Adapt the parallel queries to the local Ollama server, up to --workers')
+
+    parser.add_argument('--plan', action='store_true',
+                        help='Print the projected calls, tokens, cost and time and exit')
+
+    parser.add_argument('--max_tokens', type=int, default=None,
+                        help='Stop the run before it uses more tokens than this')
+
+    parser.add_argument('--max_cost', type=float, default=None,
+                        help='Stop the run before it costs more US dollars than this')
+
+    parser.add_argument('--record', action='store_true',
+                        help='Record all LLM exchanges to cassette.jsonl.gz in the book directory')
+
+    parser.add_argument('--replay', action='store_true',
+                        help='Replay the recorded LLM exchanges instantly, without network access')
+
+    parser.add_argument('--replay_realtime', action='store_true',
+                        help='Replay the recorded LLM exchanges with their original latencies')
+
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile every chain element into output/profile')
+
+    parser.add_argument('--hedge', action='store_true',
+                        help='Send a duplicate of chat requests that are slower than usual')
+
+    parser.add_argument('--hedge_percentile', type=float, default=95,
+                        help='Latency percentile of recent requests after which to hedge')
+
+    parser.add_argument('--hedge_budget', type=float, default=0.1,
+                        help='Maximum share of chat requests that may be duplicated')
+
+    parser.add_argument('--sqlite', action='store_true',
+                        help='Store the artifacts in output/book.sqlite so that many workers can write the book')
+
+    parser.add_argument('--daemon', action='store_true',
+                        help='Run as a daemon that writes the books submitted to its HTTP API')
+
+    parser.add_argument('--port', type=int, default=8765,
+                        help='Port of the daemon API on localhost')
+
+    parser.add_argument('--queue', type=str, default='writebook_queue.json',
+                        help='File that persists the job queue of the daemon')
+
+    parser.add_argument('--concurrent_books', '--cb', type=int, default=1,
+                        help='Number of books the daemon writes at the same time')
+
+    parser.add_argument('--enqueue', type=str, default=None, metavar='QUEUE',
+                        help='Queue the book as work units in the shared queue directory and exit')
+
+    parser.add_argument('--worker', type=str, default=None, metavar='QUEUE',
+                        help='Run the work units of the shared queue directory until it is drained')
+
+    parser.add_argument('--lease_seconds', type=float, default=60,
+                        help='Seconds after which the work unit of a dead worker is queued again')
+
     parser.add_argument('--gpt_model', '--gpt', type=str,
                         choices=['3.5', '4'],
                         # default='3.5',
@@ -176,14 +485,56 @@ def main():
     }
     mapped_gpt_model = gpt_model_mapping.get(args.gpt_model, DEFAULT_GPT_MODEL)
 
-    # -------!!!!!!!---------
-    # OpenAI's assistants take too long to respond, so that option is disabled for now.
-    args.assistant = False
-
-    writebook(args.book_path, verbose=args.verbose, logging=args.logging,
-              persistent_logging=args.persistent_logging, 
-              assistant=args.assistant, langchain=args.langchain, gpt_model=mapped_gpt_model,
-              local_cm=args.local_cm,local_llm=args.local_llm)
+    options = dict(verbose=args.verbose, logging=args.logging,
+                   persistent_logging=args.persistent_logging, 
+                   assistant=args.assistant, langchain=args.langchain, gpt_model=mapped_gpt_model,
+                   local_cm=args.local_cm,local_llm=args.local_llm,
+                   retrieval=args.retrieval, deduplicate=args.deduplicate,
+                   parallel_lines=args.parallel_lines, smooth_transitions=args.smooth_transitions,
+                   workers=args.workers, plan=args.plan,
+                   max_tokens=args.max_tokens, max_cost=args.max_cost,
+                   record=args.record, replay=args.replay, replay_realtime=args.replay_realtime,
+                   profile=args.profile, hedge=args.hedge,
+                   hedge_percentile=args.hedge_percentile, hedge_budget=args.hedge_budget,
+                   sqlite=args.sqlite, summary_tree=args.summary_tree,
+                   adaptive_concurrency=args.adaptive_concurrency)
+
+    # Serve the job API. The command line options are the defaults of the submitted jobs.
+    if args.daemon:
+        transport.configure(args.workers * args.concurrent_books)
+        daemon = BookDaemon(functools.partial(writebook, **options), args.queue,
+                            concurrency=args.concurrent_books, port=args.port)
+        daemon.serve_forever()
+        return
+
+    # Work on the units of the shared queue, together with any number of other workers.
+    if args.worker is not None:
+        transport.configure(args.workers)
+        queue = WorkQueue(args.worker, lease_seconds=args.lease_seconds)
+        worker = QueueWorker(queue, functools.partial(run_work_unit,
+                                                      parallel_lines=args.parallel_lines,
+                                                      smooth_transitions=args.smooth_transitions,
+                                                      workers=args.workers))
+        worker.run()
+        return
+
+    if args.book_path is None:
+        parser.error("book_path is required unless --daemon or --worker is given.")
+
+    # Initialize the book and queue its first unit. The following units are queued by the
+    # workers as the artifacts they depend on are written.
+    if args.enqueue is not None:
+        Project(book_path=args.book_path, sqlite=args.sqlite)
+        queue = WorkQueue(args.enqueue, lease_seconds=args.lease_seconds)
+        queue.enqueue({"book_path": os.path.abspath(args.book_path), "stage": "toc",
+                       "chapter": None, "priority": 4})
+        print(f"Queued {args.book_path} in {args.enqueue}")
+        return
+
+    # An incomplete book exits with an error code, so that scripts can tell.
+    run_status = writebook(args.book_path, **options)
+    if run_status not in (None, COMPLETED):
+        raise SystemExit(1)
 
 
 if __name__ == '__main__':
@@ -191,5 +542,7 @@ if __name__ == '__main__':
         main()
     except ExitException as e:
         print(e)
+    except SystemExit:
+        raise
     except:
         traceback.print_exc()
\ No newline at end of file